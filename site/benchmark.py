@@ -0,0 +1,303 @@
+"""
+Benchmarks for the performance critical parts of SF_KMeans.
+No database, S3 or celery setup or use is employed; data is generated randomly.
+
+Usage: python benchmark.py --n 200000 --d 10 --k 20
+
+Author: Angad Gill, Nevena Golubovic
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from numpy.linalg import LinAlgError
+from scipy.spatial.distance import cdist
+
+from sf_kmeans.distances import squared_mahalanobis, squared_euclidean, BLOCK_SIZE
+from sf_kmeans.factorization import CovarianceFactors
+from sf_kmeans.cluster_statistics import ClusterStatistics, covariances_from_statistics
+from sf_kmeans.sf_kmeans import SF_KMeans
+from sf_kmeans.multi_config import MultiConfigKMeans
+from sf_kmeans.seeding import kmeans_plusplus, kmeans_parallel, farthest_traversal
+from sf_kmeans.workspace import Workspace
+
+
+def timeit(func, repeat=3):
+    """
+    Runs `func` `repeat` times and returns the best wall clock time in seconds along with the last result.
+    """
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start_time = time.time()
+        result = func()
+        best = min(best, time.time() - start_time)
+    return best, result
+
+
+def random_problem(n, d, k, seed=0):
+    """
+    Generates random data, cluster centers and inverse covariance matrices.
+    """
+    rs = np.random.RandomState(seed)
+    data = rs.randn(n, d)
+    centers = rs.randn(k, d)
+    inv_covar_matrices = []
+    for _ in range(k):
+        a = rs.randn(d, d)
+        inv_covar_matrices += [np.linalg.inv(a.dot(a.T) / d + np.eye(d))]
+    return data, centers, np.array(inv_covar_matrices)
+
+
+def whitening_factors(inv_covar_matrices):
+    """
+    Computes a whitening factor W for each inverse covariance matrix, such that VI = W W^T.
+
+    The lower Cholesky factor is used when possible. A matrix that is not positive definite (numerically)
+    falls back to its symmetric eigendecomposition with negative eigenvalues clipped to zero.
+
+    Parameters
+    ----------
+    inv_covar_matrices: list or numpy array of inverse covariance matrices. Shape: (n_clusters, dim, dim)
+
+    Returns
+    -------
+    numpy array of whitening factors. Shape: (n_clusters, dim, dim)
+    """
+    inv_covar_matrices = np.asarray(inv_covar_matrices, dtype=float)
+    try:
+        return np.linalg.cholesky(inv_covar_matrices)
+    except LinAlgError:
+        factors = np.empty_like(inv_covar_matrices)
+        for k, matrix in enumerate(inv_covar_matrices):
+            try:
+                factors[k] = np.linalg.cholesky(matrix)
+            except LinAlgError:
+                eigenValues, eigenVectors = np.linalg.eigh(matrix)
+                factors[k] = eigenVectors * np.sqrt(np.clip(eigenValues, 0, None))
+        return factors
+
+
+def cdist_loop(data, centers, inv_covar_matrices):
+    """ Per-cluster cdist loop that SF_KMeans used before the batched distance engine """
+    distances = np.zeros((data.shape[0], centers.shape[0]))
+    for k in range(centers.shape[0]):
+        k_dist = cdist(data, np.array([centers[k]]), metric='mahalanobis', VI=inv_covar_matrices[k])
+        distances[:, k] = k_dist.reshape((data.shape[0],))
+    return distances
+
+
+def bench_distances(n, d, k, repeat):
+    data, centers, inv_covar_matrices = random_problem(n, d, k)
+    loop_time, expected = timeit(lambda: cdist_loop(data, centers, inv_covar_matrices), repeat)
+    batched_time, result = timeit(
+        lambda: squared_mahalanobis(data, centers, whitening_factors(inv_covar_matrices)), repeat)
+    assert np.allclose(expected ** 2, result)
+    print('distances n={} d={} k={}: cdist loop {:.4f}s, batched {:.4f}s, speedup {:.1f}x'.format(
+        n, d, k, loop_time, batched_time, loop_time / batched_time))
+
+
+def bench_shared_distances(n, d, k, repeat):
+    data, centers, inv_covar_matrices = random_problem(n, d, k)
+    factors = whitening_factors(inv_covar_matrices[:1])
+    loop_time, expected = timeit(lambda: squared_mahalanobis(data, centers, np.repeat(factors, k, axis=0)), repeat)
+    whitened_time, result = timeit(lambda: squared_euclidean(data.dot(factors[0]), centers.dot(factors[0])), repeat)
+    assert np.allclose(expected, result)
+    print('shared covariance distances n={} d={} k={}: per-cluster {:.4f}s, whitened {:.4f}s, speedup {:.1f}x'.format(
+        n, d, k, loop_time, whitened_time, loop_time / whitened_time))
+
+
+def rank_inv_det(covar_matrices):
+    """ Per-matrix rank check, inverse and determinants that SF_KMeans used before CovarianceFactors """
+    inverses = []
+    for c in covar_matrices:
+        np.linalg.det(c)  # positivity check in covariances
+        np.linalg.matrix_rank(c)
+        inverses += [np.linalg.inv(c)]
+    np.linalg.det(covar_matrices)  # log_likelihood
+    return whitening_factors(inverses)
+
+
+def bench_factorization(d, k, repeat):
+    _, _, inv_covar_matrices = random_problem(1, d, k)
+    covar_matrices = np.linalg.inv(inv_covar_matrices)
+    old_time, _ = timeit(lambda: rank_inv_det(covar_matrices), repeat)
+    new_time, _ = timeit(lambda: CovarianceFactors(covar_matrices), repeat)
+    print('factorization d={} k={}: rank+inv+det {:.4f}s, cholesky {:.4f}s, speedup {:.1f}x'.format(
+        d, k, old_time, new_time, old_time / new_time))
+
+
+def masked_covariances(data, labels, k):
+    """ Boolean-mask copy and np.cov per cluster that SF_KMeans used before ClusterStatistics """
+    return np.array([np.cov(data[labels == c].T, bias=True) for c in range(k)])
+
+
+def bench_covariances(n, d, k, repeat):
+    data, _, _ = random_problem(n, d, k)
+    labels = np.random.RandomState(0).randint(k, size=n)
+    old_time, expected = timeit(lambda: masked_covariances(data, labels, k), repeat)
+
+    def from_statistics():
+        statistics = ClusterStatistics.from_labels(data, labels, k)
+        return covariances_from_statistics(statistics.counts, statistics.scatters, 'full', False, 0)
+    new_time, result = timeit(from_statistics, repeat)
+    assert np.allclose(expected, result)
+    print('covariances n={} d={} k={}: masked np.cov {:.4f}s, statistics {:.4f}s, speedup {:.1f}x'.format(
+        n, d, k, old_time, new_time, old_time / new_time))
+
+
+def bench_restarts(n, d, k, n_init, repeat):
+    data = np.vstack([random_problem(n // k, d, 1, seed=c)[0] + 4 * c for c in range(k)])
+    times = {}
+    for engine in ['loop', 'stacked']:
+        kmeans = SF_KMeans(n_clusters=k, n_init=n_init, engine=engine, random_state=0)
+        times[engine], _ = timeit(lambda: kmeans.fit(data), repeat)
+    print('restarts n={} d={} k={} n_init={}: loop {:.4f}s, stacked {:.4f}s, speedup {:.1f}x'.format(
+        data.shape[0], d, k, n_init, times['loop'], times['stacked'], times['loop'] / times['stacked']))
+
+
+def bench_multi_config(n, d, k, n_init, repeat):
+    data = np.vstack([random_problem(n // k, d, 1, seed=c)[0] + 4 * c for c in range(k)])
+    covars = [(covar_type, covar_tied) for covar_type in ['full', 'diag', 'spher'] for covar_tied in [False, True]]
+
+    def separate():
+        for covar_type, covar_tied in covars:
+            SF_KMeans(n_clusters=k, n_init=n_init, covar_type=covar_type, covar_tied=covar_tied,
+                      random_state=0).fit(data)
+    separate_time, _ = timeit(separate, repeat)
+    together_time, _ = timeit(lambda: MultiConfigKMeans(n_clusters=k, covars=covars, n_init=n_init,
+                                                        random_state=0).fit(data), repeat)
+    print('covariance configurations n={} d={} k={} n_init={}: separate {:.4f}s, together {:.4f}s, '
+          'speedup {:.1f}x'.format(data.shape[0], d, k, n_init, separate_time, together_time,
+                                   separate_time / together_time))
+
+
+def bench_bounds(n, d, k, repeat):
+    data = np.vstack([random_problem(n // k, d, 1, seed=c)[0] + 2 * c for c in range(k)])
+    times, counts = {}, {}
+    for assignment in ['full', 'hamerly', 'elkan']:
+        kmeans = SF_KMeans(n_clusters=k, n_init=1, metric='euclidean', assignment=assignment, random_state=0)
+        times[assignment], _ = timeit(lambda: kmeans.fit(data), repeat)
+        counts[assignment] = (kmeans.distances_computed_, kmeans.distances_skipped_)
+    print('bounds n={} d={} k={}: '.format(data.shape[0], d, k) + ', '.join(
+        '{} {:.4f}s ({} computed, {} skipped)'.format(assignment, times[assignment], *counts[assignment])
+        for assignment in ['full', 'hamerly', 'elkan']))
+
+
+def farthest_traversal_cdist(data, k, seed):
+    """ Farthest Traversal that SF_KMeans used before seeding.py, recomputing the distances from all centers """
+    rs = np.random.RandomState(seed)
+    centers = data[rs.randint(low=0, high=data.shape[0], size=1)]
+    for _ in range(k - 1):
+        dist = cdist(data, centers).sum(axis=1)
+        centers = np.append(centers, [data[np.argmax(dist)]], axis=0)
+    return centers
+
+
+def bench_seeding(n, d, k, repeat):
+    data = np.vstack([random_problem(n // k, d, 1, seed=c)[0] + 4 * c for c in range(k)])
+
+    def potential(centers):
+        return squared_euclidean(data, centers).min(axis=1).sum()
+    times, potentials = {}, {}
+    for name, seed in [('k-means++', lambda: kmeans_plusplus(data, k, 0)[0]),
+                       ('k-means||', lambda: kmeans_parallel(data, k, 0)[0]),
+                       ('farthest', lambda: farthest_traversal(data, k, 0)[0]),
+                       ('farthest cdist', lambda: farthest_traversal_cdist(data, k, 0))]:
+        times[name], centers = timeit(seed, repeat)
+        potentials[name] = potential(centers)
+    print('seeding n={} d={} k={}: '.format(data.shape[0], d, k) + ', '.join(
+        '{} {:.4f}s (potential {:.4g})'.format(name, times[name], potentials[name]) for name in times))
+
+
+def bench_two_phase(n, d, k, n_init, repeat):
+    rs = np.random.RandomState(0)
+    data = np.vstack([random_problem(n // k, d, 1, seed=c)[0].dot(rs.randn(d, d)) + 4 * c for c in range(k)])
+    data = (data - data.mean(axis=0)) / data.std(axis=0)
+    times, iterations = {}, {}
+    for euclidean_tol in [None, 1e-2]:
+        kmeans = SF_KMeans(n_clusters=k, n_init=n_init, euclidean_tol=euclidean_tol, random_state=0)
+        times[euclidean_tol], _ = timeit(lambda: kmeans.fit(data), repeat)
+        iterations[euclidean_tol] = (sum(kmeans.euclidean_iteration_nums_),
+                                     sum(kmeans.iteration_nums_) - sum(kmeans.euclidean_iteration_nums_))
+    print('two-phase n={} d={} k={} n_init={}: mahalanobis only {:.4f}s ({} iterations), euclidean then mahalanobis '
+          '{:.4f}s ({} + {} iterations), speedup {:.1f}x'.format(
+              data.shape[0], d, k, n_init, times[None], iterations[None][1], times[1e-2], iterations[1e-2][0],
+              iterations[1e-2][1], times[None] / times[1e-2]))
+
+
+def bench_racing(n, d, k, n_init, repeat):
+    # Overlapping clusters, so that restarts end in local optima of different quality
+    data = np.vstack([problem[0] * (0.5 + c % 3) + 2 * problem[1][0]
+                      for c, problem in enumerate(random_problem(n // k, d, 1, seed=c) for c in range(k))])
+    times, fits = {}, {}
+    for race_margin in [None, 0.01]:
+        kmeans = SF_KMeans(n_clusters=k, n_init=n_init, covar_type='spher', covar_tied=True, race_margin=race_margin,
+                           random_state=0)
+        times[race_margin], _ = timeit(lambda: kmeans.fit(data), repeat)
+        fits[race_margin] = (kmeans.best_inertia_, sum(kmeans.iteration_nums_), kmeans.pruned_restarts_,
+                             sum(kmeans.pruned_iteration_nums_))
+    print('racing n={} d={} k={} n_init={}: all restarts {:.4f}s (inertia {:.1f}, {} iterations), racing {:.4f}s '
+          '(inertia {:.1f}, {} iterations, {} restarts abandoned after {} iterations), speedup {:.1f}x'.format(
+              data.shape[0], d, k, n_init, times[None], fits[None][0], fits[None][1], times[0.01], *fits[0.01],
+              times[None] / times[0.01]))
+
+
+def lloyd_steps(data, centers, factors, iterations, workspace=None):
+    """
+    Runs the assignment and cluster statistics steps of `iterations` iterations with fixed factors, with the
+    scratch arrays allocated anew in every iteration if workspace is None.
+    """
+    n, d = data.shape
+    k = centers.shape[0]
+    for _ in range(iterations):
+        if workspace is None:
+            distances = squared_mahalanobis(data, centers, factors)
+        else:
+            distances = squared_mahalanobis(data, centers, factors, out=workspace.array('distances', (n, k)),
+                                            scratch=workspace.array('projected', (max(BLOCK_SIZE, k * d),)))
+        labels = np.argmin(distances, axis=1)
+        centers = ClusterStatistics.from_labels(data, labels, k, workspace=workspace).means
+    return centers
+
+
+def bench_workspace(n, d, k, iterations, repeat):
+    data, centers, inv_covar_matrices = random_problem(n, d, k)
+    factors = whitening_factors(inv_covar_matrices)
+    peaks, times = {}, {}
+    for name, workspace in [('fresh arrays', None), ('workspace', Workspace())]:
+        times[name], _ = timeit(lambda: lloyd_steps(data, centers, factors, iterations, workspace), repeat)
+        tracemalloc.start()
+        lloyd_steps(data, centers, factors, iterations, workspace)
+        peaks[name] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    print('workspace n={} d={} k={} iterations={}: fresh arrays {:.4f}s (peak {:.1f} MiB allocated), workspace '
+          '{:.4f}s (peak {:.1f} MiB allocated after the first run), speedup {:.1f}x'.format(
+              n, d, k, iterations, times['fresh arrays'], peaks['fresh arrays'], times['workspace'],
+              peaks['workspace'], times['fresh arrays'] / times['workspace']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SF_KMeans benchmarks')
+    parser.add_argument('--n', type=int, default=200000, help='number of data points')
+    parser.add_argument('--d', type=int, default=10, help='number of dimensions')
+    parser.add_argument('--k', type=int, default=20, help='number of clusters')
+    parser.add_argument('--n_init', type=int, default=50, help='number of restarts')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timing repetitions')
+    args = parser.parse_args()
+
+    bench_distances(args.n, args.d, args.k, args.repeat)
+    bench_shared_distances(args.n, args.d, args.k, args.repeat)
+    bench_factorization(args.d, args.k, args.repeat)
+    bench_covariances(args.n, args.d, args.k, args.repeat)
+    bench_bounds(args.n // 10, args.d, args.k, args.repeat)
+    bench_seeding(args.n, args.d, args.k, args.repeat)
+    bench_two_phase(args.n // 10, args.d, args.k, 5, args.repeat)
+    bench_racing(args.n // 10, args.d, args.k, 20, args.repeat)
+    bench_workspace(args.n, args.d, args.k, 10, args.repeat)
+    bench_restarts(3000, args.d, args.k, args.n_init, args.repeat)
+    bench_multi_config(args.n // 10, args.d, args.k, 10, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,478 @@
+"""
+Worker-side cache of the datasets read from S3.
+
+Every task of a job reads the same file, so each worker process keeps two tiers of datasets, each bounded in bytes
+and evicted least recently used first:
+1. Memory: parsed Pandas DataFrames and prepared data of this process.
+2. Disk: downloaded files in a directory shared by the worker processes of a machine. Files are downloaded to a
+   temporary name and renamed into place, so a process never reads a partially downloaded file.
+
+Entries are keyed by the S3 file key and the ETag of the file, or a content hash given by the caller, so a file
+that changes in S3 is read again.
+
+The cache also keeps prepared data, see PreparedData: the matrix a task fits after selecting and scaling the
+columns of its job. It is the same for all tasks of a job, so only the first task of a job on a worker prepares
+it. Prepared data is kept in memory, or in a SharedDataStore that all worker processes of a machine map, and,
+optionally, in the disk tier.
+
+Author: Angad Gill, Nevena Golubovic
+"""
+import os
+import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from utils import download_from_s3, s3_object_info
+
+
+class PreparedData(object):
+    """
+    Data ready for fit: the columns of a job, scaled if requested, as one contiguous float array.
+
+    Attributes
+    ----------
+    data: numpy array. Shape: (number of data points, number of columns)
+    mean: mean of each column before scaling, or None if the data is not scaled. Shape: (number of columns)
+    std: standard deviation of each column before scaling, 1 for constant columns, or None if the data is not
+        scaled. Shape: (number of columns)
+    """
+    def __init__(self, data, mean=None, std=None):
+        self.data = data
+        self.mean = mean
+        self.std = std
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.data, self.mean, self.std) if array is not None)
+
+    def original_units(self, centers):
+        """
+        Maps cluster centers fit on the data back to the units of the columns before scaling.
+
+        Parameters
+        ----------
+        centers: numpy array. Shape: (n_clusters, number of columns)
+
+        Returns
+        -------
+        numpy array. Shape: (n_clusters, number of columns)
+        """
+        if self.mean is None:
+            return centers
+        return centers * self.std + self.mean
+
+
+class DatasetCache(object):
+    """
+    Two-tier LRU cache of datasets read from S3.
+
+    Attributes
+    ----------
+    memory_hits: int
+    shared_hits: int
+    disk_hits: int
+    misses: int
+        number of reads served by each tier, or downloaded from S3, by this process
+    """
+    def __init__(self, memory_bytes, disk_bytes, directory, shared=None):
+        """
+        Parameters
+        ----------
+        memory_bytes: int
+            Size limit of the parsed DataFrames and prepared data kept in memory; 0 disables the memory tier
+        disk_bytes: int
+            Size limit of the files kept in directory; 0 disables the disk tier
+        directory: str
+            Directory of the disk tier, created if it does not exist
+        shared: SharedDataStore
+            If set, prepared data is kept there instead of in the memory of this process
+        """
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = directory
+        self.shared = shared
+        self.memory_hits = 0
+        self.shared_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # (s3_file_key, version) -> (DataFrame, size in bytes) and ('prepared', key) -> (PreparedData, size in
+        # bytes), least recently used first
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._miss_read_times = {}  # (s3_file_key, version) -> seconds taken by the read from S3
+        self._lock = threading.Lock()
+
+    def read(self, s3_file_key, parse, version=None, size=None):
+        """
+        Reads a dataset from the fastest tier that has it.
+        The returned data is shared with later reads and must not be modified.
+
+        Parameters
+        ----------
+        s3_file_key: str
+            Eucalyptus S3 file key
+        parse: function
+            Converts the local file name of the downloaded file to the dataset. Only Pandas DataFrames are kept in
+            memory; other datasets, such as memory-mapped arrays, are parsed again from disk on every read.
+        version: str
+            ETag or content hash of the file, such as the hashes of `utils.csv_to_columns`; if None, the ETag and
+            size are looked up in S3
+        size: int
+            Size of the file in bytes, used with version
+
+        Returns
+        -------
+        data, dict
+            dataset as returned by parse, read details:
+                read_source: 'memory', 'disk' or 's3'
+                read_time_saved: seconds saved compared to the read from S3 of the same file by this process,
+                    or None if unknown
+        """
+        start_time = time.time()
+        if version is None:
+            version, size = s3_object_info(s3_file_key)
+        key = (s3_file_key, version)
+
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key][0], self._read_details(key, 'memory', start_time)
+
+        filename = self._disk_filename(s3_file_key, version)
+        try:
+            os.utime(filename)  # marks the file as recently used
+            data = parse(filename)
+            source = 'disk'
+        except FileNotFoundError:  # not on disk, or just evicted by another process
+            data = self._download(s3_file_key, filename, 0 < size <= self.disk_bytes, parse)
+            source = 's3'
+
+        with self._lock:
+            if source == 'disk':
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+            if isinstance(data, pd.DataFrame):
+                self._add_to_memory(key, data, int(data.memory_usage(deep=True).sum()))
+            details = self._read_details(key, source, start_time)
+        return data, details
+
+    def prepared_key(self, s3_file_key, columns, scale):
+        """
+        Key of the prepared data of a file, made of the S3 file key, the ETag of the file, the columns and scale.
+
+        Parameters
+        ----------
+        s3_file_key: str
+        columns: list(str)
+        scale: bool
+
+        Returns
+        -------
+        str
+        """
+        etag, _ = s3_object_info(s3_file_key)
+        description = json.dumps([s3_file_key, etag, list(columns), bool(scale)])
+        return hashlib.md5(description.encode('utf-8')).hexdigest()
+
+    def read_prepared(self, key):
+        """
+        Reads prepared data from memory, from the shared data store or, if it was persisted, from disk.
+        The returned data is shared with later reads and must not be modified.
+
+        Parameters
+        ----------
+        key: str
+            see `prepared_key`
+
+        Returns
+        -------
+        PreparedData, dict
+            prepared data and read details, see `read`, with read_source 'shared' for the shared data store, or
+            None, None if no tier has it
+        """
+        start_time = time.time()
+        memory_key = ('prepared', key)
+        with self._lock:
+            if memory_key in self._memory:
+                self._memory.move_to_end(memory_key)
+                self.memory_hits += 1
+                return self._memory[memory_key][0], self._read_details(memory_key, 'memory', start_time)
+        if self.shared is not None:
+            prepared = self.shared.get(key)
+            if prepared is not None:
+                with self._lock:
+                    self.shared_hits += 1
+                    return prepared, self._read_details(memory_key, 'shared', start_time)
+
+        filename = self._disk_filename('prepared', key)
+        try:
+            os.utime(filename)  # marks the file as recently used
+            with np.load(filename) as arrays:
+                prepared = PreparedData(arrays['data'], *[arrays[name] if name in arrays.files else None
+                                                          for name in ('mean', 'std')])
+        except FileNotFoundError:  # not on disk, or just evicted by another process
+            return None, None
+        prepared = self._keep_prepared(key, prepared)
+        with self._lock:
+            self.disk_hits += 1
+            return prepared, self._read_details(memory_key, 'disk', start_time)
+
+    def add_prepared(self, key, prepared, read_time, persist=False):
+        """
+        Keeps prepared data in memory, or in the shared data store, and, if persist, in the disk tier.
+
+        Parameters
+        ----------
+        key: str
+            see `prepared_key`
+        prepared: PreparedData
+        read_time: float
+            Seconds taken to read and prepare the data, used for read_time_saved of later reads
+        persist: bool
+
+        Returns
+        -------
+        PreparedData
+            prepared, or its copy in the shared data store, which the caller should use instead so that its own
+            copy can be freed
+        """
+        with self._lock:
+            self._miss_read_times[('prepared', key)] = read_time
+        kept = self._keep_prepared(key, prepared)
+        if not persist or prepared.nbytes > self.disk_bytes:
+            return kept
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self._disk_filename('prepared', key)
+        partial_filename = '{}.{}.part'.format(filename, os.getpid())
+        arrays = dict((name, array) for name, array in
+                      (('data', prepared.data), ('mean', prepared.mean), ('std', prepared.std)) if array is not None)
+        with open(partial_filename, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(partial_filename, filename)
+        self._evict_disk(keep=filename)
+        return kept
+
+    def _keep_prepared(self, key, prepared):
+        """
+        Keeps prepared data in the shared data store if there is one and it fits, else in memory; returns the kept
+        data
+        """
+        if self.shared is not None:
+            kept = self.shared.put(key, prepared)
+            if kept is not prepared:
+                return kept
+        with self._lock:
+            self._add_to_memory(('prepared', key), prepared, prepared.nbytes)
+        return prepared
+
+    def _download(self, s3_file_key, filename, keep_on_disk, parse):
+        """
+        Downloads the file to filename in the disk tier, or to a temporary file if not keep_on_disk, and parses it
+        """
+        if not keep_on_disk:
+            filename = download_from_s3(s3_file_key)
+            try:
+                return parse(filename)
+            finally:
+                os.remove(filename)
+        os.makedirs(self.directory, exist_ok=True)
+        partial_filename = '{}.{}.part'.format(filename, os.getpid())
+        download_from_s3(s3_file_key, partial_filename)
+        os.replace(partial_filename, filename)
+        self._evict_disk(keep=filename)
+        return parse(filename)
+
+    def _read_details(self, key, source, start_time):
+        """ Read details of `read`; records the read time of reads from S3 """
+        read_time = time.time() - start_time
+        if source == 's3':
+            self._miss_read_times[key] = read_time
+            return dict(read_source=source, read_time_saved=None)
+        miss_read_time = self._miss_read_times.get(key)
+        read_time_saved = None if miss_read_time is None else max(0., miss_read_time - read_time)
+        return dict(read_source=source, read_time_saved=read_time_saved)
+
+    def _add_to_memory(self, key, data, size):
+        """ Keeps data of size bytes in memory and evicts the least recently used data beyond memory_bytes """
+        if key in self._memory:
+            self._memory_size -= self._memory.pop(key)[1]
+        if size > self.memory_bytes:
+            return
+        self._memory[key] = (data, size)
+        self._memory_size += size
+        while self._memory_size > self.memory_bytes:
+            _, (_, evicted_size) = self._memory.popitem(last=False)
+            self._memory_size -= evicted_size
+
+    def _disk_filename(self, s3_file_key, version):
+        return os.path.join(self.directory, '{}.{}.cached'.format(s3_file_key.replace('/', '_'), version))
+
+    def _evict_disk(self, keep):
+        """
+        Deletes the least recently used files beyond disk_bytes, except keep. Only complete downloads count;
+        partial downloads and files derived from a download, such as the arrays of `utils.csv_to_memmap`, are left
+        alone.
+        """
+        evict_least_recently_used(self.directory, '.cached', self.disk_bytes, keep)
+
+
+class SharedDataStore(object):
+    """
+    Prepared data shared by the worker processes of a machine through memory-mapped files in a shared memory
+    file system such as /dev/shm. The first process to prepare the data of a job writes it once; the others map
+    the same pages read-only, so a machine holds one copy of the data of a job however many processes fit it.
+    Files are written to a temporary name and renamed into place, and evicted least recently used first beyond
+    max_bytes. A process that still maps an evicted file keeps reading it until it unmaps it.
+
+    The store is only a cache: data that does not fit, or cannot be written, is not stored, and the caller keeps
+    its own copy.
+    """
+    def __init__(self, directory, max_bytes):
+        """
+        Parameters
+        ----------
+        directory: str
+            Directory in a shared memory file system, created if it does not exist
+        max_bytes: int
+            Size limit of the shared data, lowered to half of the size of the file system, which is often small;
+            Docker gives containers 64 MB of /dev/shm by default
+        """
+        self.directory = directory
+        total_bytes, _ = file_system_bytes(directory)
+        self.max_bytes = min(max_bytes, total_bytes // 2)
+
+    def get(self, key):
+        """
+        Maps the prepared data stored under key.
+
+        Parameters
+        ----------
+        key: str
+            see `DatasetCache.prepared_key`
+
+        Returns
+        -------
+        PreparedData with read-only memory-mapped data, or None if the store does not have it
+        """
+        data_filename, stats_filename = self._filenames(key)
+        try:
+            os.utime(data_filename)  # marks the data as recently used
+            stats = np.load(stats_filename)
+            data = np.load(data_filename, mmap_mode='r')
+        except FileNotFoundError:  # not stored, or just evicted by another process
+            return None
+        if stats.size == 0:
+            return PreparedData(data)
+        return PreparedData(data, stats[0], stats[1])
+
+    def put(self, key, prepared):
+        """
+        Stores prepared data under key, unless it is larger than max_bytes.
+
+        Parameters
+        ----------
+        key: str
+        prepared: PreparedData
+
+        Returns
+        -------
+        PreparedData
+            the stored data mapped read-only, so the caller can drop its own copy, or prepared if it is not stored
+        """
+        if prepared.nbytes > self.max_bytes or prepared.nbytes > file_system_bytes(self.directory)[1]:
+            return prepared
+        data_filename, stats_filename = self._filenames(key)
+        stats = np.empty(0) if prepared.mean is None else np.array([prepared.mean, prepared.std])
+        partial_filename = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # The statistics are renamed into place first, so a data file always has its statistics
+            for filename, array in ((stats_filename, stats), (data_filename, prepared.data)):
+                partial_filename = '{}.{}.part'.format(filename, os.getpid())
+                with open(partial_filename, 'wb') as f:
+                    np.save(f, array)
+                os.replace(partial_filename, filename)
+            partial_filename = None
+            evict_least_recently_used(self.directory, '.shared', self.max_bytes, data_filename, companion='.stats')
+        except OSError as e:  # e.g. the file system is full
+            print(' shared data store: not storing {}: {}'.format(key, e))
+            for filename in (partial_filename, data_filename, stats_filename):
+                if filename is not None:
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        pass
+            return prepared
+        return self.get(key) or prepared
+
+    def _filenames(self, key):
+        """ Names of the data and statistics files of key """
+        return os.path.join(self.directory, key + '.shared'), os.path.join(self.directory, key + '.stats')
+
+
+def file_system_bytes(path):
+    """
+    Total and free bytes of the file system of path, or of its nearest existing parent if path does not exist.
+
+    Parameters
+    ----------
+    path: str
+
+    Returns
+    -------
+    int, int
+        total bytes, bytes available to this process
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    stat = os.statvfs(path)
+    return stat.f_blocks * stat.f_frsize, stat.f_bavail * stat.f_frsize
+
+
+def evict_least_recently_used(directory, suffix, max_bytes, keep, companion=None):
+    """
+    Deletes the least recently modified files of directory whose names end with suffix, until those left, keep
+    included, take at most max_bytes. Other processes may delete the same files at the same time, so files that are
+    already gone are skipped.
+
+    Parameters
+    ----------
+    directory: str
+    suffix: str
+    max_bytes: int
+    keep: str
+        File that is never deleted
+    companion: str
+        If set, the file with this suffix instead of suffix is deleted together with each file
+    """
+    files = []
+    for name in os.listdir(directory):
+        filename = os.path.join(directory, name)
+        if not name.endswith(suffix) or filename == keep:
+            continue
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+        files += [(stat.st_mtime, stat.st_size, filename)]
+    total_size = sum(size for _, size, _ in files) + os.path.getsize(keep)
+    for _, size, filename in sorted(files):
+        if total_size <= max_bytes:
+            break
+        evicted = [filename]
+        if companion is not None:
+            evicted += [filename[:-len(suffix)] + companion]
+        for evicted_filename in evicted:
+            try:
+                os.remove(evicted_filename)
+            except OSError:
+                pass
+        total_size -= size
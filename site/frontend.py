@@ -31,7 +31,9 @@ from werkzeug.utils import secure_filename
 from utils import tasks_to_best_results, task_stats, tasks_to_best_task
 from utils import plot_cluster_fig, plot_single_cluster_fig, plot_aic_bic_fig
 from utils import plot_count_fig, plot_correlation_fig, get_viz_columns
-from utils import allowed_file, upload_to_s3, s3_to_df, job_to_data, fig_to_png
+from utils import allowed_file, upload_to_s3, s3_to_df, fig_to_png
+from utils import s3_to_columns, s3_column_names
+from utils import job_to_columns
 from worker import create_tasks, rerun_task
 from config import UPLOAD_FOLDER, EXCLUDE_COLUMNS, SPATIAL_COLUMNS
 from models import Job, Task
@@ -150,8 +152,7 @@ def report(job_id=None):
     best_tasks = tasks_to_best_results(job_id, min_members)
 
     viz_columns = get_viz_columns(job, x_axis, y_axis)
-    data = s3_to_df(job.s3_file_key)
-    columns = list(data.columns)
+    columns = s3_column_names(job.s3_file_key)
     spatial_columns = [c for c in columns if c.lower() in SPATIAL_COLUMNS][:2]
 
     # recommendations for all covariance types
@@ -265,10 +266,9 @@ def report_task():
     if task_id is None:
         return None
     task_id = int(task_id)
-    data = job_to_data(job_id)
-    columns = list(data.columns)
-    viz_columns = get_viz_columns(db.session.query(Job).filter_by(job_id=job_id).first(), x_axis,
-                                  y_axis)
+    job = db.session.query(Job).filter_by(job_id=job_id).first()
+    columns = s3_column_names(job.s3_file_key)
+    viz_columns = get_viz_columns(job, x_axis, y_axis)
     return render_template('report_task.html', job_id=job_id,
                            task_id=task_id, viz_columns=viz_columns,
                            columns=columns, plot_best=plot_best)
@@ -302,7 +302,7 @@ def plot_cluster():
         return None
     best_tasks = tasks_to_best_results(job_id, min_members)
     viz_columns = [x_axis, y_axis]
-    data = job_to_data(job_id)
+    data = job_to_columns(job_id, viz_columns)
     fig = plot_cluster_fig(data, viz_columns, best_tasks, show_ticks)
     cluster_plot = fig_to_png(fig)
     response = make_response(cluster_plot.getvalue())
@@ -333,11 +333,11 @@ def plot_task():
     show_ticks = request.args.get('show_ticks', 'True') == 'True'
     if job_id is None or task_id is None:
         return None
-    data = job_to_data(job_id)
     task = db.session.query(Task).filter_by(job_id=job_id,
                                             task_id=task_id).first()
     viz_columns = get_viz_columns(db.session.query(Job).filter_by(
         job_id=job_id).first(), x_axis, y_axis)
+    data = job_to_columns(job_id, viz_columns)
     fig = plot_single_cluster_fig(data, viz_columns, task.labels,
                                   task.bic, task.k,
                                   show_ticks)
@@ -367,7 +367,7 @@ def plot_correlation():
         return None
     job = db.session.query(Job).filter_by(job_id=job_id).first()
     s3_file_key = job.s3_file_key
-    data = s3_to_df(s3_file_key)
+    data = s3_to_columns(s3_file_key)
     fig = plot_correlation_fig(data)
     correlation_plot = fig_to_png(fig)
     response = make_response(correlation_plot.getvalue())
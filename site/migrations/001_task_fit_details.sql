@@ -0,0 +1,11 @@
+-- Adds the columns the worker writes with the results of each task to a task table created before they existed.
+-- New databases get them from the CREATE TABLE statements in the README. Safe to run more than once.
+--
+-- psql -h localhost -U kmeans -d kmeans -f migrations/001_task_fit_details.sql
+ALTER TABLE task
+    ADD COLUMN IF NOT EXISTS coreset_size int,
+    ADD COLUMN IF NOT EXISTS coreset_error numeric,
+    ADD COLUMN IF NOT EXISTS stop_reason text,
+    ADD COLUMN IF NOT EXISTS pruned_restarts int,
+    ADD COLUMN IF NOT EXISTS read_source text,
+    ADD COLUMN IF NOT EXISTS read_time_saved numeric;
@@ -46,3 +46,9 @@ class Task(db.Model):
     elapsed_time = db.Column(db.Integer)
     elapsed_read_time = db.Column(db.Integer)
     elapsed_processing_time = db.Column(db.Integer)
+    coreset_size = db.Column(db.Integer)  # data points in the coreset the task was fit on; null if fit exactly
+    coreset_error = db.Column(db.Float)  # relative log likelihood error of the coreset
+    stop_reason = db.Column(db.String)  # stopping rule that ended the fit, see SF_KMeans.scale_tol
+    pruned_restarts = db.Column(db.Integer)  # restarts abandoned by racing, see SF_KMeans.race_margin
+    read_source = db.Column(db.String)  # where the worker read the data from: 'memory', 'shared', 'disk' or 's3'
+    read_time_saved = db.Column(db.Float)  # seconds the dataset cache saved on the read, see worker.read_data
@@ -0,0 +1,169 @@
+"""
+Triangle inequality bounds that let SF_KMeans skip distance computations in the assignment step.
+
+Bounds are valid for Euclidean distances, which covers metric='euclidean' and the global and tied covariance
+types after whitening. They are tracked in the whitened space and reset whenever the whitening changes.
+
+Hamerly keeps one lower bound per data point (distance to the second closest center) and works well for few
+clusters. Elkan keeps one lower bound per data point and cluster, which prunes more with many clusters at the
+cost of O(number of data points * n_clusters) memory.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import numpy as np
+
+from .distances import squared_euclidean
+
+# With at least this many clusters, 'bounds' uses Elkan's algorithm instead of Hamerly's. Updating Elkan's
+# O(number of data points * n_clusters) bounds costs about as much as computing all distances at low dimension,
+# so Hamerly's is faster for all but very many clusters.
+ELKAN_MIN_CLUSTERS = 256
+
+
+def pair_distances(data, data_norms, cluster_centers, points, clusters):
+    """
+    Computes the Euclidean distance between data[points[i]] and cluster_centers[clusters[i]] for each i.
+    """
+    centers = cluster_centers[clusters]
+    squared = data_norms[points] - 2 * np.einsum('nd,nd->n', data[points], centers) + \
+        np.einsum('nd,nd->n', centers, centers)
+    return np.sqrt(np.maximum(squared, 0))
+
+
+class BoundedAssignment(object):
+    """
+    Assigns data points to their nearest cluster center, skipping the distances that the bounds prove cannot
+    change the assignment.
+
+    Attributes
+    ----------
+    method: str
+        "hamerly" or "elkan"
+    distances_computed: number of point to center distances computed
+    distances_skipped: number of point to center distances skipped thanks to the bounds
+    """
+    def __init__(self, method):
+        if method not in ['hamerly', 'elkan']:
+            raise ValueError('Bound method "{}" not valid. Must be "hamerly" or "elkan".'.format(method))
+        self.method = method
+        self.distances_computed = 0
+        self.distances_skipped = 0
+        self.reset()
+
+    def reset(self):
+        """ Discards the bounds, so that the next assignment computes all distances """
+        self.key = None
+        self.cluster_centers = None
+        self.labels = None
+        self.upper = None
+        self.lower = None
+
+    def assign(self, data, data_norms, cluster_centers, key):
+        """
+        Assigns each data point to its nearest cluster center.
+
+        Parameters
+        ----------
+        data: whitened data. Shape: (number of data points, dim)
+        data_norms: squared norm of each data point. Shape: (number of data points)
+        cluster_centers: whitened cluster centers. Shape: (n_clusters, dim)
+        key: object identifying data and its whitening; the bounds are reset when it changes
+
+        Returns
+        -------
+        labels: cluster label of each data point. Shape: (number of data points)
+        """
+        if self.key is None or self.key is not key:
+            self._initialize(data, data_norms, cluster_centers, key)
+            return self.labels.copy()
+
+        n, n_clusters = data.shape[0], cluster_centers.shape[0]
+        shifts = np.sqrt(((cluster_centers - self.cluster_centers) ** 2).sum(axis=1))
+        self.cluster_centers = cluster_centers
+        labels = self.labels
+        self.upper += shifts[labels]
+        if self.method == 'hamerly':
+            order = np.argsort(shifts)
+            largest = np.where(labels == order[-1], shifts[order[-2]] if n_clusters > 1 else 0, shifts[order[-1]])
+            self.lower -= largest
+        else:
+            self.lower -= shifts  # negative lower bounds are loose but still valid
+
+        center_distances = np.sqrt(squared_euclidean(cluster_centers, cluster_centers))
+        np.fill_diagonal(center_distances, np.inf)
+        half_separation = 0.5 * center_distances.min(axis=1)
+
+        if self.method == 'hamerly':
+            computed = self._hamerly(data, data_norms, half_separation)
+        else:
+            computed = self._elkan(data, data_norms, center_distances, half_separation)
+        self.distances_computed += computed
+        self.distances_skipped += n * n_clusters - computed
+        return self.labels.copy()
+
+    def _initialize(self, data, data_norms, cluster_centers, key):
+        """ Computes all distances and sets tight bounds """
+        n, n_clusters = data.shape[0], cluster_centers.shape[0]
+        distances = np.sqrt(squared_euclidean(data, cluster_centers, data_norms))
+        self.key = key
+        self.cluster_centers = cluster_centers
+        self.labels = np.argmin(distances, axis=1)
+        self.upper = distances[np.arange(n), self.labels]
+        if self.method == 'hamerly':
+            self.lower = self._second_smallest(distances)
+        else:
+            self.lower = distances
+        self.distances_computed += n * n_clusters
+
+    def _hamerly(self, data, data_norms, half_separation):
+        """ Hamerly's assignment step. Returns the number of distances computed. """
+        cluster_centers, labels = self.cluster_centers, self.labels
+        n_clusters = cluster_centers.shape[0]
+        bound = np.maximum(half_separation[labels], self.lower)
+        points = np.flatnonzero(self.upper > bound)
+        computed = points.shape[0]
+        # Tighten the upper bound with the distance to the current center
+        self.upper[points] = pair_distances(data, data_norms, cluster_centers, points, labels[points])
+        points = points[self.upper[points] > bound[points]]
+        if points.shape[0] > 0:
+            distances = np.sqrt(squared_euclidean(data[points], cluster_centers, data_norms[points]))
+            computed += points.shape[0] * (n_clusters - 1)
+            labels[points] = np.argmin(distances, axis=1)
+            self.upper[points] = distances[np.arange(points.shape[0]), labels[points]]
+            self.lower[points] = self._second_smallest(distances)
+        return computed
+
+    def _elkan(self, data, data_norms, center_distances, half_separation):
+        """ Elkan's assignment step. Returns the number of distances computed. """
+        cluster_centers, labels = self.cluster_centers, self.labels
+        points = np.flatnonzero(self.upper > half_separation[labels])
+        computed = points.shape[0]
+        # Tighten the upper bound with the distance to the current center
+        upper = pair_distances(data, data_norms, cluster_centers, points, labels[points])
+        self.upper[points] = upper
+        self.lower[points, labels[points]] = upper
+        # Centers that may be closer than the current one
+        candidates = (upper[:, np.newaxis] > self.lower[points]) & \
+                     (upper[:, np.newaxis] > 0.5 * center_distances[labels[points]])
+        rows, clusters = np.nonzero(candidates)
+        if rows.shape[0] > 0:
+            distances = pair_distances(data, data_norms, cluster_centers, points[rows], clusters)
+            computed += rows.shape[0]
+            self.lower[points[rows], clusters] = distances
+            # Centers that were not candidates are at least as far as the current one, so the closest candidate
+            # (first of each row after sorting by row, then distance) replaces the current center if it is closer
+            order = np.lexsort((distances, rows))
+            firsts = order[np.r_[True, rows[order][1:] != rows[order][:-1]]]
+            closer = distances[firsts] < upper[rows[firsts]]
+            moved, moved_points = firsts[closer], points[rows[firsts[closer]]]
+            labels[moved_points] = clusters[moved]
+            self.upper[moved_points] = distances[moved]
+        return computed
+
+    @staticmethod
+    def _second_smallest(distances):
+        """ Second smallest value in each row, or inf if there is a single column """
+        if distances.shape[1] < 2:
+            return np.full(distances.shape[0], np.inf)
+        return np.partition(distances, 1, axis=1)[:, 1]
@@ -0,0 +1,199 @@
+"""
+Per-cluster sufficient statistics and the covariance matrices derived from them.
+
+All covariance types (full, diag, spher; tied or not; global) are derived from the same per-cluster counts,
+means and scatter matrices, which are computed with a single pass over the data.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import numpy as np
+
+
+class ClusterStatistics(object):
+    """
+    Sufficient statistics of each cluster.
+
+    Attributes
+    ----------
+    counts: number of data points in each cluster, or their total weight. Shape: (n_clusters)
+    means: mean of the data points in each cluster; nan for empty clusters. Shape: (n_clusters, dim)
+    scatters: sum of outer products of the centered data points in each cluster. Shape: (n_clusters, dim, dim)
+    """
+    def __init__(self, counts, means, scatters):
+        self.counts = counts
+        self.means = means
+        self.scatters = scatters
+
+    @classmethod
+    def from_labels(cls, data, labels, n_clusters, sample_weight=None, workspace=None):
+        """
+        Computes the statistics of each cluster with one pass over the data.
+        Data points are ordered by label once, after which each cluster is a contiguous segment.
+
+        Parameters
+        ----------
+        data: numpy array of input data. Shape: (number of data points, dim)
+        labels: cluster label of each data point. Shape: (number of data points)
+        n_clusters: int
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+        workspace: Workspace for the sorted and centered copies of the data, which are allocated if None
+
+        Returns
+        -------
+        ClusterStatistics
+        """
+        data = np.asarray(data, dtype=float)
+        labels = np.asarray(labels)
+        n, n_features = data.shape
+        members = np.bincount(labels, minlength=n_clusters)
+        if n_clusters <= np.iinfo(np.int16).max:
+            labels = labels.astype(np.int16)  # stable sort of small ints is a linear time radix sort
+        order = np.argsort(labels, kind='stable')
+        if workspace is None:
+            sorted_data = data[order]
+            centered_buffer = np.empty_like(data)
+        else:
+            sorted_data = np.take(data, order, axis=0, out=workspace.array('sorted_data', (n, n_features)))
+            centered_buffer = workspace.array('centered_data', (n, n_features))
+        ends = np.cumsum(members)
+        if sample_weight is None:
+            counts = members
+        else:
+            sample_weight = np.asarray(sample_weight, dtype=float)
+            counts = np.bincount(labels, weights=sample_weight, minlength=n_clusters)
+            sorted_weights = sample_weight[order]
+
+        means = np.full((n_clusters, n_features), np.nan)
+        scatters = np.zeros((n_clusters, n_features, n_features))
+        for k in range(n_clusters):
+            if counts[k] == 0:
+                continue
+            segment = sorted_data[ends[k] - members[k]:ends[k]]
+            if sample_weight is None:
+                means[k] = segment.mean(axis=0)
+                centered = np.subtract(segment, means[k], out=centered_buffer[:members[k]])
+                scatters[k] = centered.T.dot(centered)
+            else:
+                weights = sorted_weights[ends[k] - members[k]:ends[k]]
+                means[k] = weights.dot(segment) / counts[k]
+                centered = np.subtract(segment, means[k], out=centered_buffer[:members[k]])
+                # the segment is not needed any more, so it holds the weighted copy
+                weighted = np.multiply(centered, weights[:, np.newaxis], out=segment)
+                scatters[k] = weighted.T.dot(centered)
+        return cls(counts, means, scatters)
+
+    @classmethod
+    def from_label_blocks(cls, data, labels, n_clusters, block_rows, sample_weight=None):
+        """
+        Computes the statistics of each cluster one block of rows at a time, so only one block of data is copied
+        at once.
+
+        Parameters
+        ----------
+        data: numpy array of input data. Shape: (number of data points, dim)
+        labels: cluster label of each data point. Shape: (number of data points)
+        n_clusters: int
+        block_rows: number of rows in each block
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+
+        Returns
+        -------
+        ClusterStatistics
+        """
+        statistics = None
+        for start in range(0, data.shape[0], block_rows):
+            block_weight = None if sample_weight is None else sample_weight[start:start + block_rows]
+            block = cls.from_labels(data[start:start + block_rows], labels[start:start + block_rows], n_clusters,
+                                    block_weight)
+            statistics = block if statistics is None else statistics.merge(block)
+        return statistics
+
+    def merge(self, other):
+        """
+        Combines these statistics with the statistics of other data points, using the pairwise update of
+        Chan, Golub and LeVeque, "Algorithms for computing the sample variance" (1983).
+
+        Parameters
+        ----------
+        other: ClusterStatistics with the same number of clusters
+
+        Returns
+        -------
+        ClusterStatistics of the data points of both
+        """
+        counts = self.counts + other.counts
+        means_a, means_b = np.nan_to_num(self.means), np.nan_to_num(other.means)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = (self.counts[:, np.newaxis] * means_a + other.counts[:, np.newaxis] * means_b) / \
+                counts[:, np.newaxis]
+            weights = np.where(counts > 0, self.counts * other.counts / counts, 0.)
+        offsets = means_b - means_a
+        scatters = self.scatters + other.scatters + weights[:, np.newaxis, np.newaxis] * \
+            np.einsum('kd,ke->kde', offsets, offsets)
+        return ClusterStatistics(counts, means, scatters)
+
+    def pooled(self):
+        """
+        Combines the statistics of all clusters into the statistics of the whole dataset.
+
+        Returns
+        -------
+        ClusterStatistics with a single cluster
+        """
+        nonempty = self.counts > 0
+        counts = self.counts[nonempty]
+        means = self.means[nonempty]
+        count = counts.sum()
+        mean = counts.dot(means) / count
+        offsets = means - mean
+        scatter = self.scatters.sum(axis=0) + np.einsum('k,kd,ke->de', counts, offsets, offsets)
+        return ClusterStatistics(np.array([count]), mean[np.newaxis], scatter[np.newaxis])
+
+
+def covariances_from_statistics(counts, scatters, covar_type, covar_tied, min_members):
+    """
+    Computes covariance matrices from per-cluster statistics.
+    Based on Kevin P. Murphy. "Fitting a Conditional Linear Gaussian Distribution" (2003).
+
+    Clusters with `min_members` or fewer data points get the identity matrix. Tied covariances are the sum of
+    the per-cluster covariances divided by the number of clusters. Leading batch dimensions are supported,
+    so statistics of several clusterings can be converted at once.
+
+    Parameters
+    ----------
+    counts: number of data points in each cluster. Shape: (..., n_clusters)
+    scatters: scatter matrix of each cluster. Shape: (..., n_clusters, dim, dim)
+    covar_type: str
+        "full", "diag" or "spher"
+    covar_tied: bool
+    min_members: int
+
+    Returns
+    -------
+    covariance matrices. Shape: (..., n_clusters, dim, dim)
+    """
+    counts = np.asarray(counts)
+    scatters = np.asarray(scatters, dtype=float)
+    n_clusters, n_features = scatters.shape[-3], scatters.shape[-1]
+    identity = np.eye(n_features)
+    valid = counts > min_members
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covars = scatters / counts[..., np.newaxis, np.newaxis]
+    covars = np.where(valid[..., np.newaxis, np.newaxis], covars, 0.)
+
+    if covar_type == 'full':
+        pass
+    elif covar_type == 'diag':
+        covars = covars * identity  # zero out non-diagonal elements
+    elif covar_type == 'spher':
+        variances = np.diagonal(covars, axis1=-2, axis2=-1)  # var of each feature
+        covars = variances.mean(axis=-1)[..., np.newaxis, np.newaxis] * identity
+    else:
+        raise ValueError('Covariance type "{}" not valid. Must be "full", "diag", "spher".'.format(covar_type))
+
+    if covar_tied:
+        covar = covars.sum(axis=-3, keepdims=True) / n_clusters
+        return np.repeat(covar, n_clusters, axis=-3)
+    return np.where(valid[..., np.newaxis, np.newaxis], covars, identity)
@@ -0,0 +1,133 @@
+"""
+Coreset variant of SF_KMeans for fast approximate fits of large datasets.
+
+A coreset is a small weighted sample of the data whose clustering cost approximates the cost of the full data
+for every set of cluster centers. All restarts and iterations run on the coreset, followed by one full-data
+pass that assigns every data point with the learned cluster centers and covariances and scores the model
+exactly like SF_KMeans.
+
+The coreset is a lightweight coreset: O. Bachem, M. Lucic and A. Krause, "Scalable k-Means Clustering via
+Lightweight Coresets" (2018). It is built with two passes over the data, independently of n_clusters.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import copy
+
+import numpy as np
+from sklearn.utils import check_random_state
+
+from .sf_kmeans import SF_KMeans
+
+
+def lightweight_coreset(data, size, random_state=None, sample_weight=None):
+    """
+    Samples a lightweight coreset. Each data point is drawn with probability
+    q(x) = 1/2 * w(x) / W + 1/2 * w(x) * d(x, mean)^2 / sum(w * d^2) and weighted by w(x) / (size * q(x)), so that
+    weighted sums over the coreset are unbiased estimates of weighted sums over the data.
+
+    Parameters
+    ----------
+    data: numpy array. Shape: (number of data points, dim)
+    size: number of data points to draw
+    random_state: int, RandomState instance or None
+    sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+
+    Returns
+    -------
+    coreset points, their weights, their indices in data. Shapes: (size, dim), (size), (size)
+    """
+    random_state = check_random_state(random_state)
+    weights = np.ones(data.shape[0]) if sample_weight is None else sample_weight
+    mean = weights.dot(data) / weights.sum()
+    squared_distances = np.nan_to_num(((data - mean) ** 2).sum(axis=1))  # to deal with nans in the input data
+    weighted_distances = weights * squared_distances
+    probabilities = 0.5 * weights / weights.sum()
+    if weighted_distances.sum() > 0:
+        probabilities += 0.5 * weighted_distances / weighted_distances.sum()
+    else:
+        probabilities *= 2  # all data points are identical
+    indices = np.sort(random_state.choice(data.shape[0], size, p=probabilities))
+    return data[indices], weights[indices] / (size * probabilities[indices]), indices
+
+
+class CoresetSF_KMeans(SF_KMeans):
+    """
+    SF_KMeans fit on a coreset of coreset_size data points, followed by a full-data assignment and scoring pass.
+    Data with at most coreset_size data points, or coreset_size=None, is fit exactly.
+
+    Attributes
+    ----------
+    coreset_: points and weights of the coreset used by the last fit, or None if it was exact
+    coreset_log_likelihood_: log likelihood of the best restart on the coreset
+    coreset_error_: relative difference between the log likelihood on the coreset and on the full data
+    """
+    def __init__(self, n_clusters=2, coreset_size=10000, **kwargs):
+        super(CoresetSF_KMeans, self).__init__(n_clusters=n_clusters, **kwargs)
+        self.coreset_size = coreset_size
+        self.coreset_ = None
+        self.coreset_log_likelihood_ = None
+        self.coreset_error_ = None
+
+    def fit(self, data, sample_weight=None):
+        """
+        Runs the n_init restarts of K-Means on a coreset of data and assigns every data point with the result.
+
+        Parameters
+        ----------
+        data: numpy array
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+        """
+        if self.coreset_size is None or len(data) <= self.coreset_size:
+            self.coreset_ = None
+            return super(CoresetSF_KMeans, self).fit(data, sample_weight)
+        data, sample_weight, inverse = self._prepare_weighted_data(data, sample_weight)
+        self.coreset_ = self._build_coreset(data, sample_weight)
+        super(CoresetSF_KMeans, self).fit(*self.coreset_)
+        self._coreset_final_pass(data, sample_weight)
+        if inverse is not None:
+            self._expand_labels(inverse)
+
+    def iter_path(self, data, ks, sample_weight=None):
+        """
+        Fits K-Means for every number of clusters in ks on one coreset of data, as `SF_KMeans.iter_path` does on
+        the data, and yields each model after a full-data assignment and scoring pass.
+        """
+        if self.coreset_size is None or len(data) <= self.coreset_size:
+            yield from super(CoresetSF_KMeans, self).iter_path(data, ks, sample_weight)
+            return
+        data, sample_weight, inverse = self._prepare_weighted_data(data, sample_weight)
+        coreset = self._build_coreset(data, sample_weight)
+        exact = self._clone(coreset_size=None, compress_duplicates=False)
+        for kmeans in super(CoresetSF_KMeans, exact).iter_path(coreset[0], ks, coreset[1]):
+            kmeans = copy.copy(kmeans)  # the path continues from the coreset fit
+            kmeans.coreset_size, kmeans.coreset_ = self.coreset_size, coreset
+            kmeans._coreset_final_pass(data, sample_weight)
+            if inverse is not None:
+                kmeans._expand_labels(inverse)
+            yield kmeans
+
+    def _build_coreset(self, data, sample_weight=None):
+        """ Returns the points and the weights of a lightweight coreset of data """
+        random_state = check_random_state(self.random_state)
+        points, weights, _ = lightweight_coreset(data, self.coreset_size, random_state, sample_weight)
+        if self.verbose >= 4:
+            print('Coreset of {} data points out of {}.'.format(points.shape[0], data.shape[0]))
+        return points, weights
+
+    def _coreset_final_pass(self, data, sample_weight=None):
+        """
+        Assigns every data point using the cluster centers and covariances learned on the coreset and scores the
+        model on the full data.
+        """
+        points, weights = self.coreset_
+        self.coreset_log_likelihood_ = self.best_log_likelihood_
+        coreset_distances = self.distances_computed_
+        statistics = self._cluster_statistics(points, self.labels_, weights)
+        self._global_covar_matrices = None  # replaced by the global covariance of all data points
+        self._final_assignment(data, statistics, sample_weight)
+        self._distance_counts = (coreset_distances + data.shape[0] * self.n_clusters, 0)
+        self.inertias_, self.log_likelihoods_ = [], []
+        self._set_results([self._restart_result(data, sample_weight)])
+        self.coreset_error_ = abs(self.coreset_log_likelihood_ - self.best_log_likelihood_) / \
+            abs(self.best_log_likelihood_)
@@ -0,0 +1,89 @@
+"""
+Batched distance computations used by SF_KMeans.
+
+All point-to-center distances for every cluster are computed in one vectorized pass from per-cluster
+whitening factors W (VI = W W^T), instead of calling cdist once per cluster. When all clusters share one
+covariance matrix, the data is whitened once and the distances are squared Euclidean distances in the whitened
+space, computed with a single matrix multiply.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import numpy as np
+
+# Number of float64 values in the whitened block of rows processed at once; sized to stay in cache
+BLOCK_SIZE = 2 ** 16
+
+
+def squared_mahalanobis(data, cluster_centers, factors, out=None, scratch=None):
+    """
+    Computes squared Mahalanobis distances of all data points from all cluster centers.
+
+    The data is projected through every cluster's whitening factor with a single matrix multiply per block of
+    rows, so the cost is one BLAS call plus an elementwise reduction per block, regardless of the number of
+    clusters. Blocks are kept small enough to stay in cache.
+
+    Parameters
+    ----------
+    data: numpy array of input data. Shape: (number of data points, dim)
+    cluster_centers: numpy array of cluster centers. Shape: (n_clusters, dim)
+    factors: numpy array of whitening factors, see `CovarianceFactors.whitening`. Shape: (n_clusters, dim, dim)
+    out: numpy array the squared distances are written to, allocated if None. Shape: (number of data points,
+        n_clusters)
+    scratch: float numpy array of at least max(BLOCK_SIZE, n_clusters * dim) elements that holds the projected
+        blocks, allocated if None
+
+    Returns
+    -------
+    numpy array of squared distances. Shape: (number of data points, n_clusters)
+    """
+    data = np.asarray(data, dtype=float)
+    cluster_centers = np.asarray(cluster_centers, dtype=float)
+    factors = np.asarray(factors, dtype=float)
+    n, d = data.shape
+    n_clusters = cluster_centers.shape[0]
+
+    # Column block k of factors_cat is W_k, so data.dot(factors_cat) whitens data for all clusters at once
+    factors_cat = factors.transpose(1, 0, 2).reshape(d, n_clusters * d)
+    centers_cat = np.einsum('kd,kde->ke', cluster_centers, factors).reshape(n_clusters * d)
+
+    distances = np.empty((n, n_clusters)) if out is None else out
+    block_rows = max(1, BLOCK_SIZE // (n_clusters * d))
+    if scratch is None:
+        scratch = np.empty(min(n, block_rows) * n_clusters * d)
+    for start in range(0, n, block_rows):
+        block = data[start:start + block_rows]
+        projected = scratch[:block.shape[0] * n_clusters * d].reshape(block.shape[0], n_clusters * d)
+        np.dot(block, factors_cat, out=projected)
+        projected -= centers_cat
+        projected = projected.reshape(-1, n_clusters, d)
+        np.einsum('nkd,nkd->nk', projected, projected, out=distances[start:start + block_rows])
+    return distances
+
+
+def squared_euclidean(data, cluster_centers, data_norms=None, out=None):
+    """
+    Computes squared Euclidean distances of all data points from all cluster centers as
+    ||x||^2 - 2 x.c + ||c||^2, so the only O(n * n_clusters * dim) work is a single matrix multiply.
+
+    Parameters
+    ----------
+    data: numpy array of input data. Shape: (number of data points, dim)
+    cluster_centers: numpy array of cluster centers. Shape: (n_clusters, dim)
+    data_norms: squared norm of each data point, computed if not provided. Shape: (number of data points)
+    out: numpy array the squared distances are written to, allocated if None. Shape: (number of data points,
+        n_clusters)
+
+    Returns
+    -------
+    numpy array of squared distances. Shape: (number of data points, n_clusters)
+    """
+    data = np.asarray(data, dtype=float)
+    cluster_centers = np.asarray(cluster_centers, dtype=float)
+    if data_norms is None:
+        data_norms = np.einsum('nd,nd->n', data, data)
+    distances = np.dot(data, -2 * cluster_centers.T, out=out)
+    distances += data_norms[:, np.newaxis]
+    distances += np.einsum('kd,kd->k', cluster_centers, cluster_centers)
+    np.maximum(distances, 0, out=distances)  # rounding can make distances of points at a center negative
+    return distances
@@ -0,0 +1,123 @@
+"""
+Covariance matrix factorization shared by SF_KMeans.
+
+Each distinct covariance matrix is factorized once per iteration and the inverse, log-determinant and
+whitening transform are all derived from that one factorization.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import numpy as np
+from numpy.linalg import LinAlgError
+
+
+class CovarianceFactors(object):
+    """
+    Factorization of a stack of covariance matrices.
+
+    Positive definite matrices are factorized with Cholesky, C = L L^T. Matrices that are not (numerically)
+    positive definite fall back to a symmetric eigendecomposition and use Hadi's technique for the inverse.
+
+    Attributes
+    ----------
+    matrices: the covariance matrices that were factorized. Shape: (n_clusters, dim, dim)
+    whitening: whitening factors W such that inverse(C) = W W^T. Shape: (n_clusters, dim, dim)
+    log_det: log of the absolute value of the determinant of each matrix. Shape: (n_clusters)
+    sign: sign of the determinant of each matrix (-1, 0 or 1). Shape: (n_clusters)
+    shared: True if all matrices are identical
+    """
+    def __init__(self, matrices, shared=False):
+        """
+        Parameters
+        ----------
+        matrices: list or numpy array of covariance matrices. Shape: (n_clusters, dim, dim)
+        shared: bool
+            If True, all matrices are known to be identical and only the first one is factorized.
+        """
+        self.matrices = matrices
+        self.shared = shared
+        matrices = np.asarray(matrices, dtype=float)
+        n_matrices = matrices.shape[0]
+        if shared:
+            whitening, log_det, sign = self._factorize(matrices[:1])
+            whitening = np.repeat(whitening, n_matrices, axis=0)
+            log_det = np.repeat(log_det, n_matrices)
+            sign = np.repeat(sign, n_matrices)
+        else:
+            whitening, log_det, sign = self._factorize(matrices)
+        self.whitening = whitening
+        self.log_det = log_det
+        self.sign = sign
+        self._inverse = None
+
+    @property
+    def inverse(self):
+        """ Inverse of each covariance matrix. Shape: (n_clusters, dim, dim) """
+        if self._inverse is None:
+            self._inverse = np.matmul(self.whitening, self.whitening.transpose(0, 2, 1))
+        return self._inverse
+
+    def set_identity(self, idx):
+        """ Replaces the factorization of matrix `idx` with that of the identity matrix. """
+        self.whitening[idx] = np.eye(self.whitening.shape[1])
+        self.log_det[idx] = 0.
+        self.sign[idx] = 1.
+        self._inverse = None
+
+    @classmethod
+    def _factorize(cls, matrices):
+        """
+        Factorizes a stack of matrices.
+
+        Returns
+        -------
+        whitening, log_det, sign
+        """
+        try:
+            return cls._factorize_cholesky(matrices)
+        except LinAlgError:
+            pass
+        n_matrices, n_features = matrices.shape[:2]
+        whitening = np.empty((n_matrices, n_features, n_features))
+        log_det = np.empty(n_matrices)
+        sign = np.empty(n_matrices)
+        for k, matrix in enumerate(matrices):
+            try:
+                result = cls._factorize_cholesky(matrix[np.newaxis])
+            except LinAlgError:
+                result = cls._factorize_eigh(matrix)
+            whitening[k], log_det[k], sign[k] = [r[0] for r in result]
+        return whitening, log_det, sign
+
+    @staticmethod
+    def _factorize_cholesky(matrices):
+        """ Factorizes a stack of positive definite matrices using Cholesky. Raises LinAlgError otherwise. """
+        chol = np.linalg.cholesky(matrices)
+        diagonals = np.diagonal(chol, axis1=1, axis2=2)
+        if not np.all(diagonals > 0):
+            raise LinAlgError('Matrix is not positive definite')
+        # inverse(C) = L^-T L^-1, so W = L^-T
+        whitening = np.linalg.inv(chol).transpose(0, 2, 1)
+        log_det = 2 * np.log(diagonals).sum(axis=1)
+        sign = np.ones(matrices.shape[0])
+        return whitening, log_det, sign
+
+    @staticmethod
+    def _factorize_eigh(matrix):
+        """
+        Factorizes a single symmetric matrix that is not positive definite, using Hadi's technique for the inverse.
+        Reference: Ali S. Hadi (1992) "Identifying Multiple Outliers in Multivariate Data" eg. 2.3, 2.4
+        """
+        eigenValues, eigenVectors = np.linalg.eigh(matrix)
+        if np.any(eigenValues == 0):
+            sign = 0.
+        else:
+            sign = np.prod(np.sign(eigenValues))
+        eigenValues = np.abs(eigenValues)  # to deal with -0 values
+        with np.errstate(divide='ignore'):
+            log_det = np.log(eigenValues).sum()
+        nonzero = eigenValues[eigenValues != 0]
+        s = nonzero.min() if nonzero.shape[0] > 0 else 1.
+        w = 1 / np.maximum(eigenValues, s)
+        whitening = eigenVectors * np.sqrt(w)
+        return whitening[np.newaxis], np.array([log_det]), np.array([sign])
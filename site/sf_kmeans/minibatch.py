@@ -0,0 +1,158 @@
+"""
+Mini-batch variant of SF_KMeans for large datasets.
+
+Each step assigns one small random batch of data points and merges its per-cluster statistics into running
+statistics, so the cluster centers and covariance matrices move with per-cluster learning rates of
+(batch members) / (all members seen so far), which decay as clusters accumulate data points. Based on
+D. Sculley, "Web-scale k-means clustering" (2010), extended to the sufficient statistics of the covariances.
+
+A final full pass assigns every data point with the learned centers and covariances, and the model is scored
+on it exactly like SF_KMeans.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import numpy as np
+from sklearn.utils import check_random_state
+from sklearn.utils.extmath import squared_norm
+
+from .sf_kmeans import SF_KMeans
+from .cluster_statistics import ClusterStatistics
+from .distances import squared_euclidean
+from .weights import check_sample_weight
+
+
+class MiniBatchSF_KMeans(SF_KMeans):
+    """
+    SF_KMeans fit with mini-batches. max_iter is the maximum number of mini-batches of each restart. Restarts
+    always run with the loop engine.
+    """
+    def __init__(self, n_clusters=2, batch_size=1024, max_iter=100, **kwargs):
+        kwargs['engine'] = 'loop'
+        super(MiniBatchSF_KMeans, self).__init__(n_clusters=n_clusters, max_iter=max_iter, **kwargs)
+        self.batch_size = batch_size
+        self._batch_statistics = None  # running ClusterStatistics of all batches seen so far
+        self._batch_distances_computed = 0
+
+    def partial_fit(self, batch, random_state=None, sample_weight=None):
+        """
+        Updates the cluster centers and covariance statistics with one batch of data points.
+        The first batch seeds the cluster centers with the init strategy unless they are already set.
+
+        Parameters
+        ----------
+        batch: numpy array
+        random_state: int, RandomState instance or None
+            Used to seed the initial cluster centers.
+        sample_weight: weight of each data point of the batch, or None for unit weights
+
+        Returns
+        -------
+        self
+        """
+        batch = np.asarray(batch, dtype=float)
+        sample_weight = check_sample_weight(sample_weight, batch.shape[0])
+        self._set_min_members(batch)
+        if self._batch_statistics is None:
+            if self.cluster_centers_ is None:
+                self.cluster_centers_ = self._init_centers(batch, random_state, sample_weight)
+            distances = squared_euclidean(batch, self.cluster_centers_)
+        else:
+            # The global covariance is estimated from the first batch, unless fit computed it from all data
+            covar_matrices = self.covariances(None, cluster_centers=self.cluster_centers_, data=batch,
+                                              statistics=self._batch_statistics)
+            self._factorize(covar_matrices)
+            distances = self._squared_distances(batch)
+        distances[np.isnan(distances)] = float('inf')  # to deal with nans in the input data
+        self._batch_distances_computed += distances.size
+
+        labels = np.argmin(distances, axis=1)
+        statistics = ClusterStatistics.from_labels(batch, labels, self.n_clusters, sample_weight)
+        if self._batch_statistics is None:
+            # Every cluster needs members from the first batch; later batches only add members
+            labels = self._reassign_empty_clusters(labels, distances)
+            statistics = ClusterStatistics.from_labels(batch, labels, self.n_clusters, sample_weight)
+            self._batch_statistics = statistics
+        else:
+            self._batch_statistics = self._batch_statistics.merge(statistics)
+        self.labels_ = labels
+        self.cluster_centers_ = self._batch_statistics.means.copy()
+        return self
+
+    def final_pass(self, data, sample_weight=None):
+        """
+        Assigns every data point using the learned cluster centers and covariances, recomputes the cluster
+        centers from the assignment and scores the model, so that `score`, `aic` and `bic` can be used.
+
+        Parameters
+        ----------
+        data: numpy array
+        sample_weight: weight of each data point, or None for unit weights
+        """
+        data = np.asarray(data, dtype=float)
+        sample_weight = check_sample_weight(sample_weight, data.shape[0])
+        self._global_covar_matrices = None  # replaced by the global covariance of all data points
+        self._assign_all(data, sample_weight)
+        self._distance_counts = (self._batch_distances_computed + data.shape[0] * self.n_clusters, 0)
+        self._set_results([self._restart_result(data, sample_weight)])
+
+    def _fit(self, data, random_state=None, statistics=None, sample_weight=None):
+        """
+        Runs mini-batch K-Means on data once, followed by a full assignment pass.
+
+        Parameters
+        ----------
+        data: numpy array
+        random_state: int, RandomState instance or None
+            Used to seed the initial cluster centers and to draw the mini-batches.
+        statistics: not used; mini-batch statistics are always computed from the batches
+        sample_weight: weight of each data point, or None for unit weights
+            Data points are drawn into the mini-batches with probability proportional to their weight.
+
+        Returns
+        -------
+        No value is returned.
+        Function sets the following two object params:
+            self.labels_
+            self.cluster_centers_
+        """
+        data = np.asarray(data)
+        random_state = check_random_state(random_state)
+        self._set_min_members(data)
+        self._batch_statistics = None
+        self._batch_distances_computed = 0
+        self.iteration_num = self.max_iter
+        self.stop_reason = 'max_iter'
+        tol = None if self.scale_tol else self.tol
+        batch_size = min(self.batch_size, data.shape[0])
+        probabilities = None if sample_weight is None else sample_weight / sample_weight.sum()
+
+        for i in range(self.max_iter):
+            if self.verbose == 2:
+                print('\rbatch: {}/{}'.format(i + 1, self.max_iter))
+            old_cluster_centers_ = self.cluster_centers_
+            if probabilities is None:
+                batch = data[random_state.randint(0, data.shape[0], batch_size)]
+            else:
+                batch = data[random_state.choice(data.shape[0], batch_size, p=probabilities)]
+            self.partial_fit(batch, random_state=random_state)
+            if tol is None:
+                tol = self.tol * self._tol_scale(self._batch_statistics)  # the first batch gives the scale of the data
+            if old_cluster_centers_ is None:
+                continue
+            center_shift_total = squared_norm(old_cluster_centers_ - self.cluster_centers_)
+            if self.verbose == 2:
+                print('center_shift_total: {:0.6f}'.format(center_shift_total))
+            if center_shift_total <= tol:
+                self.iteration_num = (i + 1)
+                self.stop_reason = 'center_shift'
+                if self.verbose >= 4:
+                    print('Converged after {} batches.'.format(i + 1))
+                break
+
+        self._assign_all(data, sample_weight)
+        self._distance_counts = (self._batch_distances_computed + data.shape[0] * self.n_clusters, 0)
+
+    def _assign_all(self, data, sample_weight=None):
+        """ Assigns every data point with the current covariances and recomputes the cluster centers """
+        self._final_assignment(data, self._batch_statistics, sample_weight)
@@ -0,0 +1,123 @@
+"""
+Fitting several covariance configurations of SF_KMeans at the same number of clusters together.
+
+The seeding, the initial Euclidean assignment and the per-cluster statistics of that assignment do not depend on
+the covariance type, so they are computed once for each restart and shared by all configurations. Each
+configuration then runs its own iterations from the shared starting point and keeps its own best restart.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sklearn.utils import check_random_state
+
+from .sf_kmeans import SF_KMeans
+from .stacked import StackedRestarts
+from .coreset import CoresetSF_KMeans
+from .workspace import ThreadWorkspaces
+
+
+class MultiConfigKMeans(object):
+    """
+    Fits one SF_KMeans model for each covariance configuration with shared restarts.
+
+    With the same random_state, each fitted model is identical to fitting SF_KMeans with that configuration on
+    its own, because every configuration starts its restarts from the same seeds.
+    """
+    def __init__(self, n_clusters=2, covars=(('full', False),), n_init=10, n_jobs=1, random_state=None,
+                 engine='loop', kmeans_class=SF_KMeans, **kwargs):
+        """
+        Parameters
+        ----------
+        n_clusters: int
+        covars: list of (covar_type, covar_tied)
+        n_init: int
+        n_jobs: int
+            num. of threads used to run the restarts concurrently; -1 uses all CPUs
+        random_state: int, RandomState instance or None
+        engine: str
+            "loop" or "stacked", see SF_KMeans
+        kmeans_class: SF_KMeans or a subclass such as MiniBatchSF_KMeans or CoresetSF_KMeans
+        kwargs: other parameters of kmeans_class, used by all configurations
+        """
+        self.n_clusters = n_clusters
+        self.covars = [(covar_type, bool(covar_tied)) for covar_type, covar_tied in covars]
+        self.n_init = n_init
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.engine = engine
+        self.kmeans_class = kmeans_class
+        self.kwargs = kwargs
+        self.models_ = None  # fitted SF_KMeans object of each configuration, in the order of covars
+
+    def fit(self, data, sample_weight=None):
+        """
+        Fits all configurations on data.
+
+        Parameters
+        ----------
+        data: numpy array, or any data accepted by kmeans_class
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+
+        Returns
+        -------
+        list of fitted SF_KMeans objects, one for each configuration in the order of covars
+        """
+        models = [self.kmeans_class(n_clusters=self.n_clusters, covar_type=covar_type, covar_tied=covar_tied,
+                                    n_init=self.n_init, n_jobs=self.n_jobs, engine=self.engine, **self.kwargs)
+                  for covar_type, covar_tied in self.covars]
+        data, sample_weight, inverse = models[0]._prepare_weighted_data(data, sample_weight)
+        full_data = None
+        if isinstance(models[0], CoresetSF_KMeans) and models[0].coreset_size is not None and \
+                data.shape[0] > models[0].coreset_size:
+            # All configurations run on one coreset, followed by a full-data pass for each
+            full_data = (data, sample_weight)
+            data, sample_weight = models[0]._build_coreset(data, sample_weight)
+            for kmeans in models:
+                kmeans.coreset_ = (data, sample_weight)
+        for kmeans in models:
+            kmeans._set_min_members(data)
+        global_models = [kmeans for kmeans in models if kmeans.covar_type == 'global']
+        if global_models:
+            # The global covariance does not depend on labels, so it is computed once for all configurations
+            global_covar_matrices = global_models[0]._global_covariance(data, sample_weight)
+            for kmeans in global_models:
+                kmeans._global_covar_matrices = global_covar_matrices
+
+        random_state = check_random_state(self.random_state)
+        seeds = random_state.randint(np.iinfo(np.int32).max, size=self.n_init)
+        if models[0].engine == 'stacked':
+            stacked = StackedRestarts(models[0], data, sample_weight)
+            start = stacked.initial_assignment(seeds)
+            results = [stacked.for_model(kmeans).fit(seeds, start=start) for kmeans in models]
+        else:
+            workspaces = ThreadWorkspaces()  # configurations run one after the other in a thread and share buffers
+            for kmeans in models:
+                kmeans._race = kmeans._new_race()  # each configuration races its own restarts
+                kmeans._workspaces = workspaces
+
+            def fit_seed(seed):
+                start = models[0]._initial_assignment(data, seed, sample_weight)
+                return [kmeans._fit_restart(data, seed, start=start, sample_weight=sample_weight) for kmeans in models]
+
+            n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+            if n_jobs == 1:
+                seed_results = [fit_seed(seed) for seed in seeds]
+            else:
+                with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                    seed_results = list(executor.map(fit_seed, seeds))
+            results = [list(config_results) for config_results in zip(*seed_results)]
+
+        for kmeans, config_results in zip(models, results):
+            kmeans._race = None
+            kmeans._workspaces = None
+            kmeans._set_results(config_results)
+            if full_data is not None:
+                kmeans._coreset_final_pass(*full_data)
+            if inverse is not None:
+                kmeans._expand_labels(inverse)
+        self.models_ = models
+        return models
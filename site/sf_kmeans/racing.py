@@ -0,0 +1,39 @@
+"""
+Racing of the n_init restarts of SF_KMeans.
+
+The restarts only matter through the best of them, so a restart whose objective is still far worse than the best
+one after a few iterations is abandoned instead of run to convergence. Restarts are compared by the inertia of
+their assignment steps: the (weighted) sum of the distances of the data points from the cluster centers they
+were assigned to. A restart is abandoned once its inertia exceeds the best inertia by more than a relative
+margin.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import threading
+
+
+class RestartRace(object):
+    """
+    Best inertia among the finished restarts of one fit, shared by restarts that may run in concurrent threads.
+
+    Attributes
+    ----------
+    margin: relative margin by which a restart may be worse than the best one
+    min_iter: number of iterations every restart runs before it can be abandoned
+    best_inertia: best inertia of a finished restart so far
+    """
+    def __init__(self, margin, min_iter):
+        self.margin = margin
+        self.min_iter = min_iter
+        self.best_inertia = float('inf')
+        self._lock = threading.Lock()
+
+    def hopeless(self, iteration_num, inertia):
+        """ True if a restart with this inertia after iteration_num iterations should be abandoned """
+        return iteration_num >= self.min_iter and inertia > (1 + self.margin) * self.best_inertia
+
+    def finish(self, inertia):
+        """ Records the inertia of the last assignment step of a restart that ran to the end """
+        with self._lock:
+            self.best_inertia = min(self.best_inertia, inertia)
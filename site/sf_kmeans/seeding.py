@@ -0,0 +1,168 @@
+"""
+Seeding of the initial cluster centers.
+
+All seeding strategies keep the squared distance of each data point from its closest center picked so far and
+update it with the distances from the newly picked centers only, so each new center costs O(number of data
+points * dim) instead of recomputing the distances from all centers picked so far.
+
+k-means++: D. Arthur and S. Vassilvitskii, "k-means++: The Advantages of Careful Seeding" (2007), with the greedy
+local trials of scikit-learn; the same random_state picks the same centers as sklearn.cluster.kmeans_plusplus.
+k-means||: B. Bahmani, B. Moseley, A. Vattani, R. Kumar and S. Vassilvitskii, "Scalable K-Means++" (2012). It
+oversamples candidates in a few passes over the data and runs k-means++ on the weighted candidates, so the number
+of passes does not grow with n_clusters.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import numpy as np
+from sklearn.utils import check_random_state
+
+from .distances import squared_euclidean, BLOCK_SIZE
+
+
+def kmeans_plusplus(data, n_clusters, random_state=None, sample_weight=None, n_local_trials=None,
+                    data_norms=None):
+    """
+    Picks initial cluster centers with k-means++. Each center is the best of n_local_trials candidates drawn
+    with probability proportional to the weighted squared distance from the closest center picked so far.
+
+    Parameters
+    ----------
+    data: numpy array. Shape: (number of data points, dim)
+    n_clusters: int
+    random_state: int, RandomState instance or None
+    sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+    n_local_trials: number of candidates for each center after the first; default: 2 + log(n_clusters)
+    data_norms: squared norm of each data point, computed if not provided. Shape: (number of data points)
+
+    Returns
+    -------
+    cluster centers, their indices in data. Shapes: (n_clusters, dim), (n_clusters)
+    """
+    random_state = check_random_state(random_state)
+    data = np.asarray(data, dtype=float)
+    n = data.shape[0]
+    weights = np.ones(n) if sample_weight is None else sample_weight
+    if n_local_trials is None:
+        n_local_trials = 2 + int(np.log(n_clusters))
+    if data_norms is None:
+        data_norms = np.einsum('nd,nd->n', data, data)
+
+    indices = np.empty(n_clusters, dtype=int)
+    indices[0] = random_state.choice(n, p=weights / weights.sum())
+    closest = squared_euclidean(data, data[indices[:1]], data_norms)[:, 0]
+    potential = weights.dot(closest)
+    for c in range(1, n_clusters):
+        rand_vals = random_state.uniform(size=n_local_trials) * potential
+        candidates = np.searchsorted(np.cumsum(weights * closest), rand_vals)
+        np.clip(candidates, None, n - 1, out=candidates)  # rounding can put a candidate past the end
+        # Closest squared distance of each data point if each candidate were added. Shape: (n_local_trials, n)
+        candidate_closest = np.minimum(closest, squared_euclidean(data, data[candidates], data_norms).T)
+        candidate_potentials = candidate_closest.dot(weights)
+        best = np.argmin(candidate_potentials)
+        potential = candidate_potentials[best]
+        closest = candidate_closest[best]
+        indices[c] = candidates[best]
+    return data[indices], indices
+
+
+def kmeans_parallel(data, n_clusters, random_state=None, sample_weight=None, oversampling=None, n_rounds=5):
+    """
+    Picks initial cluster centers with k-means||. Each round samples every data point independently with
+    probability oversampling * weighted squared distance from the closest candidate / total weighted squared
+    distance. The candidates are weighted by the total weight of the data points closest to them and reduced to
+    n_clusters centers with k-means++.
+
+    Parameters
+    ----------
+    data: numpy array. Shape: (number of data points, dim)
+    n_clusters: int
+    random_state: int, RandomState instance or None
+    sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+    oversampling: expected number of candidates drawn in each round; default: 2 * n_clusters
+    n_rounds: number of sampling rounds
+
+    Returns
+    -------
+    cluster centers, their indices in data. Shapes: (n_clusters, dim), (n_clusters)
+    """
+    random_state = check_random_state(random_state)
+    data = np.asarray(data, dtype=float)
+    n = data.shape[0]
+    weights = np.ones(n) if sample_weight is None else sample_weight
+    if oversampling is None:
+        oversampling = 2 * n_clusters
+    data_norms = np.einsum('nd,nd->n', data, data)
+
+    candidates = [random_state.choice(n, size=1, p=weights / weights.sum())]
+    closest, _ = _closest(data, data_norms, candidates[0])
+    for _ in range(n_rounds):
+        potential = weights.dot(closest)
+        if potential == 0:  # every data point is a candidate already
+            break
+        probabilities = np.minimum(1, oversampling * weights * closest / potential)
+        new_candidates = np.flatnonzero(random_state.uniform(size=n) < probabilities)
+        if new_candidates.size:
+            candidates.append(new_candidates)
+            np.minimum(closest, _closest(data, data_norms, new_candidates)[0], out=closest)
+
+    candidates = np.unique(np.concatenate(candidates))
+    if candidates.size <= n_clusters:
+        return kmeans_plusplus(data, n_clusters, random_state, sample_weight, data_norms=data_norms)
+    _, labels = _closest(data, data_norms, candidates)
+    candidate_weights = np.bincount(labels, weights=weights, minlength=candidates.size)
+    _, indices = kmeans_plusplus(data[candidates], n_clusters, random_state, candidate_weights,
+                                 data_norms=data_norms[candidates])
+    return data[candidates[indices]], candidates[indices]
+
+
+def farthest_traversal(data, n_clusters, random_state=None):
+    """
+    Picks initial cluster centers with Farthest Traversal: the first center is a random data point and each
+    following center is the data point with the largest sum of distances from the centers picked so far.
+
+    Parameters
+    ----------
+    data: numpy array. Shape: (number of data points, dim)
+    n_clusters: int
+    random_state: int, RandomState instance or None
+
+    Returns
+    -------
+    cluster centers, their indices in data. Shapes: (n_clusters, dim), (n_clusters)
+    """
+    random_state = check_random_state(random_state)
+    data = np.asarray(data, dtype=float)
+    data_norms = np.einsum('nd,nd->n', data, data)
+    indices = np.empty(n_clusters, dtype=int)
+    indices[0] = random_state.randint(low=0, high=data.shape[0], size=1)[0]
+    total_distances = np.zeros(data.shape[0])
+    for c in range(1, n_clusters):
+        total_distances += np.sqrt(squared_euclidean(data, data[indices[c - 1:c]], data_norms)[:, 0])
+        indices[c] = np.argmax(total_distances)
+    return data[indices], indices
+
+
+def _closest(data, data_norms, candidates):
+    """
+    Finds the closest of the candidate data points to each data point, one block of rows at a time.
+
+    Returns
+    -------
+    squared distance from the closest candidate, position of the closest candidate in candidates.
+        Shape of each: (number of data points)
+    """
+    n = data.shape[0]
+    centers = data[candidates]
+    center_norms = data_norms[candidates]
+    closest = np.empty(n)
+    labels = np.empty(n, dtype=int)
+    block_rows = max(1, BLOCK_SIZE // candidates.size)
+    for start in range(0, n, block_rows):
+        rows = slice(start, start + block_rows)
+        distances = data[rows].dot(-2 * centers.T)
+        distances += data_norms[rows, np.newaxis]
+        distances += center_norms
+        labels[rows] = np.argmin(distances, axis=1)
+        closest[rows] = np.maximum(distances[np.arange(distances.shape[0]), labels[rows]], 0)
+    return closest, labels
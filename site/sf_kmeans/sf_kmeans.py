@@ -6,17 +6,34 @@ The algorithm is structured to maximize the likelihood of a model that uses a mu
 Authors: Nevena Golubovic, Angad Gill
 """
 
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from numpy.linalg import LinAlgError
 from scipy.spatial.distance import cdist
+from sklearn.utils import check_random_state
 from sklearn.utils.extmath import squared_norm
-from sklearn.cluster import k_means_
+
+from .distances import squared_mahalanobis, squared_euclidean, BLOCK_SIZE
+from .factorization import CovarianceFactors
+from .cluster_statistics import ClusterStatistics, covariances_from_statistics
+from .stacked import StackedRestarts
+from .bounds import BoundedAssignment, ELKAN_MIN_CLUSTERS
+from .weights import check_sample_weight, collapse_duplicates, MIN_DUPLICATES
+from .seeding import kmeans_plusplus, kmeans_parallel, farthest_traversal
+from .racing import RestartRace
+from .workspace import Workspace, ThreadWorkspaces
 
 
 class SF_KMeans(object):
     def __init__(self, n_clusters=2, max_iter=300, tol=0.0001, verbose=0, n_init=10,
                  metric='mahalanobis', use_rss=False, covar_type='full', covar_tied=False,
-                 min_members='auto', warm_start=False, **kwargs):
+                 min_members='auto', warm_start=False, n_jobs=1, random_state=None, engine='loop',
+                 assignment='full', memory_budget=None, compress_duplicates=False, init='k-means++',
+                 euclidean_tol=None, scale_tol=False, reassign_tol=None, ll_tol=None,
+                 race_margin=None, race_min_iter=5, **kwargs):
         self.n_clusters = n_clusters
         self.max_iter = max_iter
         self.tol = tol
@@ -30,25 +47,92 @@ class SF_KMeans(object):
         self.cluster_centers_ = None
         self._inv_covar_matrices = None  # shape: (n_clusters, dim, dim)
         self._global_covar_matrices = None # shape: (n_clusters, dim, dim)
+        self._covar_factors = None  # CovarianceFactors of the most recently computed covariance matrices
+        self._whitened_data = None  # data, CovarianceFactors, whitened data and its squared norms; see _whiten
         if covar_type not in ['full', 'diag', 'spher', 'global']:
             raise ValueError('Covariance type "{}" not valid. Must be "full", "diag", "spher", "global".'.format(covar_type))
         self.covar_type = covar_type
         self.covar_tied = covar_tied  # Only used with full, diag, spher covar_types
         self.warm_start = warm_start  # If True, cluster centers are not re-initialized each time fit is called
         self.min_members = min_members
+        self.n_jobs = n_jobs  # num. of threads used to run the n_init restarts concurrently; -1 uses all CPUs
+        self.random_state = random_state  # seeds the restarts; each restart gets its own seed drawn from it
+        if engine not in ['loop', 'stacked']:
+            raise ValueError('Engine "{}" not valid. Must be "loop" or "stacked".'.format(engine))
+        # "stacked" runs all restarts in lockstep as stacked arrays; it is faster on small datasets
+        self.engine = engine
+        if assignment not in ['full', 'bounds', 'hamerly', 'elkan']:
+            raise ValueError('Assignment "{}" not valid. Must be "full", "bounds", "hamerly" or "elkan".'.format(
+                assignment))
+        # Anything but "full" skips distances using triangle inequality bounds when distances are Euclidean in a
+        # space that is fixed for the whole fit, i.e. with the euclidean metric or a global covariance; "bounds" picks
+        # Hamerly or Elkan based on n_clusters. A tied covariance changes every iteration, which would reset the
+        # bounds every iteration, so it always uses "full". Only used by the loop engine.
+        self.assignment = assignment
+        # Bytes of temporary memory the loop engine may use for distances. If set and the data does not fit, distances
+        # are computed and reduced one block of rows at a time instead of as a (number of data points, n_clusters)
+        # matrix, and bounds are not used.
+        self.memory_budget = memory_budget
+        if compress_duplicates and warm_start:
+            raise ValueError('compress_duplicates cannot be used with warm_start.')
+        # If True, fit collapses identical rows into unique rows weighted by their number of copies and expands the
+        # labels back to the original rows at the end. Rows are only collapsed if at least MIN_DUPLICATES of them
+        # are duplicates. Results are not identical to a fit on the original rows: an empty cluster takes a whole
+        # unique row with all its copies, where it would take a single copy of it.
+        self.compress_duplicates = compress_duplicates
+        if init not in ['k-means++', 'k-means||', 'farthest']:
+            raise ValueError('Init "{}" not valid. Must be "k-means++", "k-means||" or "farthest".'.format(init))
+        # Seeding of the initial cluster centers, see seeding.py; "k-means||" needs fewer passes over large datasets
+        self.init = init
+        # If set, every restart first runs Euclidean iterations, which need no covariance matrices, until the center
+        # shift drops to euclidean_tol, and then the covariance-aware iterations until it drops to tol. Both phases
+        # share the max_iter budget. Used by the loop and stacked engines.
+        self.euclidean_tol = euclidean_tol
+        # Stopping rules. A restart stops as soon as one holds and records it in stop_reason: "labels" if no data
+        # point changed cluster, "center_shift" if the center shift is at most tol, "reassigned" if at most a
+        # fraction reassign_tol of the (weighted) data points changed cluster, "log_likelihood" if the log likelihood
+        # of the assignment improved by at most a fraction ll_tol, and "max_iter" if none held. If scale_tol is
+        # True, tol and euclidean_tol are multiplied by the mean variance of the features, like sklearn's KMeans,
+        # so they do not depend on the scale of the data.
+        self.scale_tol = scale_tol
+        self.reassign_tol = reassign_tol
+        self.ll_tol = ll_tol
+        # If race_margin is set, restarts race (see racing.py): after race_min_iter iterations, a restart is abandoned
+        # once the inertia of its assignment step is more than a fraction race_margin above the best one, which is
+        # the best finished restart with the loop engine and the best restart at the same iteration with the
+        # stacked engine. Not used with warm_start.
+        self.race_margin = race_margin
+        self.race_min_iter = race_min_iter
         self.all_labels_ = []
         self.best_inertia_ = None
         self.inertias_ = []
         self.log_likelihoods_ = []
         self.iteration_num = self.max_iter
-
-    def fit(self, data):
+        self.iteration_nums_ = []
+        self.euclidean_iteration_num = 0  # iterations of iteration_num that ran in the Euclidean phase
+        self.euclidean_iteration_nums_ = []
+        self.stop_reason = None  # stopping rule that ended the best restart, see scale_tol
+        self.stop_reasons_ = []
+        self.pruned_restarts_ = 0  # restarts of the last fit abandoned by racing; they are not in the other results
+        self.pruned_iteration_nums_ = []  # iterations each abandoned restart ran before it was abandoned
+        self._race = None  # RestartRace shared by the restarts of the running fit
+        self._pruned = False  # True if the last call to _fit abandoned its restart
+        self._workspaces = None  # ThreadWorkspaces with the scratch buffers of the running fit
+        self.restart_statistics_ = []  # covariances, log dets and per-cluster distance sums of each restart
+        self.distances_ = None  # distance of each data point from its assigned cluster center in the best restart
+        self.distances_computed_ = 0  # point to center distances computed in the assignment steps of the last fit
+        self.distances_skipped_ = 0  # point to center distances skipped thanks to bounds in the last fit
+        self._distance_counts = (0, 0)  # distances computed and skipped by the last call to _fit
+        self._n_samples = None  # number of data points, or their total weight, in the last fit
+
+    def fit(self, data, sample_weight=None):
         """
         Run K-Means on data n_init times.
 
         Parameters
         ----------
         data: numpy array
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
 
         Returns
         -------
@@ -57,35 +141,386 @@ class SF_KMeans(object):
             self.labels_
             self.cluster_centers_
         """
-        data = np.array(data)
-        labels, cluster_centers = [], []
-        for i in range(self.n_init):
-            if not self.warm_start:
-                self.cluster_centers_ = None
-                self._global_covar_matrices = None
-                self._inv_covar_matrices = None
-            self._fit(data)
-            labels += [self.labels_]
-            cluster_centers += [self.cluster_centers_]
-            self.inertias_ += [self._inertia(data)]
-            self.log_likelihoods_ += [self.log_likelihood(data)]
-        best_idx = np.argmin(self.inertias_)
-        self.labels_ = labels[best_idx]
-        self.all_labels_ = labels
-        self.best_log_likelihood_ = self.log_likelihoods_[best_idx]
-        self.best_inertia_ = self.inertias_[best_idx]
-        self.cluster_centers_ = cluster_centers[best_idx]
+        data, sample_weight, inverse = self._prepare_weighted_data(data, sample_weight)
+        self._set_min_members(data)
+        random_state = check_random_state(self.random_state)
+        seeds = random_state.randint(np.iinfo(np.int32).max, size=self.n_init)
+        if not self.warm_start:
+            self.cluster_centers_ = None
+            self._global_covar_matrices = None
+            self._inv_covar_matrices = None
+            self._covar_factors = None
+            self._whitened_data = None
+            if self.covar_type == 'global':
+                # The global covariance does not depend on labels, so it is computed once and shared by all restarts
+                self._global_covariance(data, sample_weight)
+
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        self._race = self._new_race()
+        self._workspaces = ThreadWorkspaces()
+        if self.engine == 'stacked' and not self.warm_start:
+            results = StackedRestarts(self, data, sample_weight).fit(seeds)
+        elif self.warm_start or n_jobs == 1:
+            # Restarts with warm_start continue from each other, so they run one after the other on this object
+            results = [self._fit_restart(data, seed, clone=not self.warm_start, sample_weight=sample_weight)
+                       for seed in seeds]
+        else:
+            # Threads share data without copying it. NumPy releases the GIL inside its heavy operations.
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(lambda seed: self._fit_restart(data, seed, sample_weight=sample_weight),
+                                            seeds))
+        self._race = None
+        self._workspaces = None  # frees the scratch buffers
+        self._set_results(results)
+        if inverse is not None:
+            self._expand_labels(inverse)
+
+    def _new_race(self):
+        """ Returns a RestartRace for the restarts of a fit, or None if restarts do not race """
+        if self.race_margin is None or self.warm_start:
+            return None
+        return RestartRace(self.race_margin, self.race_min_iter)
+
+    def _workspace(self):
+        """ Workspace of this thread in the running fit, or a new one outside fit """
+        if self._workspaces is None:
+            return Workspace()
+        return self._workspaces.workspace
+
+    def _set_results(self, results):
+        """
+        Keeps the best of the restart results, in the format returned by `_fit_restart`, and their statistics.
+        Restarts abandoned by racing only count towards pruned_restarts_ and the distance counts.
+        """
+        self.distances_computed_ = sum(r['distances_computed'] for r in results)
+        self.distances_skipped_ = sum(r['distances_skipped'] for r in results)
+        pruned = [r for r in results if r.get('pruned')]
+        self.pruned_restarts_ = len(pruned)
+        self.pruned_iteration_nums_ = [r['iteration_num'] for r in pruned]
+        results = [r for r in results if not r.get('pruned')]
+        inertias = [r['inertia'] for r in results]
+        log_likelihoods = [r['log_likelihood'] for r in results]
+        best_idx = np.argmin(inertias)
+        best = results[best_idx]
+        self.inertias_ += inertias
+        self.log_likelihoods_ += log_likelihoods
+        self.iteration_nums_ = [r['iteration_num'] for r in results]
+        self.euclidean_iteration_nums_ = [r['euclidean_iteration_num'] for r in results]
+        self.stop_reasons_ = [r['stop_reason'] for r in results]
+        self.restart_statistics_ = [dict((key, r[key]) for key in ['covariances', 'log_dets', 'distance_sums'])
+                                    for r in results]
+        self.labels_ = best['labels']
+        self.all_labels_ = [r['labels'] for r in results]
+        self.best_log_likelihood_ = best['log_likelihood']
+        self.best_inertia_ = best['inertia']
+        self.cluster_centers_ = best['cluster_centers']
+        self.iteration_num = best['iteration_num']
+        self.euclidean_iteration_num = best['euclidean_iteration_num']
+        self.stop_reason = best['stop_reason']
+        self.distances_ = best['distances']
+        self._n_samples = best['n_samples']
         if self.verbose == 1:
             print('fit: n_clusters: {}, label bin count: {}'.format(self.n_clusters, np.bincount(self.labels_, minlength=self.n_clusters)))
 
+    def fit_path(self, data, ks, sample_weight=None):
+        """
+        Fits K-Means for every number of clusters in ks. See `iter_path`.
+
+        Parameters
+        ----------
+        data: numpy array
+        ks: list(int)
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+
+        Returns
+        -------
+        list of fitted SF_KMeans objects, one for each k in increasing order of k.
+        """
+        return list(self.iter_path(data, ks, sample_weight))
+
+    def iter_path(self, data, ks, sample_weight=None):
+        """
+        Fits K-Means for every number of clusters in ks, in increasing order, and yields each fitted model as soon
+        as it is done. The data is converted once and shared by all fits.
+
+        The smallest k is fit with n_init restarts. Every following k is warm started from the solution for the
+        previous k by repeatedly splitting its worst fitting cluster (the one with the largest sum of squared
+        Euclidean distances from its center) along its principal axis, followed by one K-Means run.
+
+        Parameters
+        ----------
+        data: numpy array
+        ks: list(int)
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+
+        Yields
+        ------
+        fitted SF_KMeans object with the parameters of this object and n_clusters=k
+        """
+        data, sample_weight, inverse = self._prepare_weighted_data(data, sample_weight)
+        previous = None
+        for k in sorted(set(ks)):
+            # Duplicates are collapsed once for the whole path, so the fits run on the prepared data as is
+            kmeans = self._clone(n_clusters=k, compress_duplicates=False)
+            if previous is None:
+                kmeans.fit(data, sample_weight)
+            else:
+                kmeans._set_min_members(data)
+                labels, cluster_centers = previous_labels.copy(), previous.cluster_centers_
+                while cluster_centers.shape[0] < k:
+                    labels, cluster_centers = self._split_worst_cluster(data, labels, cluster_centers.shape[0],
+                                                                        sample_weight)
+                kmeans.labels_, kmeans.cluster_centers_ = labels, cluster_centers
+                if self.covar_type == 'global':
+                    kmeans._global_covar_matrices = [previous._global_covar_matrices[0]] * k
+                kmeans._fit(data, sample_weight=sample_weight)
+                kmeans._set_results([kmeans._restart_result(data, sample_weight)])
+            previous, previous_labels = kmeans, kmeans.labels_
+            if inverse is not None:
+                kmeans.compress_duplicates = self.compress_duplicates
+                kmeans._expand_labels(inverse)
+            yield kmeans
+
+    def _prepare_data(self, data, copy=True):
+        """
+        Converts data to the form used by `_fit`: a numpy array, copied unless copy is False. Fits never write to
+        the data, so read-only arrays, such as memory maps shared by several processes, are not copied either.
+        """
+        if isinstance(data, np.ndarray) and not data.flags.writeable:
+            return data
+        return np.array(data) if copy else np.asarray(data)
+
+    def _prepare_weighted_data(self, data, sample_weight=None):
+        """
+        Prepares data and sample weights for `_fit`, collapsing identical rows into weighted unique rows if
+        compress_duplicates is set.
+
+        Returns
+        -------
+        data, sample_weight (None for unit weights), index of the unique row of each data point (None if
+        duplicates are not collapsed)
+        """
+        # collapse_duplicates copies the unique rows, so the data only needs a copy of its own if they are not
+        data = self._prepare_data(data, copy=not self.compress_duplicates)
+        sample_weight = check_sample_weight(sample_weight, data.shape[0])
+        if not self.compress_duplicates:
+            return data, sample_weight, None
+        collapsed = collapse_duplicates(data, sample_weight, MIN_DUPLICATES)
+        if collapsed is None:
+            return self._prepare_data(data), sample_weight, None
+        data, sample_weight, inverse = collapsed
+        if self.verbose >= 4:
+            print('Collapsed {} data points into {} unique rows.'.format(inverse.shape[0], data.shape[0]))
+        return data, sample_weight, inverse
+
+    def _expand_labels(self, inverse):
+        """
+        Expands the labels and distances of a fit on collapsed unique rows back to the original data points.
+
+        Parameters
+        ----------
+        inverse: index of the unique row of each original data point, as returned by `_prepare_weighted_data`
+        """
+        self.labels_ = self.labels_[inverse]
+        self.all_labels_ = [labels[inverse] for labels in self.all_labels_]
+        if self.distances_ is not None:
+            self.distances_ = self.distances_[inverse]
+
+    def _global_covariance(self, data, sample_weight=None):
+        """
+        Computes the global covariance matrix of data, unless it is already known.
+
+        Returns
+        -------
+        list of the global covariance matrix, once for each cluster
+        """
+        return self.covariances(np.zeros(data.shape[0], dtype=int), cluster_centers=None, data=data,
+                                sample_weight=sample_weight)
+
+    def _clone(self, **params):
+        """ Returns an unfitted copy of this object, with params overriding its parameters """
+        kmeans = copy.copy(self)
+        for key, value in params.items():
+            setattr(kmeans, key, value)
+        kmeans.labels_ = None
+        kmeans.cluster_centers_ = None
+        kmeans._inv_covar_matrices = None
+        kmeans._global_covar_matrices = None
+        kmeans._covar_factors = None
+        kmeans._whitened_data = None
+        kmeans.all_labels_ = []
+        kmeans.best_inertia_ = None
+        kmeans.inertias_ = []
+        kmeans.log_likelihoods_ = []
+        kmeans.iteration_num = kmeans.max_iter
+        kmeans.iteration_nums_ = []
+        kmeans.euclidean_iteration_num = 0
+        kmeans.euclidean_iteration_nums_ = []
+        kmeans.stop_reason = None
+        kmeans.stop_reasons_ = []
+        kmeans.pruned_restarts_ = 0
+        kmeans.pruned_iteration_nums_ = []
+        kmeans._race = None
+        kmeans._workspaces = None
+        kmeans.restart_statistics_ = []
+        kmeans.distances_ = None
+        kmeans.distances_computed_ = 0
+        kmeans.distances_skipped_ = 0
+        return kmeans
 
-    def _fit(self, data):
+    @staticmethod
+    def _split_worst_cluster(data, labels, n_clusters, sample_weight=None):
+        """
+        Splits the cluster with the largest sum of squared Euclidean distances from its center in two along its
+        principal axis. The new cluster gets label n_clusters.
+
+        Parameters
+        ----------
+        data: numpy array
+        labels: cluster label of each data point
+        n_clusters: current number of clusters
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+
+        Returns
+        -------
+        labels, cluster_centers with n_clusters + 1 clusters
+        """
+        statistics = ClusterStatistics.from_labels(data, labels, n_clusters, sample_weight)
+        worst = np.argmax(np.trace(statistics.scatters, axis1=1, axis2=2))
+        eigenValues, eigenVectors = np.linalg.eigh(statistics.scatters[worst])
+        axis = eigenVectors[:, -1]  # eigenvalues are in ascending order
+        members = np.argwhere(labels == worst).flatten()
+        side = (data[members] - statistics.means[worst]).dot(axis) > 0
+        labels = labels.copy()
+        labels[members[side]] = n_clusters
+        statistics = ClusterStatistics.from_labels(data, labels, n_clusters + 1, sample_weight)
+        return labels, statistics.means
+
+    def _fit_restart(self, data, seed, clone=True, start=None, sample_weight=None):
+        """
+        Runs one restart of K-Means and scores it.
+
+        Parameters
+        ----------
+        data: numpy array
+        seed: int
+            Seed for the initial cluster centers of this restart.
+        clone: bool
+            If True, the restart runs on a shallow copy of this object so that restarts can run concurrently.
+        start: labels, cluster_centers, statistics as returned by `_initial_assignment`
+            If given, the restart continues from this initial assignment instead of computing it from seed.
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+
+        Returns
+        -------
+        dict, see `_restart_result`; a restart abandoned by racing only has pruned=True, iteration_num,
+        distances_computed and distances_skipped
+        """
+        kmeans = copy.copy(self) if clone else self
+        statistics = None
+        if start is not None:
+            kmeans.labels_, kmeans.cluster_centers_, statistics = start
+        kmeans._fit(data, random_state=seed, statistics=statistics, sample_weight=sample_weight)
+        if kmeans._pruned:
+            distances_computed, distances_skipped = kmeans._distance_counts
+            return dict(pruned=True, iteration_num=kmeans.iteration_num, distances_computed=distances_computed,
+                        distances_skipped=distances_skipped)
+        return kmeans._restart_result(data, sample_weight)
+
+    def _restart_result(self, data, sample_weight=None):
+        """
+        Collects the result of the last call to `_fit`.
+
+        Returns
+        -------
+        dict
+            labels, cluster_centers, iteration_num, euclidean_iteration_num, stop_reason, distances_computed,
+            distances_skipped and the statistics returned by `_final_statistics`
+        """
+        result = self._final_statistics(data, sample_weight)
+        distances_computed, distances_skipped = self._distance_counts
+        result.update(labels=self.labels_, cluster_centers=self.cluster_centers_, iteration_num=self.iteration_num,
+                      euclidean_iteration_num=self.euclidean_iteration_num, stop_reason=self.stop_reason,
+                      distances_computed=distances_computed, distances_skipped=distances_skipped)
+        return result
+
+    def _final_statistics(self, data, sample_weight=None):
+        """
+        Computes everything needed to score the current clustering with one covariance update and one distance
+        pass, instead of separate passes for `_inertia` and `log_likelihood`.
+
+        Parameters
+        ----------
+        data: numpy array
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+
+        Returns
+        -------
+        dict
+            inertia: same as `_inertia`
+            log_likelihood: same as `log_likelihood`
+            covariances: covariance matrices. Shape: (n_clusters, dim, dim)
+            log_dets: log determinants of the covariance matrices. Shape: (n_clusters)
+            distances: distance of each data point from its assigned cluster center. Shape: (number of data points)
+            distance_sums: sum of the (weighted) distances in each cluster. Shape: (n_clusters)
+            n_samples: number of data points, or their total weight
+        """
+        n, d = data.shape
+        workspace = self._workspace()
+        statistics = self._cluster_statistics(data, self.labels_, sample_weight, workspace)
+        covar_matrices = self.covariances(self.labels_, cluster_centers=self.cluster_centers_, data=data,
+                                          statistics=statistics)
+        factors = self._factorize(covar_matrices)
+        if not self._is_chunked(data):
+            distances = self._covariance_squared_distances(data, factors, workspace)
+            np.sqrt(distances, out=distances)
+            if self.metric == 'euclidean':
+                min_distances = np.sqrt(self._squared_distances(data).min(axis=1))
+            else:
+                min_distances = distances.min(axis=1)
+            inertia = min_distances.sum() if sample_weight is None else sample_weight.dot(min_distances)
+            distances = distances[np.arange(n), self.labels_]
+        else:
+            distances = np.empty(n)
+            inertia = 0.
+            for start, _, block_distances in self._distance_blocks(data, self.cluster_centers_, factors):
+                rows = np.arange(block_distances.shape[0])
+                block_labels = self.labels_[start:start + rows.shape[0]]
+                distances[start:start + rows.shape[0]] = np.sqrt(block_distances[rows, block_labels])
+                if self.metric != 'euclidean':
+                    inertia += self._weighted_sum(np.sqrt(block_distances.min(axis=1)), sample_weight, start)
+            if self.metric == 'euclidean':
+                for start, _, block_distances in self._distance_blocks(data, self.cluster_centers_, None):
+                    inertia += self._weighted_sum(np.sqrt(block_distances.min(axis=1)), sample_weight, start)
+        weighted_distances = np.nan_to_num(distances)  # to deal with nans in the input data
+        if sample_weight is not None:
+            weighted_distances = weighted_distances * sample_weight
+        distance_sums = np.bincount(self.labels_, weights=weighted_distances, minlength=self.n_clusters)
+        nks = statistics.counts
+        n_samples = n if sample_weight is None else sample_weight.sum()
+        return dict(inertia=inertia, covariances=np.array(covar_matrices), log_dets=factors.log_det.copy(),
+                    distances=distances, distance_sums=distance_sums, n_samples=n_samples,
+                    log_likelihood=self._log_likelihood(nks, factors.log_det, distance_sums, n_samples, d))
+
+    @staticmethod
+    def _weighted_sum(values, sample_weight, start=0):
+        """ Sum of values, weighted by the weights of the data points from row start on if sample_weight is set """
+        if sample_weight is None:
+            return values.sum()
+        return sample_weight[start:start + values.shape[0]].dot(values)
+
+    def _fit(self, data, random_state=None, statistics=None, sample_weight=None):
         """
         Run K-Means on data once.
 
         Parameters
         ----------
         data: numpy array
+        random_state: int, RandomState instance or None
+            Used to seed the initial cluster centers.
+        statistics: ClusterStatistics of self.labels_
+            Optional, used when the fit continues from given labels and cluster centers.
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
 
         Returns
         -------
@@ -94,78 +529,472 @@ class SF_KMeans(object):
             self.labels_
             self.cluster_centers_
         """
-        if self.min_members == 'auto':
-            self._min_members = data.shape[1]
-        else:
-            self._min_members = self.min_members
-
-        data = np.array(data)
-        distances = np.zeros((data.shape[0], self.n_clusters))
-        distances.fill(float('inf'))
+        self._set_min_members(data)
+        data = self._prepare_data(data, copy=False)  # fit already copied the data; restarts share it
+        self.iteration_num = self.max_iter
+        n, n_clusters = data.shape[0], self.n_clusters
+        chunked = self._is_chunked(data)
+        bounds = None
+        fixed_whitening = self.metric == 'euclidean' or self.covar_type == 'global'
+        if self._bound_method() is not None and fixed_whitening and not chunked and not np.isnan(data).any():
+            bounds = BoundedAssignment(self._bound_method())
+        distances_computed = 0
+        workspace = self._workspace()
 
         """ Initial assignment """
         if self.cluster_centers_ is None:
-            self.cluster_centers_ = k_means_._init_centroids(data, self.n_clusters, 'k-means++')
-            for k in range(self.n_clusters):
-                k_dist = cdist(data, np.array([self.cluster_centers_[k]]), metric='euclidean')
-                distances[:, k] = k_dist.reshape((data.shape[0],))
-            self.labels_ = np.argmin(distances, axis=1)
-            self.cluster_centers_ = self._compute_cluster_centers(data)
-
+            self.labels_, self.cluster_centers_, statistics = self._initial_assignment(data, random_state,
+                                                                                       sample_weight)
+
+        tol_scale = 1.
+        if self.scale_tol:
+            if statistics is None:
+                statistics = self._cluster_statistics(data, self.labels_, sample_weight)
+            tol_scale = self._tol_scale(statistics)
+        self.euclidean_iteration_num = 0
+        if self.euclidean_tol is not None:
+            statistics = self._euclidean_phase(data, statistics, sample_weight, tol_scale)
+            distances_computed += self.euclidean_iteration_num * n * n_clusters
+
+        self.stop_reason = 'max_iter'
+        self._pruned = False
+        race = self._race
         old_cluster_centers_ = self.cluster_centers_
+        log_likelihood = None
+        inertia = None
 
-        for i in range(self.max_iter):
-            distances.fill(float('inf'))
-
+        for i in range(self.euclidean_iteration_num, self.max_iter):
             if self.verbose == 2:
                 print('\riteration: {}/{}'.format(i + 1, self.max_iter))
 
             """ Compute covariance matrices and inverse covariance matrices """
 
-            covar_matrices = self.covariances(self.labels_, cluster_centers=self.cluster_centers_, data=data)
-            # TODO: make this go faster for tied matrices
-            self._inv_covar_matrices = self._matrix_inverses(covar_matrices)
-
-            nks = np.bincount(self.labels_, minlength=self.n_clusters)  # number of points in each cluster
-
-            for k, nk in enumerate(nks):
-                k_dist = cdist(data, np.array([self.cluster_centers_[k]]), metric=self.metric, VI=self._inv_covar_matrices[k])
-                k_dist[np.isnan(k_dist)] = float('inf')  #  to deal with nans in cdist return
-                distances[:, k] = k_dist.reshape((data.shape[0],))
-
-            labels = np.argmin(distances, axis=1)
-            nks = np.bincount(labels, minlength=self.n_clusters)  # number of points in each cluster
-
-            if 0 in nks:  # at least one empty cluster
-                # move empty clusters to points farthest away from its cluster center
-                empty_clusters_idx = np.argwhere(nks == 0).flatten()
-                max_distances = np.min(distances, axis=1)  # distance of each point from its cluster center
-                farthest_point_idx = list(np.argsort(max_distances))
+            covar_matrices = self.covariances(self.labels_, cluster_centers=self.cluster_centers_, data=data,
+                                              statistics=statistics, sample_weight=sample_weight)
+            self._factorize(covar_matrices)
+
+            statistics = None
+            assigned_distances = None  # squared distance of each data point from its assigned cluster center
+            if bounds is not None:
+                labels = self._bounded_labels(data, bounds)
+            elif chunked:
+                factors = None if self.metric == 'euclidean' else self._covar_factors
+                labels, min_distances, statistics = self._chunked_assignment(data, self.cluster_centers_, factors,
+                                                                             sample_weight)
+                distances_computed += n * n_clusters
+                if np.bincount(labels, minlength=n_clusters).min() == 0:
+                    labels = self._reassign_empty_clusters(labels, min_distances=min_distances)
+                    statistics = self._cluster_statistics(data, labels, sample_weight)
+                assigned_distances = min_distances
+            else:
+                distances = self._squared_distances(data, workspace)
+                self._mask_nans(distances, workspace)
+                distances_computed += n * n_clusters
 
-                for c_idx in empty_clusters_idx:
-                    idx = farthest_point_idx.pop()
-                    single_point_clusters_idx = np.argwhere(nks == 1).flatten()
-                    while labels[idx] in single_point_clusters_idx:
-                        # find a point that is not in single point cluster
-                        idx = farthest_point_idx.pop()
-                    labels[idx] = c_idx
-                    nks = np.bincount(labels, minlength=self.n_clusters)
+                labels = np.argmin(distances, axis=1)
+                labels = self._reassign_empty_clusters(labels, distances)
+                assigned_distances = distances[np.arange(n), labels]
 
+            old_labels = self.labels_
             self.labels_ = labels
-            self.cluster_centers_ = self._compute_cluster_centers(data)
+            if statistics is None:
+                statistics = ClusterStatistics.from_labels(data, self.labels_, self.n_clusters, sample_weight,
+                                                           workspace)
+            if self.ll_tol is not None or race is not None:
+                assigned_distances = self._assigned_squared_distances(data, assigned_distances)
+            old_log_likelihood = log_likelihood
+            if self.ll_tol is not None:
+                log_likelihood = self._assignment_log_likelihood(data, statistics, assigned_distances, sample_weight)
+            if race is not None:
+                distances = np.sqrt(assigned_distances)
+                distances[~np.isfinite(distances)] = 0  # to deal with nans in the input data
+                inertia = self._weighted_sum(distances, sample_weight)
+            self.cluster_centers_ = self._compute_cluster_centers(data, statistics)
 
             center_shift_total = squared_norm(old_cluster_centers_ - self.cluster_centers_)
             if self.verbose == 2:
                 print('center_shift_total: {:0.6f}'.format(center_shift_total))
-            if center_shift_total <= self.tol:
+            stop_reason = self._stop_reason(old_labels, labels, center_shift_total, self.tol * tol_scale,
+                                            old_log_likelihood, log_likelihood, sample_weight)
+            if stop_reason is not None:
                 self.iteration_num = (i + 1)
+                self.stop_reason = stop_reason
                 if self.verbose >= 4:
-                    print('Converged after {} iterations.'.format(i + 1))
+                    print('Converged after {} iterations ({}).'.format(i + 1, stop_reason))
+                break
+            if race is not None and race.hopeless(i + 1, inertia):
+                self.iteration_num = (i + 1)
+                self._pruned = True
+                if self.verbose >= 4:
+                    print('Abandoned after {} iterations.'.format(i + 1))
                 break
             old_cluster_centers_ = self.cluster_centers_
+        if race is not None and not self._pruned:
+            race.finish(inertia)
+        if bounds is None:
+            self._distance_counts = (distances_computed, 0)
+        else:
+            self._distance_counts = (distances_computed + bounds.distances_computed, bounds.distances_skipped)
         # self.labels_ = self.reset_labels(self.labels_)
         # self.cluster_centers_ = self._compute_cluster_centers(data)
 
+    def _tol_scale(self, statistics):
+        """ Mean variance of the features of the data points described by statistics, see scale_tol """
+        pooled = statistics.pooled()
+        return np.trace(pooled.scatters[0]) / (pooled.counts[0] * pooled.means.shape[1])
+
+    def _stop_reason(self, old_labels, labels, center_shift_total, tol, old_log_likelihood=None,
+                     log_likelihood=None, sample_weight=None):
+        """
+        Checks the stopping rules after an iteration, see scale_tol.
+
+        Parameters
+        ----------
+        old_labels, labels: cluster label of each data point before and after the iteration
+        center_shift_total: squared norm of the change of the cluster centers
+        tol: tolerance of center_shift_total, scaled if scale_tol is True
+        old_log_likelihood, log_likelihood: log likelihood of the assignment before and after the iteration, or
+            None if unknown
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+
+        Returns
+        -------
+        str, name of the rule that holds, or None to continue
+        """
+        changed = None
+        if old_labels is not None and old_labels.shape == labels.shape:
+            changed = old_labels != labels
+        if changed is not None and not changed.any():
+            return 'labels'
+        if center_shift_total <= tol:
+            return 'center_shift'
+        if self.reassign_tol is not None and changed is not None:
+            if sample_weight is None:
+                fraction = changed.mean()
+            else:
+                fraction = sample_weight[changed].sum() / sample_weight.sum()
+            if fraction <= self.reassign_tol:
+                return 'reassigned'
+        if self.ll_tol is not None and old_log_likelihood is not None and \
+                log_likelihood - old_log_likelihood <= self.ll_tol * abs(old_log_likelihood):
+            return 'log_likelihood'
+        return None
+
+    def _assigned_squared_distances(self, data, assigned_distances=None):
+        """
+        Squared distance of each data point from its assigned cluster center in the last assignment step, computed
+        from the whitened data unless assigned_distances is given. Assignment steps with bounds do not keep
+        distances.
+        """
+        if assigned_distances is not None:
+            return assigned_distances
+        factors = None if self.metric == 'euclidean' else self._covar_factors
+        whitened, _ = self._whiten(data, factors)
+        cluster_centers = self.cluster_centers_ if factors is None else self.cluster_centers_.dot(factors.whitening[0])
+        offsets = whitened - cluster_centers[self.labels_]
+        return np.einsum('nd,nd->n', offsets, offsets)
+
+    def _assignment_log_likelihood(self, data, statistics, assigned_distances=None, sample_weight=None):
+        """
+        Log likelihood of the labels of the last assignment step, with the cluster centers and covariances the
+        data points were assigned with. Used by the ll_tol stopping rule.
+
+        Parameters
+        ----------
+        data: numpy array
+        statistics: ClusterStatistics of self.labels_
+        assigned_distances: squared distance of each data point from its assigned cluster center, see
+            `_assigned_squared_distances`
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+        """
+        distances = np.sqrt(self._assigned_squared_distances(data, assigned_distances))
+        distances[~np.isfinite(distances)] = 0  # to deal with nans in the input data
+        if sample_weight is not None:
+            distances = distances * sample_weight
+        distance_sums = np.bincount(self.labels_, weights=distances, minlength=self.n_clusters)
+        counts = statistics.counts
+        n, d = counts.sum(), data.shape[1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            term_1 = counts * (np.log(counts / n) - 0.5 * d * np.log(2 * np.pi) - 0.5 * self._covar_factors.log_det)
+        return np.nan_to_num(term_1).sum() - 0.5 * distance_sums.sum()
+
+    def _euclidean_phase(self, data, statistics=None, sample_weight=None, tol_scale=1.):
+        """
+        Runs Lloyd iterations with squared Euclidean distances from self.labels_ and self.cluster_centers_ until the
+        center shift drops to euclidean_tol, and sets euclidean_iteration_num. No covariance matrices are computed.
+
+        Parameters
+        ----------
+        data: numpy array
+        statistics: ClusterStatistics of self.labels_, or None
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+        tol_scale: factor applied to euclidean_tol, see scale_tol
+
+        Returns
+        -------
+        ClusterStatistics of self.labels_, or the given statistics if no iterations ran
+        """
+        chunked = self._is_chunked(data)
+        data_norms = None if chunked else np.einsum('nd,nd->n', data, data)
+        workspace = self._workspace()
+        for i in range(self.max_iter):
+            if chunked:
+                labels, min_distances, statistics = self._chunked_assignment(data, self.cluster_centers_, None,
+                                                                             sample_weight)
+                if np.bincount(labels, minlength=self.n_clusters).min() == 0:
+                    labels = self._reassign_empty_clusters(labels, min_distances=min_distances)
+                    statistics = self._cluster_statistics(data, labels, sample_weight)
+            else:
+                distances = squared_euclidean(data, self.cluster_centers_, data_norms,
+                                              out=workspace.array('distances', (data.shape[0], self.n_clusters)))
+                self._mask_nans(distances, workspace)
+                labels = self._reassign_empty_clusters(np.argmin(distances, axis=1), distances)
+                statistics = ClusterStatistics.from_labels(data, labels, self.n_clusters, sample_weight, workspace)
+            old_cluster_centers_ = self.cluster_centers_
+            self.labels_ = labels
+            self.cluster_centers_ = self._compute_cluster_centers(data, statistics)
+            self.euclidean_iteration_num = i + 1
+            center_shift_total = squared_norm(old_cluster_centers_ - self.cluster_centers_)
+            if self.verbose == 2:
+                print('euclidean center_shift_total: {:0.6f}'.format(center_shift_total))
+            if center_shift_total <= self.euclidean_tol * tol_scale:
+                break
+        if self.verbose >= 4:
+            print('Euclidean phase converged after {} iterations.'.format(self.euclidean_iteration_num))
+        return statistics
+
+    def _bound_method(self):
+        """ Returns the bound method used by the assignment step ("hamerly" or "elkan"), or None """
+        if self.assignment == 'full':
+            return None
+        if self.assignment == 'bounds':
+            return 'hamerly' if self.n_clusters < ELKAN_MIN_CLUSTERS else 'elkan'
+        return self.assignment
+
+    def _bounded_labels(self, data, bounds):
+        """
+        Assigns each data point to its nearest cluster center in the whitened space, using bounds to skip
+        distances. Bounds are reset whenever the whitening changes. If a cluster ends up empty, all distances are
+        computed and empty clusters are reassigned as in the full assignment step.
+
+        Parameters
+        ----------
+        data: numpy array
+        bounds: BoundedAssignment
+
+        Returns
+        -------
+        labels
+        """
+        factors = None if self.metric == 'euclidean' else self._covar_factors
+        whitened, norms = self._whiten(data, factors)
+        cluster_centers = self.cluster_centers_ if factors is None else self.cluster_centers_.dot(factors.whitening[0])
+        # The whitening cache entry changes exactly when the data or its whitening change
+        labels = bounds.assign(whitened, norms, cluster_centers, key=self._whitened_data)
+        if np.bincount(labels, minlength=self.n_clusters).min() == 0:
+            distances = squared_euclidean(whitened, cluster_centers, norms)
+            bounds.distances_computed += distances.size
+            labels = self._reassign_empty_clusters(labels, distances)
+            bounds.reset()
+        return labels
+
+    def _initial_assignment(self, data, random_state=None, sample_weight=None):
+        """
+        Seeds the cluster centers and assigns each data point to its nearest center using Euclidean distance.
+        The result only depends on the data, n_clusters and random_state, so fits with different covariance
+        types can share it.
+
+        Parameters
+        ----------
+        data: numpy array
+        random_state: int, RandomState instance or None
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+
+        Returns
+        -------
+        labels, cluster_centers, ClusterStatistics of labels
+        """
+        cluster_centers = self._init_centers(data, random_state, sample_weight)
+        if not self._is_chunked(data):
+            labels = np.argmin(squared_euclidean(data, cluster_centers), axis=1)
+            statistics = ClusterStatistics.from_labels(data, labels, self.n_clusters, sample_weight)
+        else:
+            labels, _, statistics = self._chunked_assignment(data, cluster_centers, None, sample_weight)
+        return labels, statistics.means.copy(), statistics
+
+    def _block_rows(self, data):
+        """ Number of rows in each block of the chunked assignment step, or None if memory_budget is not set """
+        if self.memory_budget is None:
+            return None
+        # distances, their temporaries and one whitened block of data
+        bytes_per_row = 8 * (2 * self.n_clusters + data.shape[1])
+        return max(1, int(self.memory_budget // bytes_per_row))
+
+    def _is_chunked(self, data):
+        """ True if the assignment step processes data in more than one block of rows """
+        block_rows = self._block_rows(data)
+        return block_rows is not None and block_rows < data.shape[0]
+
+    def _row_blocks(self, data):
+        """
+        Iterates over data one block of rows at a time, with the block size set by memory_budget.
+
+        Yields
+        ------
+        index of the first row of the block, block of rows
+        """
+        block_rows = self._block_rows(data) or data.shape[0]
+        for start in range(0, data.shape[0], block_rows):
+            yield start, data[start:start + block_rows]
+
+    def _cluster_statistics(self, data, labels, sample_weight=None, workspace=None):
+        """ ClusterStatistics of labels, computed one block of rows at a time if memory_budget is set """
+        block_rows = self._block_rows(data)
+        if block_rows is None or block_rows >= data.shape[0]:
+            return ClusterStatistics.from_labels(data, labels, self.n_clusters, sample_weight, workspace)
+        return ClusterStatistics.from_label_blocks(data, labels, self.n_clusters, block_rows, sample_weight)
+
+    def _distance_blocks(self, data, cluster_centers, factors):
+        """
+        Computes squared distances of the data points from all cluster centers one block of rows at a time, with
+        the blocks given by `_row_blocks`.
+
+        Parameters
+        ----------
+        data: numpy array
+        cluster_centers: numpy array. Shape: (n_clusters, dim)
+        factors: CovarianceFactors of the covariance matrices of the clusters, or None for Euclidean distances
+
+        Yields
+        ------
+        index of the first row of the block, block of rows, squared distances.
+            Shape of the squared distances: (rows in the block, n_clusters)
+        """
+        if factors is not None and factors.shared:
+            whitening = factors.whitening[0]
+            whitened_centers = cluster_centers.dot(whitening)
+        for start, block in self._row_blocks(data):
+            if factors is None:
+                yield start, block, squared_euclidean(block, cluster_centers)
+            elif factors.shared:
+                yield start, block, squared_euclidean(block.dot(whitening), whitened_centers)
+            else:
+                yield start, block, squared_mahalanobis(block, cluster_centers, factors.whitening)
+
+    def _chunked_assignment(self, data, cluster_centers, factors, sample_weight=None):
+        """
+        Assigns each data point to its nearest cluster center one block of rows at a time, reducing each block of
+        distances to labels, minimum distances and cluster statistics before the next block is computed.
+
+        Parameters
+        ----------
+        data: numpy array
+        cluster_centers: numpy array. Shape: (n_clusters, dim)
+        factors: CovarianceFactors of the covariance matrices of the clusters, or None for Euclidean distances
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+
+        Returns
+        -------
+        labels, squared distance of each data point from its nearest cluster center, ClusterStatistics of labels
+        """
+        n = data.shape[0]
+        labels = np.empty(n, dtype=int)
+        min_distances = np.empty(n)
+        statistics = None
+        for start, block, distances in self._distance_blocks(data, cluster_centers, factors):
+            distances[np.isnan(distances)] = float('inf')  # to deal with nans in the input data
+            rows = slice(start, start + distances.shape[0])
+            labels[rows] = np.argmin(distances, axis=1)
+            min_distances[rows] = distances[np.arange(distances.shape[0]), labels[rows]]
+            block_weight = None if sample_weight is None else sample_weight[rows]
+            block_statistics = ClusterStatistics.from_labels(block, labels[rows], self.n_clusters, block_weight)
+            statistics = block_statistics if statistics is None else statistics.merge(block_statistics)
+        return labels, min_distances, statistics
+
+    def _final_assignment(self, data, statistics, sample_weight=None):
+        """
+        Assigns every data point using the current cluster centers and the covariances derived from statistics,
+        then recomputes the cluster centers from the assignment. Used by fits that learn the clustering on a
+        sample of the data. The global covariance is computed from data unless it is already known.
+
+        Parameters
+        ----------
+        data: numpy array
+        statistics: ClusterStatistics the covariances are derived from, or None to use the current covariances
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+        """
+        if self.covar_type == 'global':
+            self._factorize(self._global_covariance(data, sample_weight))
+        elif statistics is not None:
+            covar_matrices = self.covariances(None, cluster_centers=self.cluster_centers_, data=data,
+                                              statistics=statistics)
+            self._factorize(covar_matrices)
+        factors = None if self.metric == 'euclidean' or self._covar_factors is None else self._covar_factors
+        labels, min_distances, statistics = self._chunked_assignment(data, self.cluster_centers_, factors,
+                                                                     sample_weight)
+        if np.bincount(labels, minlength=self.n_clusters).min() == 0:
+            labels = self._reassign_empty_clusters(labels, min_distances=min_distances)
+            statistics = self._cluster_statistics(data, labels, sample_weight)
+        self.labels_ = labels
+        self.cluster_centers_ = statistics.means.copy()
+
+    def _init_centers(self, data, random_state=None, sample_weight=None):
+        """ Picks the initial cluster centers using the init strategy; farthest traversal ignores sample_weight """
+        if self.init == 'k-means||':
+            centers, _ = kmeans_parallel(data, self.n_clusters, random_state, sample_weight)
+        elif self.init == 'farthest':
+            centers, _ = farthest_traversal(data, self.n_clusters, random_state)
+        else:
+            centers, _ = kmeans_plusplus(data, self.n_clusters, random_state, sample_weight)
+        return centers
+
+    def _reassign_empty_clusters(self, labels, distances=None, min_distances=None):
+        """
+        Moves empty clusters to the points farthest away from their cluster centers.
+
+        Parameters
+        ----------
+        labels: cluster label of each data point. Modified in place. Shape: (number of data points)
+        distances: distances of all data points from all cluster centers. Shape: (number of data points, n_clusters)
+        min_distances: distance of each data point from its cluster center, used instead of distances.
+            Shape: (number of data points)
+
+        Returns
+        -------
+        labels
+        """
+        nks = np.bincount(labels, minlength=self.n_clusters)  # number of points in each cluster
+
+        if 0 in nks:  # at least one empty cluster
+            # move empty clusters to points farthest away from its cluster center
+            empty_clusters_idx = np.argwhere(nks == 0).flatten()
+            max_distances = min_distances
+            if max_distances is None:
+                max_distances = np.min(distances, axis=1)  # distance of each point from its cluster center
+            # Each empty cluster takes one point and each single point cluster can cause one point to be skipped,
+            # so only the farthest few points need to be sorted
+            n = max_distances.shape[0]
+            n_farthest = min(n, empty_clusters_idx.shape[0] + self.n_clusters + 1)
+            farthest = np.argpartition(max_distances, n - n_farthest)[n - n_farthest:]
+            farthest_point_idx = list(farthest[np.argsort(max_distances[farthest])])
+
+            for c_idx in empty_clusters_idx:
+                idx = farthest_point_idx.pop()
+                single_point_clusters_idx = np.argwhere(nks == 1).flatten()
+                while labels[idx] in single_point_clusters_idx:
+                    # find a point that is not in single point cluster
+                    idx = farthest_point_idx.pop()
+                labels[idx] = c_idx
+                nks = np.bincount(labels, minlength=self.n_clusters)
+        return labels
+
+    def _set_min_members(self, data):
+        """ Sets the minimum number of members a cluster needs to get its own covariance matrix """
+        if self.min_members == 'auto':
+            self._min_members = data.shape[1]
+        else:
+            self._min_members = self.min_members
+
     @staticmethod
     def reset_labels(labels):
         """ Resets label numbers so that they are sequential. For example, [0, 0, 3, 3, 1, 1] --> [0, 0, 1, 1, 2, 2] """
@@ -177,68 +1006,123 @@ class SF_KMeans(object):
 
     def _initial_farthest_traversal(self, data, seed=None):
         """ Find the initial set of cluster centers using Farthest Traversal strategy """
-        # Pick first at random
-        np.random.seed(seed)
-        centers = data[np.random.randint(low=0, high=data.shape[0], size=1)]
-        for _ in range(self.n_clusters - 1):
-            dist = cdist(data, centers)
-            dist = dist.sum(axis=1)
-            assert dist.shape[0] == data.shape[0]  # making sure that axis=1 is correct
-            # point with max. dist from all centers becomes a new center
-            centers = np.append(centers, [data[np.argmax(dist)]], axis=0)
+        centers, _ = farthest_traversal(data, self.n_clusters, seed)
         return centers
 
-    def _inertia(self, data):
-        """ Sum of distances of all data points from their cluster centers """
-        distances = np.zeros((data.shape[0], self.n_clusters))
-        covar_matrices = self.covariances(self.labels_, cluster_centers=self.cluster_centers_, data=data)
-        self._inv_covar_matrices = self._matrix_inverses(covar_matrices)
-        for k in range(self.n_clusters):
-            k_dist = cdist(data, np.array([self.cluster_centers_[k]]), metric=self.metric,
-                           VI=self._inv_covar_matrices[k])
-            k_dist = k_dist.reshape((data.shape[0],))
-            distances[:, k] = k_dist
-        distances = distances.min(axis=1)
+    def _squared_distances(self, data, workspace=None):
+        """
+        Computes squared distances of all data points from all cluster centers using the factorization of the
+        most recently computed covariance matrices.
+
+        Parameters
+        ----------
+        data: numpy array
+        workspace: Workspace
+            If given, the distances are written to its 'distances' buffer instead of a new array.
+
+        Returns
+        -------
+        numpy array of squared distances. Shape: (number of data points, self.n_clusters)
+        """
+        if self.metric == 'euclidean':
+            whitened, norms = self._whiten(data, None)
+            out = None if workspace is None else workspace.array('distances', (data.shape[0], self.n_clusters))
+            return squared_euclidean(whitened, self.cluster_centers_, norms, out=out)
+        return self._covariance_squared_distances(data, self._covar_factors, workspace)
+
+    def _covariance_squared_distances(self, data, factors, workspace=None):
+        """
+        Computes squared Mahalanobis distances of all data points from all cluster centers.
+        When all clusters share one covariance matrix (global or tied), Mahalanobis distance is Euclidean
+        distance on whitened data, so the data is whitened once and a single matrix multiply gives all distances.
+
+        Parameters
+        ----------
+        data: numpy array
+        factors: CovarianceFactors of the covariance matrices of the clusters
+        workspace: Workspace
+            If given, the distances are written to its 'distances' buffer instead of a new array.
+
+        Returns
+        -------
+        numpy array of squared distances. Shape: (number of data points, self.n_clusters)
+        """
+        out = scratch = None
+        if workspace is not None:
+            n, d = data.shape
+            out = workspace.array('distances', (n, self.n_clusters))
+            if not factors.shared:
+                scratch = workspace.array('projected', (max(BLOCK_SIZE, self.n_clusters * d),))
+        if not factors.shared:
+            return squared_mahalanobis(data, self.cluster_centers_, factors.whitening, out=out, scratch=scratch)
+        whitened, norms = self._whiten(data, factors)
+        return squared_euclidean(whitened, self.cluster_centers_.dot(factors.whitening[0]), norms, out=out)
+
+    @staticmethod
+    def _mask_nans(distances, workspace):
+        """ Sets nan distances, which come from nans in the input data, to infinity in place """
+        nans = np.isnan(distances, out=workspace.array('nan_mask', distances.shape, dtype=bool))
+        np.copyto(distances, float('inf'), where=nans)
+
+    def _whiten(self, data, factors):
+        """
+        Whitens data with the shared whitening factor of factors, or leaves it as is if factors is None.
+        The result is cached until data or factors change, so global covariance whitens the data once per fit.
+
+        Returns
+        -------
+        whitened data, squared norm of each whitened data point
+        """
+        cache = self._whitened_data
+        if cache is None or cache[0] is not data or cache[1] is not factors:
+            whitened = data if factors is None else data.dot(factors.whitening[0])
+            cache = (data, factors, whitened, np.einsum('nd,nd->n', whitened, whitened))
+            self._whitened_data = cache
+        return cache[2], cache[3]
+
+    def _inertia(self, data, sample_weight=None):
+        """ Sum of (weighted) distances of all data points from their cluster centers """
+        covar_matrices = self.covariances(self.labels_, cluster_centers=self.cluster_centers_, data=data,
+                                          sample_weight=sample_weight)
+        self._factorize(covar_matrices)
+        distances = np.sqrt(self._squared_distances(data).min(axis=1))
         assert distances.shape[0] == data.shape[0]
-        return distances.sum()
+        return self._weighted_sum(distances, sample_weight)
 
-    def _rss(self, data):
-        """ Residual Sum of Square distances of all data points from their cluster centers """
+    def _rss(self, data, sample_weight=None):
+        """ Residual Sum of (weighted) Square distances of all data points from their cluster centers """
         if self.metric == 'euclidean':
             distances = cdist(data, self.cluster_centers_, metric='euclidean')
+            distances = distances.min(axis=1)
+            distances = distances ** 2
         elif self.metric == 'mahalanobis':
-            #covar_matrix = self.covariance(labels=self.labels_, cluster_centers=self.cluster_centers_, data=data)
-            covar_matrices = self.covariances(self.labels_,
-                                            cluster_centers=self.cluster_centers_, data=data)[0]
-            self._inv_covar_matrices = self._matrix_inverses(covar_matrices)
-            distances = cdist(data, self.cluster_centers_, metric='mahalanobis', VI=self._inv_covar_matrices)
-        distances = distances.min(axis=1)
-        distances = distances ** 2
+            covar_matrices = self.covariances(self.labels_, cluster_centers=self.cluster_centers_, data=data,
+                                              sample_weight=sample_weight)
+            # Factorized apart from the cache of the fit, which these matrices must not replace
+            factors = CovarianceFactors(covar_matrices, shared=self.covar_type == 'global' or self.covar_tied)
+            distances = self._covariance_squared_distances(data, factors).min(axis=1)
         assert distances.shape[0] == data.shape[0]
-        return distances.sum()
+        return self._weighted_sum(distances, sample_weight)
 
-    def _compute_cluster_centers(self, data):
+    def _compute_cluster_centers(self, data, statistics=None, sample_weight=None):
         """
-        Computes the center of each cluster using self.labels_
+        Computes the (weighted) center of each cluster using self.labels_
 
         Parameters
         ----------
         data: input data
+        statistics: ClusterStatistics of self.labels_, computed from data if not provided
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
 
         Returns
         -------
         cluster_centers: numpy ndarray with shape: (self.n_clusters, data.shape[1])
 
         """
-        cluster_centers = []
-        for k in range(self.n_clusters):
-            datapoints_in_k = data[self.labels_ == k]
-            if self.metric == 'euclidean':
-                cluster_centers += [datapoints_in_k.mean(axis=0)]
-            elif self.metric == 'mahalanobis':
-                # cluster_centers += [self._center_mahalanobis(datapoints_in_k)]
-                cluster_centers += [datapoints_in_k.mean(axis=0)]
-        cluster_centers = np.array(cluster_centers)
+        if statistics is None:
+            statistics = ClusterStatistics.from_labels(data, self.labels_, self.n_clusters, sample_weight)
+        # Both metrics use the mean: self._center_mahalanobis is not used for mahalanobis
+        cluster_centers = statistics.means.copy()
         assert cluster_centers.shape == (self.n_clusters, data.shape[1])
         return cluster_centers
 
@@ -259,30 +1143,29 @@ class SF_KMeans(object):
         center_idx = np.argmin(sum_distances)
         return data[center_idx]
 
-    def _matrix_inverse(self, matrix):
+    def _factorize(self, covar_matrices):
         """
-        Computes inverse of a matrix.
-        """
-        matrix = np.array(matrix)
-        n_features = matrix.shape[0]
-        rank = np.linalg.matrix_rank(matrix)
+        Factorizes covariance matrices, reusing the cached factorization if it was computed for the same matrices.
+        Tied and global covariance matrices are identical for all clusters, so only one of them is factorized.
 
-        if rank == n_features:
-            return np.linalg.inv(matrix)
-        else:
-            # Matrix is not full rank, so use Hadi's technique to compute inverse
-            # Reference: Ali S. Hadi (1992) "Identifying Multiple Outliers in Multivariate Data" eg. 2.3, 2.4
-            eigenValues, eigenVectors = np.linalg.eig(matrix)
-            eigenValues = np.abs(eigenValues)  # to deal with -0 values
-            idx = eigenValues.argsort()[::-1]
-            eigenValues = eigenValues[idx]
-            eigenVectors = eigenVectors[:, idx]
+        Parameters
+        ----------
+        covar_matrices: list of matrices, as returned by `covariances`
 
-            s = eigenValues[eigenValues != 0].min()
-            w = [1 / max(e, s) for e in eigenValues]
-            W = w * np.eye(n_features)
+        Returns
+        -------
+        CovarianceFactors
+        """
+        if self._covar_factors is None or self._covar_factors.matrices is not covar_matrices:
+            shared = self.covar_type == 'global' or self.covar_tied
+            self._covar_factors = CovarianceFactors(covar_matrices, shared=shared)
+        return self._covar_factors
 
-            return eigenVectors.dot(W).dot(eigenVectors.T)
+    def _matrix_inverse(self, matrix):
+        """
+        Computes inverse of a matrix. Matrices that are not full rank are inverted using Hadi's technique.
+        """
+        return CovarianceFactors([matrix]).inverse[0]
 
     def _matrix_inverses(self, matrix_v):
         """
@@ -297,15 +1180,7 @@ class SF_KMeans(object):
         -------
         matrix inverse: list of inverted matrices. type: list(numpy array)
         """
-        if self.covar_type == 'global':
-            if self._inv_covar_matrices is None:
-                self._inv_covar_matrices = [self._matrix_inverse(matrix_v[0])] * self.n_clusters
-            return self._inv_covar_matrices
-
-        if self.covar_tied:
-            return [self._matrix_inverse(matrix_v[0])]*self.n_clusters
-        else:
-            return [self._matrix_inverse(c) for c in matrix_v]
+        return list(self._factorize(matrix_v).inverse)
 
     @staticmethod
     def labels_to_resp(labels, n_clusters):
@@ -316,7 +1191,7 @@ class SF_KMeans(object):
         return resp
 
     # TODO: Delete cluster_centers from args
-    def covariances(self, labels, cluster_centers, data):
+    def covariances(self, labels, cluster_centers, data, statistics=None, sample_weight=None):
         """
         Computes covariance based on  Kevin P. Murphy. "Fitting a Conditional Linear Gaussian Distribution" (2003).
 
@@ -325,6 +1200,9 @@ class SF_KMeans(object):
         labels: list of cluster labels of each data point. Shape: (number of data points)
         cluster_centers: numpy array of all cluster centers. Shape: (number of clusters, dimensions of data set)
         data: numpy array of input data. Shape:(number of data points, dimensions of data set)
+        statistics: ClusterStatistics of labels, computed from data if not provided
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+            Only used to compute statistics.
 
         Returns:
         -------
@@ -332,79 +1210,33 @@ class SF_KMeans(object):
         """
         n_clusters = self.n_clusters
         n_features = data.shape[1]
-        covariances_v = np.array([np.eye(n_features)]*n_clusters)
-        nks = np.bincount(labels, minlength=self.n_clusters)
-
         if self.covar_type == 'global':
             if self._global_covar_matrices is None:
-                covar = np.cov(data.T, bias=True).reshape(data.shape[1], data.shape[1])
+                if statistics is None:
+                    statistics = self._cluster_statistics(data, labels, sample_weight)
+                pooled = statistics.pooled()
+                covar = pooled.scatters[0] / pooled.counts[0]
                 assert covar.shape == (data.shape[1], data.shape[1])
                 self._global_covar_matrices = [covar] * self.n_clusters
             return self._global_covar_matrices
 
-        elif self.covar_type == 'full' and not self.covar_tied:
-            for k in range(n_clusters):
-                if nks[k] > self._min_members:
-                    data_k = data[labels==k]
-                    covar = np.cov(data_k.T, bias=True).reshape(data_k.shape[1], data_k.shape[1])
-                    covariances_v[k] = covar
-
-        elif self.covar_type == 'full' and self.covar_tied:
-            covar = np.zeros((n_features, n_features))
-            for k in range(n_clusters):
-                if nks[k] > self._min_members:
-                    data_k = data[labels==k]
-                    covar += np.cov(data_k.T, bias=True).reshape(data_k.shape[1], data_k.shape[1])
-            covar /= n_clusters
-            covariances_v[:] = covar
-
-        if self.covar_type == 'diag' and not self.covar_tied:
-            for k in range(n_clusters):
-                if nks[k] > self._min_members:
-                    data_k = data[labels==k]
-                    covar = np.cov(data_k.T, bias=True).reshape(data_k.shape[1], data_k.shape[1])
-                    covar *= np.eye(n_features)  # zero out non-diagonal elements
-                    covariances_v[k] = covar
-
-        elif self.covar_type == 'diag' and self.covar_tied:
-            covar = np.zeros((n_features, n_features))
-            for k in range(n_clusters):
-                if nks[k] > self._min_members:
-                    data_k = data[labels==k]
-                    covar += np.cov(data_k.T, bias=True).reshape(data_k.shape[1], data_k.shape[1])
-            covar /= n_clusters
-            covar *= np.eye(n_features)  # zero out non-diagonal elements
-            covariances_v[:] = covar
-
-        if self.covar_type == 'spher' and not self.covar_tied:
-            for k in range(n_clusters):
-                if nks[k] > self._min_members:
-                    data_k = data[labels==k]
-                    covar = np.var(data_k, axis=0)  # var of each feature
-                    covar = np.mean(covar)
-                    covar *= np.eye(n_features)
-                    covariances_v[k] = covar
-
-        elif self.covar_type == 'spher' and self.covar_tied:
-            covar = np.zeros(n_features)
-            for k in range(n_clusters):
-                if nks[k] > self._min_members:
-                    data_k = data[labels==k]
-                    covar += np.var(data_k, axis=0)  # var of each feature
-            covar /= n_clusters
-            covar = np.mean(covar)
-            covar *= np.eye(n_features)  # zero out non-diagonal elements
-            covariances_v[:] = covar
+        if statistics is None:
+            statistics = self._cluster_statistics(data, labels, sample_weight)
+        nks = statistics.counts
+        covariances_v = covariances_from_statistics(nks, statistics.scatters, self.covar_type, self.covar_tied,
+                                                    self._min_members)
 
         # It is possible for the determinant of the covariance matrix to be zero
         # when there are less than n_features independent points in the dataset
         # In this case, set the covariance matrix to the identity matrix to force the use
         # of euclidean distance.
+        factors = self._factorize(covariances_v)
         for idx, c in enumerate(covariances_v):
-            if np.linalg.det(c) <= 0:
+            if factors.sign[idx] <= 0:
                 if self.verbose == 1:
-                    print("det is {}, matrix is {}, nk:{}".format(np.linalg.det(c), c, np.bincount(labels, minlength=n_clusters)[idx]))
+                    print("log det is {}, matrix is {}, nk:{}".format(factors.log_det[idx], c, nks[idx]))
                 covariances_v[idx] = np.eye(n_features)
+                factors.set_identity(idx)
 
         return covariances_v
 
@@ -452,20 +1284,44 @@ class SF_KMeans(object):
             covar_v.append(covar)
         return covar_v
 
-    def log_likelihood(self, data):
-        nks = np.bincount(self.labels_, minlength=self.n_clusters)  # number of points in each cluster
+    def log_likelihood(self, data, sample_weight=None):
+        sample_weight = check_sample_weight(sample_weight, data.shape[0])
+        if self._is_chunked(data):
+            return self._final_statistics(data, sample_weight)['log_likelihood']
+        # number of points in each cluster, or their total weight
+        nks = np.bincount(self.labels_, weights=sample_weight, minlength=self.n_clusters)
         n, d = data.shape
+        covar_matrices = self.covariances(self.labels_, cluster_centers=self.cluster_centers_, data=data,
+                                          sample_weight=sample_weight)
+        factors = self._factorize(covar_matrices)
+        distances = self._covariance_squared_distances(data, factors)
+        distances = np.sqrt(distances[np.arange(n), self.labels_])
+        distances = np.nan_to_num(distances)  # to deal with nans in the input data
+        if sample_weight is not None:
+            distances *= sample_weight
+            n = sample_weight.sum()
+        distance_sums = np.bincount(self.labels_, weights=distances, minlength=self.n_clusters)
+        return self._log_likelihood(nks, factors.log_det, distance_sums, n, d)
+
+    def _log_likelihood(self, nks, covar_matrix_log_det_v, distance_sums, n, d):
+        """
+        Computes the log likelihood from per-cluster statistics.
+
+        Parameters
+        ----------
+        nks: number of points in each cluster, or their total weight. Shape: (n_clusters)
+        covar_matrix_log_det_v: log determinant of each covariance matrix. Shape: (n_clusters)
+        distance_sums: sum of the (weighted) distances of the points in each cluster from its center.
+            Shape: (n_clusters)
+        n: number of data points, or their total weight
+        d: number of dimensions
+        """
         log_likelihood = 0
-        covar_matrices = self.covariances(self.labels_, cluster_centers=self.cluster_centers_, data=data)
-        covar_matrix_det_v = np.linalg.det(covar_matrices)
-        self._inv_covar_matrices = self._matrix_inverses(covar_matrices)
         for k, nk in enumerate(nks):
             if self.verbose == 1:
-                print('log_likelihood: covar_matrix_det = {}'.format(covar_matrix_det_v[k]))
-            term_1 = nk * (np.log(float(nk)/n) - 0.5 * d * np.log(2*np.pi) - 0.5 * np.log(abs(covar_matrix_det_v[k])))
-            cdist_result = cdist(data[self.labels_ == k], np.array([self.cluster_centers_[k]]), metric='mahalanobis', VI=self._inv_covar_matrices[k])
-            cdist_no_nan = cdist_result[~np.isnan(cdist_result)]  #  to deal with nans returned by cdist
-            term_2 = -0.5 * (np.sum(cdist_no_nan))
+                print('log_likelihood: covar_matrix_log_det = {}'.format(covar_matrix_log_det_v[k]))
+            term_1 = nk * (np.log(float(nk)/n) - 0.5 * d * np.log(2*np.pi) - 0.5 * covar_matrix_log_det_v[k])
+            term_2 = -0.5 * distance_sums[k]
             k_sum = term_1 + term_2
             log_likelihood += k_sum
         if np.isnan(log_likelihood) or log_likelihood == float('inf'):
@@ -476,8 +1332,14 @@ class SF_KMeans(object):
         """
         Compute free parameters for the model fit using K-Means
         """
-        K = np.unique(self.labels_).shape[0]  # number of clusters
         n, d = data.shape
+        return self._free_parameters(d)
+
+    def _free_parameters(self, d):
+        """
+        Compute free parameters for the model fit using K-Means on data with d dimensions
+        """
+        K = np.unique(self.labels_).shape[0]  # number of clusters
         r = (K - 1) + (K * d)
         if self.metric == 'euclidean':
             r += 1  # one parameter for variance
@@ -496,7 +1358,7 @@ class SF_KMeans(object):
                 r += K  # all diagonal elements are equal
         return r
 
-    def bic(self, data):
+    def bic(self, data, sample_weight=None):
         """
         Computes the BIC score for a model fit using K-Means.
 
@@ -505,27 +1367,32 @@ class SF_KMeans(object):
         Parameters
         ----------
         data: input data
+        sample_weight: weight of each data point, or None for unit weights. The size of the dataset is the total
+            weight.
 
         Returns
         -------
         BIC score
         """
-        data = np.array(data)
+        data = self._prepare_data(data, copy=False)
+        sample_weight = check_sample_weight(sample_weight, data.shape[0])
         n, d = data.shape
+        if sample_weight is not None:
+            n = sample_weight.sum()
         penalty = 0.5 * self.free_parameters(data) * np.log(n)
         if self.use_rss:
-            rss = self._rss(data)
+            rss = self._rss(data, sample_weight)
             bic = n * np.log(rss / float(n)) - penalty
             if self.verbose == 1:
                 print('rss: {:0.4f}, penalty:{:0.4f}, bic:{:0.4f}'.format(rss, penalty, bic))
         else:
-            log_likelihood = self.log_likelihood(data)
+            log_likelihood = self.log_likelihood(data, sample_weight)
             bic = log_likelihood - penalty
             if self.verbose == 1:
                 print('log_likelihood: {:0.4f}, penalty:{:0.4f}, bic:{:0.4f}'.format(log_likelihood, penalty, bic))
         return bic
 
-    def aic(self, data):
+    def aic(self, data, sample_weight=None):
         """
         Computes AIC score for a model fit using K-Means.
 
@@ -534,22 +1401,57 @@ class SF_KMeans(object):
         Parameters
         ----------
         data: input data
+        sample_weight: weight of each data point, or None for unit weights. The size of the dataset is the total
+            weight.
 
         Returns
         -------
         AIC score
         """
-        data = np.array(data)
+        data = self._prepare_data(data, copy=False)
+        sample_weight = check_sample_weight(sample_weight, data.shape[0])
         n, d = data.shape
+        if sample_weight is not None:
+            n = sample_weight.sum()
         penalty = self.free_parameters(data)
         if self.use_rss:
-            rss = self._rss(data)
+            rss = self._rss(data, sample_weight)
             aic = n * np.log(rss / float(n)) - penalty
             if self.verbose == 1:
                 print('rss: {:0.4f}, penalty:{:0.4f}, aic:{:0.4f}'.format(rss, penalty, aic))
         else:
-            log_likelihood = self.log_likelihood(data)
+            log_likelihood = self.log_likelihood(data, sample_weight)
             aic = log_likelihood - penalty
         if self.verbose == 1:
             print('log_likelihood: {:0.4f}, penalty:{:0.4f}, aic:{:0.4f}'.format(log_likelihood, penalty, aic))
         return aic
+
+    def score(self, data=None, sample_weight=None):
+        """
+        Computes AIC, BIC, log likelihood and inertia of the best restart from the statistics kept by `fit`,
+        without recomputing covariances or distances.
+
+        Parameters
+        ----------
+        data: input data
+            Only needed when use_rss is True.
+        sample_weight: weight of each data point, or None for unit weights
+            Only used when use_rss is True.
+
+        Returns
+        -------
+        dict
+            aic, bic, log_likelihood, inertia
+        """
+        n, d = self._n_samples, self.cluster_centers_.shape[1]  # n is the total weight of a weighted fit
+        free_parameters = self._free_parameters(d)
+        if self.use_rss:
+            if data is None:
+                raise ValueError('data is required to compute scores when use_rss is True.')
+            data = np.array(data)
+            rss = self._rss(data, check_sample_weight(sample_weight, data.shape[0]))
+            fit_term = n * np.log(rss / float(n))
+        else:
+            fit_term = self.best_log_likelihood_
+        return dict(aic=fit_term - free_parameters, bic=fit_term - 0.5 * free_parameters * np.log(n),
+                    log_likelihood=self.best_log_likelihood_, inertia=self.best_inertia_)
@@ -0,0 +1,436 @@
+"""
+Stacked multi-restart engine for SF_KMeans.
+
+Advances all n_init restarts in lockstep as stacked arrays (restarts x clusters x ...), so every iteration is a
+handful of batched linear algebra calls instead of one Python loop per restart. Restarts that have converged are
+masked out of later iterations.
+
+Distances and second moments are computed from the outer products of the data points, which takes
+O(n * dim^2) memory, so this engine is meant for datasets with a few thousand rows where per-iteration Python
+overhead dominates the arithmetic.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import copy
+
+import numpy as np
+
+from .factorization import CovarianceFactors
+from .cluster_statistics import ClusterStatistics, covariances_from_statistics
+
+
+def stacked_memory_bytes(n, n_features, n_clusters, n_restarts):
+    """
+    Estimates the bytes the stacked engine allocates: the outer products of the data points, plus the distances,
+    their temporaries and the one-hot labels of all restarts, each of (n_restarts, number of data points, n_clusters)
+    values.
+
+    Parameters
+    ----------
+    n: number of data points
+    n_features: int
+    n_clusters: int
+    n_restarts: int
+
+    Returns
+    -------
+    int
+    """
+    return 8 * (n * n_features ** 2 + 3 * n_restarts * n_clusters * n)
+
+
+def stacked_squared_distances(data, outer, cluster_centers, inv_covar_matrices):
+    """
+    Computes squared Mahalanobis distances of all data points from the cluster centers of every restart using
+    x^T VI x - 2 x^T VI c + c^T VI c, which turns into two matrix multiplies over all restarts at once.
+
+    Parameters
+    ----------
+    data: numpy array of input data. Shape: (number of data points, dim)
+    outer: outer products of the data points. Shape: (number of data points, dim * dim)
+    cluster_centers: cluster centers of each restart. Shape: (n_restarts, n_clusters, dim)
+    inv_covar_matrices: inverse covariance matrices of each restart. Shape: (n_restarts, n_clusters, dim, dim)
+
+    Returns
+    -------
+    numpy array of squared distances. Shape: (n_restarts, number of data points, n_clusters)
+    """
+    n_restarts, n_clusters, n_features = cluster_centers.shape
+    inv_centers = np.einsum('rkij,rkj->rki', inv_covar_matrices, cluster_centers)
+    # One matrix multiply per restart, each producing a contiguous (number of data points, n_clusters) block
+    inv_covar_flat = inv_covar_matrices.reshape(n_restarts, n_clusters, n_features ** 2)
+    distances = np.matmul(outer, inv_covar_flat.transpose(0, 2, 1))
+    distances -= 2 * np.matmul(data, inv_centers.transpose(0, 2, 1))
+    distances += np.einsum('rki,rki->rk', cluster_centers, inv_centers)[:, np.newaxis, :]
+    np.maximum(distances, 0, out=distances)  # rounding can make distances of points at a center negative
+    return distances
+
+
+def stacked_statistics(data, outer, labels, n_clusters, sample_weight=None):
+    """
+    Computes the per-cluster counts, means and scatter matrices of every restart with matrix multiplies by the
+    one-hot label matrix.
+
+    Parameters
+    ----------
+    data: numpy array of input data, preferably centered. Shape: (number of data points, dim)
+    outer: outer products of the data points. Shape: (number of data points, dim * dim)
+    labels: cluster labels of each restart. Shape: (n_restarts, number of data points)
+    n_clusters: int
+    sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+        With weights, counts are the total weight of each cluster.
+
+    Returns
+    -------
+    counts, means, scatters. Shapes: (n_restarts, n_clusters), (n_restarts, n_clusters, dim),
+    (n_restarts, n_clusters, dim, dim)
+    """
+    n_restarts, n = labels.shape
+    n_features = data.shape[1]
+    one_hot = np.zeros((n_restarts * n_clusters, n))
+    one_hot[labels + n_clusters * np.arange(n_restarts)[:, np.newaxis], np.arange(n)] = \
+        1 if sample_weight is None else sample_weight
+    counts = one_hot.sum(axis=1).reshape(n_restarts, n_clusters)
+    sums = one_hot.dot(data).reshape(n_restarts, n_clusters, n_features)
+    moments = one_hot.dot(outer).reshape(n_restarts, n_clusters, n_features, n_features)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts[..., np.newaxis]
+    nonempty = counts > 0
+    means[~nonempty] = np.nan
+    scatters = moments - counts[..., np.newaxis, np.newaxis] * np.einsum('rki,rkj->rkij', means, means)
+    scatters[~nonempty] = 0.
+    return counts, means, scatters
+
+
+class StackedRestarts(object):
+    """
+    Runs the restarts of an SF_KMeans object in lockstep. Uses the parameters of the SF_KMeans object and follows
+    the same steps as SF_KMeans._fit, _inertia and log_likelihood.
+    """
+    def __init__(self, kmeans, data, sample_weight=None):
+        """
+        Parameters
+        ----------
+        kmeans: SF_KMeans object whose parameters are used
+        data: numpy array of input data
+        sample_weight: weight of each data point, or None for unit weights. Shape: (number of data points)
+        """
+        self.kmeans = kmeans
+        data = np.asarray(data, dtype=float)
+        self.n, self.n_features = data.shape
+        self.sample_weight = sample_weight
+        # Everything is computed on centered data, which leaves distances and covariances unchanged
+        self.shift = data.mean(axis=0)
+        self.data = data - self.shift
+        self.outer = np.einsum('ni,nj->nij', self.data, self.data).reshape(self.n, self.n_features ** 2)
+        self._global_factors = self._global_covariance_factors(kmeans, data)
+
+    def for_model(self, kmeans):
+        """
+        Returns an engine that runs the restarts of another SF_KMeans object on the same data, sharing the
+        centered data and outer products of this one.
+
+        Parameters
+        ----------
+        kmeans: SF_KMeans object with the same n_clusters whose parameters are used
+
+        Returns
+        -------
+        StackedRestarts
+        """
+        stacked = copy.copy(self)
+        stacked.kmeans = kmeans
+        stacked._global_factors = self._global_covariance_factors(kmeans, self.data)
+        return stacked
+
+    def _global_covariance_factors(self, kmeans, data):
+        """ Factorizes the global covariance matrix of kmeans, which all restarts share """
+        if kmeans.covar_type != 'global':
+            return None
+        return CovarianceFactors(kmeans.covariances(np.zeros(self.n, dtype=int), cluster_centers=None, data=data,
+                                                    sample_weight=self.sample_weight),
+                                 shared=True)
+
+    def initial_assignment(self, seeds):
+        """
+        Seeds the cluster centers of each restart and assigns the data points to their nearest center using
+        Euclidean distance, as SF_KMeans._initial_assignment does for a single restart.
+
+        Parameters
+        ----------
+        seeds: list(int)
+
+        Returns
+        -------
+        labels, counts, centers (in centered coordinates), scatters of every restart
+        """
+        kmeans = self.kmeans
+        n_clusters = kmeans.n_clusters
+        centers = np.array([kmeans._init_centers(self.data + self.shift, seed, self.sample_weight)
+                            for seed in seeds]) - self.shift
+        identity = np.broadcast_to(np.eye(self.n_features), (len(seeds), n_clusters, self.n_features, self.n_features))
+        distances = stacked_squared_distances(self.data, self.outer, centers, identity)
+        labels = np.argmin(distances, axis=2)
+        counts, centers, scatters = stacked_statistics(self.data, self.outer, labels, n_clusters, self.sample_weight)
+        return labels, counts, centers, scatters
+
+    def fit(self, seeds, start=None):
+        """
+        Runs one restart for each seed.
+
+        Parameters
+        ----------
+        seeds: list(int)
+        start: initial assignment of every restart as returned by `initial_assignment`
+            If given, the restarts continue from it instead of computing it from seeds.
+
+        Returns
+        -------
+        list of dict, one for each restart, in the format of SF_KMeans._fit_restart
+        """
+        kmeans = self.kmeans
+        n_clusters = kmeans.n_clusters
+        n_restarts = len(seeds)
+
+        """ Initial assignment """
+        if start is None:
+            start = self.initial_assignment(seeds)
+        labels, counts, centers, scatters = [a.copy() for a in start]
+        identity = np.broadcast_to(np.eye(self.n_features), (n_restarts, n_clusters, self.n_features, self.n_features))
+
+        iteration_nums = np.full(n_restarts, kmeans.max_iter)
+        # Restarts in the Euclidean phase of a two-phase fit (see SF_KMeans.euclidean_tol) and the number of
+        # iterations each restart ran in it
+        euclidean = np.full(n_restarts, kmeans.euclidean_tol is not None)
+        euclidean_iteration_nums = np.zeros(n_restarts, dtype=int)
+        # Stopping rule that ended each restart and the log likelihood of its last assignment (see SF_KMeans.ll_tol)
+        stop_reasons = np.full(n_restarts, 'max_iter', dtype=object)
+        log_likelihoods = np.full(n_restarts, np.nan)
+        # Inertia of the last assignment step of each restart and the restarts abandoned by racing (see
+        # SF_KMeans.race_margin); restarts race against the best restart at the same iteration
+        inertias = np.full(n_restarts, np.inf)
+        pruned = np.zeros(n_restarts, dtype=bool)
+        tol_scale = 1.
+        if kmeans.scale_tol:
+            tol_scale = kmeans._tol_scale(ClusterStatistics(counts[0], centers[0], scatters[0]))
+        active = np.arange(n_restarts)
+        for i in range(kmeans.max_iter):
+            if kmeans.verbose == 2:
+                print('\riteration: {}/{}, active restarts: {}'.format(i + 1, kmeans.max_iter, active.shape[0]))
+
+            active_euclidean = euclidean[active]
+            if active_euclidean.all():
+                inv_covar_matrices, log_dets = identity[:active.shape[0]], None
+            elif not active_euclidean.any():
+                _, inv_covar_matrices, log_dets = self._factorize(counts, scatters)
+            else:
+                inv_covar_matrices = identity[:active.shape[0]].copy()
+                log_dets = np.zeros((active.shape[0], n_clusters))
+                _, inv_covar_matrices[~active_euclidean], log_dets[~active_euclidean] = self._factorize(
+                    counts[~active_euclidean], scatters[~active_euclidean])
+            if kmeans.metric == 'euclidean':
+                inv_covar_matrices = identity[:active.shape[0]]
+            distances = stacked_squared_distances(self.data, self.outer, centers[active], inv_covar_matrices)
+            distances[np.isnan(distances)] = float('inf')  # to deal with nans in the input data
+
+            active_labels = np.argmin(distances, axis=2)
+            nks = np.bincount((active_labels + n_clusters * np.arange(active.shape[0])[:, np.newaxis]).ravel(),
+                              minlength=active.shape[0] * n_clusters).reshape(active.shape[0], n_clusters)
+            for j in np.argwhere((nks == 0).any(axis=1)).flatten():  # restarts with at least one empty cluster
+                active_labels[j] = kmeans._reassign_empty_clusters(active_labels[j], distances[j])
+            old_labels = labels[active]
+            labels[active] = active_labels
+
+            counts, new_centers, scatters = stacked_statistics(self.data, self.outer, active_labels, n_clusters,
+                                                               self.sample_weight)
+            center_shift_total = ((centers[active] - new_centers) ** 2).sum(axis=(1, 2))
+            centers[active] = new_centers
+
+            euclidean_iteration_nums[active[active_euclidean]] = i + 1
+            if active_euclidean.any():
+                # Restarts that reach euclidean_tol switch to the covariance-aware iterations
+                euclidean[active[active_euclidean & (center_shift_total <= kmeans.euclidean_tol * tol_scale)]] = False
+            if kmeans.race_margin is not None or kmeans.ll_tol is not None:
+                assigned = self._assigned_distances(distances, active_labels)
+            if kmeans.race_margin is not None:
+                inertias[active] = np.where(active_euclidean, np.inf, assigned.sum(axis=1))
+            new_log_likelihoods = None
+            if kmeans.ll_tol is not None and log_dets is not None:
+                new_log_likelihoods = self._log_likelihoods(assigned, active_labels, counts, log_dets)
+            reasons = self._stop_reasons(old_labels, active_labels, center_shift_total, kmeans.tol * tol_scale,
+                                         log_likelihoods[active], new_log_likelihoods)
+            if new_log_likelihoods is not None:
+                log_likelihoods[active] = np.where(active_euclidean, np.nan, new_log_likelihoods)
+            converged = ~active_euclidean & reasons.astype(bool)  # reasons are None for restarts that continue
+            iteration_nums[active[converged]] = i + 1
+            stop_reasons[active[converged]] = reasons[converged]
+            done = converged
+            if kmeans.race_margin is not None and i + 1 >= kmeans.race_min_iter:
+                best_inertia = inertias[~pruned].min()
+                hopeless = ~converged & ~active_euclidean & \
+                    (inertias[active] > (1 + kmeans.race_margin) * best_inertia)
+                pruned[active[hopeless]] = True
+                iteration_nums[active[hopeless]] = i + 1
+                done = converged | hopeless
+            active = active[~done]
+            counts, scatters = counts[~done], scatters[~done]
+            if active.shape[0] == 0:
+                break
+
+        kept = np.flatnonzero(~pruned)
+        scores = iter(self.score(labels[kept], centers[kept]))
+        results = []
+        for r in range(n_restarts):
+            distances_computed = int(iteration_nums[r]) * self.n * n_clusters
+            if pruned[r]:
+                results.append(dict(pruned=True, iteration_num=int(iteration_nums[r]),
+                                    distances_computed=distances_computed, distances_skipped=0))
+                continue
+            result = next(scores)
+            result.update(labels=labels[r], cluster_centers=centers[r] + self.shift,
+                          iteration_num=int(iteration_nums[r]),
+                          euclidean_iteration_num=int(euclidean_iteration_nums[r]), stop_reason=stop_reasons[r],
+                          distances_computed=distances_computed, distances_skipped=0)
+            results.append(result)
+        return results
+
+    def _stop_reasons(self, old_labels, labels, center_shift_total, tol, old_log_likelihoods,
+                      log_likelihoods=None):
+        """
+        Checks the stopping rules of SF_KMeans._stop_reason for a stack of restarts.
+
+        Returns
+        -------
+        numpy array with the name of the rule that holds for each restart, or None to continue
+        """
+        kmeans = self.kmeans
+        reasons = np.full(labels.shape[0], None, dtype=object)
+        # Rules are assigned from the last to the first, so the first rule that holds wins
+        if log_likelihoods is not None:
+            with np.errstate(invalid='ignore'):
+                stalled = log_likelihoods - old_log_likelihoods <= kmeans.ll_tol * np.abs(old_log_likelihoods)
+            reasons[stalled] = 'log_likelihood'  # false for restarts without a previous log likelihood (nan)
+        changed = old_labels != labels
+        if kmeans.reassign_tol is not None:
+            if self.sample_weight is None:
+                fractions = changed.mean(axis=1)
+            else:
+                fractions = changed.dot(self.sample_weight) / self.sample_weight.sum()
+            reasons[fractions <= kmeans.reassign_tol] = 'reassigned'
+        reasons[center_shift_total <= tol] = 'center_shift'
+        reasons[~changed.any(axis=1)] = 'labels'
+        return reasons
+
+    def _assigned_distances(self, distances, labels):
+        """
+        (Weighted) distance of each data point from its assigned cluster center in every restart, from the squared
+        distances of the assignment step. Shape: (n_restarts, number of data points)
+        """
+        assigned = np.sqrt(np.take_along_axis(distances, labels[..., np.newaxis], axis=2)[..., 0])
+        assigned[~np.isfinite(assigned)] = 0  # to deal with nans in the input data
+        if self.sample_weight is not None:
+            assigned = assigned * self.sample_weight
+        return assigned
+
+    def _log_likelihoods(self, assigned, labels, counts, log_dets):
+        """
+        Computes SF_KMeans._assignment_log_likelihood for a stack of restarts from the distances returned by
+        `_assigned_distances`. Shape: (n_restarts)
+        """
+        n_restarts, n_clusters = counts.shape
+        distance_sums = np.bincount((labels + n_clusters * np.arange(n_restarts)[:, np.newaxis]).ravel(),
+                                    weights=assigned.ravel(),
+                                    minlength=n_restarts * n_clusters).reshape(n_restarts, n_clusters)
+        n, d = counts[0].sum(), self.n_features
+        with np.errstate(divide='ignore', invalid='ignore'):
+            term_1 = counts * (np.log(counts / n) - 0.5 * d * np.log(2 * np.pi) - 0.5 * log_dets)
+        return np.nan_to_num(term_1).sum(axis=1) - 0.5 * distance_sums.sum(axis=1)
+
+    def score(self, labels, centers):
+        """
+        Computes the statistics of every restart that SF_KMeans._final_statistics computes for a single one.
+
+        Parameters
+        ----------
+        labels: cluster labels of each restart. Shape: (n_restarts, number of data points)
+        centers: cluster centers of each restart, in centered coordinates. Shape: (n_restarts, n_clusters, dim)
+
+        Returns
+        -------
+        list of dict, one for each restart, with keys inertia, log_likelihood, covariances, log_dets, distances,
+        distance_sums and n_samples
+        """
+        kmeans = self.kmeans
+        d = self.n_features
+        n = self.n if self.sample_weight is None else self.sample_weight.sum()
+        n_restarts, n_clusters = centers.shape[:2]
+        counts, _, scatters = stacked_statistics(self.data, self.outer, labels, n_clusters, self.sample_weight)
+        covars, inv_covar_matrices, log_dets = self._factorize(counts, scatters)
+
+        distances = np.sqrt(stacked_squared_distances(self.data, self.outer, centers, inv_covar_matrices))
+        if kmeans.metric == 'euclidean':
+            identity = np.broadcast_to(np.eye(d), inv_covar_matrices.shape)
+            min_distances = np.sqrt(stacked_squared_distances(self.data, self.outer, centers, identity)).min(axis=2)
+        else:
+            min_distances = distances.min(axis=2)
+
+        assigned = np.take_along_axis(distances, labels[..., np.newaxis], axis=2)[..., 0]
+        weighted = np.nan_to_num(assigned)  # to deal with nans in the input data
+        if self.sample_weight is None:
+            inertias = min_distances.sum(axis=1)
+        else:
+            inertias = min_distances.dot(self.sample_weight)
+            weighted = weighted * self.sample_weight
+        distance_sums = np.bincount((labels + n_clusters * np.arange(n_restarts)[:, np.newaxis]).ravel(),
+                                    weights=weighted.ravel(),
+                                    minlength=n_restarts * n_clusters).reshape(n_restarts, n_clusters)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            term_1 = counts * (np.log(counts / n) - 0.5 * d * np.log(2 * np.pi) - 0.5 * log_dets)
+        log_likelihoods = term_1.sum(axis=1) - 0.5 * distance_sums.sum(axis=1)
+        if np.any(np.isnan(log_likelihoods)) or np.any(log_likelihoods == float('inf')):
+            raise Exception('ll is nan or inf')
+        return [dict(inertia=inertias[r], log_likelihood=log_likelihoods[r], covariances=covars[r],
+                     log_dets=log_dets[r], distances=assigned[r], distance_sums=distance_sums[r], n_samples=n)
+                for r in range(n_restarts)]
+
+    def _factorize(self, counts, scatters):
+        """
+        Computes the covariance matrices, their inverses and their log determinants for a stack of restarts,
+        following SF_KMeans.covariances: matrices with a non-positive determinant are replaced by the identity.
+
+        Returns
+        -------
+        covar_matrices, inv_covar_matrices, log_dets. Shapes: (n_restarts, n_clusters, dim, dim) for the matrices
+        and (n_restarts, n_clusters) for the log determinants
+        """
+        kmeans = self.kmeans
+        n_restarts, n_clusters, d = scatters.shape[:3]
+        if self._global_factors is not None:
+            shape = (n_restarts, n_clusters, d, d)
+            covars = np.broadcast_to(np.asarray(self._global_factors.matrices), shape)
+            inverse = np.broadcast_to(self._global_factors.inverse, shape)
+            log_dets = np.broadcast_to(self._global_factors.log_det, (n_restarts, n_clusters))
+            return covars, inverse, log_dets
+
+        covars = covariances_from_statistics(counts, scatters, kmeans.covar_type, kmeans.covar_tied,
+                                             kmeans._min_members)
+        if kmeans.covar_tied:
+            factors = CovarianceFactors(covars[:, 0])  # one distinct matrix per restart
+        else:
+            factors = CovarianceFactors(covars.reshape(n_restarts * n_clusters, d, d))
+        invalid = factors.sign <= 0
+        for idx in np.argwhere(invalid).flatten():
+            factors.set_identity(idx)
+
+        inverse = factors.inverse
+        log_dets = factors.log_det
+        if kmeans.covar_tied:
+            inverse = np.repeat(inverse[:, np.newaxis], n_clusters, axis=1)
+            log_dets = np.repeat(log_dets[:, np.newaxis], n_clusters, axis=1)
+            invalid = np.repeat(invalid, n_clusters)
+        covars = covars.reshape(n_restarts * n_clusters, d, d)
+        covars[invalid] = np.eye(d)
+        return (covars.reshape(n_restarts, n_clusters, d, d), inverse.reshape(n_restarts, n_clusters, d, d),
+                log_dets.reshape(n_restarts, n_clusters))
@@ -0,0 +1,218 @@
+"""
+Out-of-core variant of SF_KMeans for datasets that do not fit in memory.
+
+The data is read as a sequence of row blocks, from a numpy array or numpy.memmap, from separately stored columns
+(ColumnStack), or from a function that returns a new iterator over row blocks on every call (for example, chunks
+of a CSV file). Each iteration
+assigns the data points and accumulates the per-cluster statistics in one sequential scan, so only one block
+of data is in memory at a time. Labels and the distance of each data point from its cluster center are the
+only arrays with one entry per data point.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import numpy as np
+from sklearn.utils import check_random_state
+
+from .sf_kmeans import SF_KMeans
+from .cluster_statistics import ClusterStatistics
+
+
+class ColumnStack(object):
+    """
+    Columns stored as separate arrays, such as one numpy.memmap per column, read as one array of rows. Only the
+    requested rows are stacked, so RowBlocks reads one block of rows at a time without copying the whole data.
+
+    Attributes
+    ----------
+    columns: list of numpy arrays or numpy.memmap of the same length
+    """
+    def __init__(self, columns):
+        self.columns = list(columns)
+
+    @property
+    def shape(self):
+        return self.columns[0].shape[0], len(self.columns)
+
+    def __getitem__(self, rows):
+        """ Rows as a float numpy array; rows is a slice or an array of row indices """
+        return np.column_stack([np.asarray(column[rows], dtype=float) for column in self.columns])
+
+
+class RowBlocks(object):
+    """
+    Data read one block of rows at a time.
+
+    Attributes
+    ----------
+    source: numpy array, numpy.memmap or ColumnStack, or a function that returns a new iterator over blocks of rows
+    block_rows: number of rows in each block of an array source
+    transform: function applied to each block of rows, or None
+    """
+    def __init__(self, source, block_rows=65536, transform=None):
+        if not callable(source) and not hasattr(source, 'shape'):
+            raise TypeError('source must be an array or a function that returns an iterator over blocks of rows; '
+                            'iterators can only be read once.')
+        self.source = source
+        self.block_rows = block_rows
+        self.transform = transform
+        self._shape = None if callable(source) else source.shape
+
+    @property
+    def shape(self):
+        """ (number of data points, dim); a function source is scanned once to find it """
+        if self._shape is None:
+            n, d = 0, None
+            for _, block in self.blocks():
+                n, d = n + block.shape[0], block.shape[1]
+            self._shape = (n, d)
+        return self._shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def blocks(self):
+        """
+        Iterates over the data one block of rows at a time.
+
+        Yields
+        ------
+        index of the first row of the block, block of rows as a float numpy array
+        """
+        if callable(self.source):
+            blocks = self.source()
+        else:
+            blocks = (self.source[start:start + self.block_rows]
+                      for start in range(0, self.source.shape[0], self.block_rows))
+        start = 0
+        for block in blocks:
+            block = np.asarray(block, dtype=float)
+            if self.transform is not None:
+                block = self.transform(block)
+            yield start, block
+            start += block.shape[0]
+
+    def take(self, indices):
+        """
+        Reads the rows at the given sorted indices.
+
+        Parameters
+        ----------
+        indices: sorted numpy array of row indices
+
+        Returns
+        -------
+        numpy array. Shape: (len(indices), dim)
+        """
+        if not callable(self.source):
+            rows = np.asarray(self.source[indices], dtype=float)
+            return rows if self.transform is None else self.transform(rows)
+        rows = []
+        for start, block in self.blocks():
+            first, last = np.searchsorted(indices, [start, start + block.shape[0]])
+            rows.append(block[indices[first:last] - start])
+        return np.concatenate(rows)
+
+    def mean_std(self):
+        """
+        Computes the mean and the standard deviation of each feature with one scan. Features with zero standard
+        deviation get 1, like sklearn.preprocessing.scale.
+
+        Returns
+        -------
+        mean, std. Shape of each: (dim)
+        """
+        n, mean, squares = 0, 0., 0.
+        for _, block in self.blocks():
+            block_mean = block.mean(axis=0)
+            block_squares = ((block - block_mean) ** 2).sum(axis=0)
+            # Pairwise update of Chan, Golub and LeVeque, see ClusterStatistics.merge
+            total = n + block.shape[0]
+            squares = squares + block_squares + (block_mean - mean) ** 2 * n * block.shape[0] / total
+            mean = mean + (block_mean - mean) * block.shape[0] / total
+            n = total
+        std = np.sqrt(squares / n)
+        std[std == 0] = 1.
+        return mean, std
+
+    def standardized(self):
+        """ Returns the data scaled to zero mean and unit variance, like sklearn.preprocessing.scale """
+        mean, std = self.mean_std()
+        transform = self.transform
+
+        def scale(block):
+            if transform is not None:
+                block = transform(block)
+            return (block - mean) / std
+
+        return RowBlocks(self.source, self.block_rows, scale)
+
+
+class StreamingSF_KMeans(SF_KMeans):
+    """
+    SF_KMeans fit with sequential scans over RowBlocks. Arrays passed to `fit` are read in blocks of block_rows
+    without being copied. Restarts always run with the loop engine and compute all distances. Duplicate rows
+    are not collapsed, because that needs the whole dataset in memory.
+
+    The initial cluster centers are picked with the init strategy from a uniform random sample of init_size data
+    points (default: the larger of 100 * n_clusters and 10000).
+    """
+    def __init__(self, n_clusters=2, block_rows=65536, init_size=None, **kwargs):
+        kwargs['engine'] = 'loop'
+        kwargs['compress_duplicates'] = False
+        super(StreamingSF_KMeans, self).__init__(n_clusters=n_clusters, **kwargs)
+        self.block_rows = block_rows
+        self.init_size = init_size
+
+    def _prepare_data(self, data, copy=True):
+        """ Wraps data in RowBlocks; the data is never copied """
+        if isinstance(data, RowBlocks):
+            return data
+        return RowBlocks(data, self.block_rows)
+
+    def _is_chunked(self, data):
+        return True
+
+    def _row_blocks(self, data):
+        return data.blocks()
+
+    def _cluster_statistics(self, data, labels, sample_weight=None, workspace=None):
+        # Blocks are small and of varying size, so the statistics of a scan use no workspace
+        return self._scan_statistics(data, labels, self.n_clusters, sample_weight)
+
+    def _scan_statistics(self, data, labels, n_clusters, sample_weight=None):
+        """ ClusterStatistics of labels with n_clusters clusters, computed with one scan """
+        statistics = None
+        for start, block in data.blocks():
+            rows = slice(start, start + block.shape[0])
+            block_weight = None if sample_weight is None else sample_weight[rows]
+            block = ClusterStatistics.from_labels(block, labels[rows], n_clusters, block_weight)
+            statistics = block if statistics is None else statistics.merge(block)
+        return statistics
+
+    def _init_centers(self, data, random_state=None, sample_weight=None):
+        """ Picks the initial cluster centers using the init strategy on a random sample of the data """
+        random_state = check_random_state(random_state)
+        n = data.shape[0]
+        init_size = self.init_size or max(100 * self.n_clusters, 10000)
+        if init_size >= n:
+            indices = np.arange(n)
+        else:
+            indices = np.unique(random_state.randint(0, n, init_size))
+        sample_weight = None if sample_weight is None else sample_weight[indices]
+        return super(StreamingSF_KMeans, self)._init_centers(data.take(indices), random_state, sample_weight)
+
+    def _split_worst_cluster(self, data, labels, n_clusters, sample_weight=None):
+        """ See `SF_KMeans._split_worst_cluster`; each pass over the data is a scan """
+        statistics = self._scan_statistics(data, labels, n_clusters, sample_weight)
+        worst = np.argmax(np.trace(statistics.scatters, axis1=1, axis2=2))
+        eigenValues, eigenVectors = np.linalg.eigh(statistics.scatters[worst])
+        axis = eigenVectors[:, -1]  # eigenvalues are in ascending order
+        labels = labels.copy()
+        for start, block in data.blocks():
+            block_labels = labels[start:start + block.shape[0]]  # view, so labels is updated in place
+            members = np.argwhere(block_labels == worst).flatten()
+            side = (block[members] - statistics.means[worst]).dot(axis) > 0
+            block_labels[members[side]] = n_clusters
+        statistics = self._scan_statistics(data, labels, n_clusters + 1, sample_weight)
+        return labels, statistics.means
@@ -0,0 +1,74 @@
+"""
+Sample weights and the compression of duplicate data points into weighted unique data points.
+
+A data point with weight w counts as w identical data points in the cluster statistics, the inertia and the
+log likelihood, so clustering the unique rows of a dataset with their multiplicities as weights gives the same
+cluster centers, covariances and scores as clustering the dataset itself.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import numpy as np
+
+# Fraction of the rows that must be duplicates for SF_KMeans to collapse them; below it, the smaller data does not
+# pay for the sort that finds the duplicates
+MIN_DUPLICATES = 0.1
+
+
+def check_sample_weight(sample_weight, n):
+    """
+    Validates sample weights.
+
+    Parameters
+    ----------
+    sample_weight: weight of each data point, or None
+    n: number of data points
+
+    Returns
+    -------
+    float numpy array of weights, or None if sample_weight is None
+    """
+    if sample_weight is None:
+        return None
+    sample_weight = np.asarray(sample_weight, dtype=float)
+    if sample_weight.shape != (n,):
+        raise ValueError('sample_weight has shape {}, expected ({},).'.format(sample_weight.shape, n))
+    if np.any(sample_weight < 0) or not np.all(np.isfinite(sample_weight)):
+        raise ValueError('sample_weight must be finite and non-negative.')
+    return sample_weight
+
+
+def collapse_duplicates(data, sample_weight=None, min_duplicates=0.):
+    """
+    Collapses identical rows of data into unique rows weighted by their total weight. The unique rows keep the order
+    of their first occurrence in data, so data without duplicates is returned in its own order.
+
+    Finding the duplicates sorts the rows, which costs O(n log n) whether or not there are any.
+
+    Parameters
+    ----------
+    data: numpy array. Shape: (number of data points, dim)
+    sample_weight: weight of each data point, or None for unit weights
+    min_duplicates: float
+        fraction of the data points that must be duplicates of an earlier row for the rows to be collapsed
+
+    Returns
+    -------
+    unique rows, weight of each unique row, index of the unique row of each data point
+        Shapes: (number of unique rows, dim), (number of unique rows), (number of data points)
+        data[i] == unique_rows[inverse[i]] for every data point i
+        None if fewer than min_duplicates of the data points are duplicates
+    """
+    data = np.asarray(data)
+    _, first_index, inverse = np.unique(data, axis=0, return_index=True, return_inverse=True)
+    n = data.shape[0]
+    if n == 0 or (n - first_index.shape[0]) < min_duplicates * n:
+        return None
+    inverse = inverse.reshape(-1)  # numpy 2.0 returns the inverse with the shape of the input along the axis
+    order = np.argsort(first_index)  # unique rows in the order of their first occurrence
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0])
+    inverse = rank[inverse]
+    unique_rows = data[first_index[order]]
+    weights = np.bincount(inverse, weights=sample_weight, minlength=unique_rows.shape[0])
+    return unique_rows, weights, inverse
@@ -0,0 +1,61 @@
+"""
+Scratch buffers reused across the iterations and restarts of SF_KMeans.
+
+The assignment step needs an array of (number of data points, n_clusters) distances, and the cluster statistics
+need a copy of the data sorted by label, every iteration. Allocating them anew every iteration of every restart
+churns the allocator and, with large data, makes the peak memory depend on when the garbage collector runs.
+A Workspace keeps one buffer of each kind and hands it out again for as long as its shape fits, and the
+computations write into it with in-place (out=) NumPy operations.
+
+Authors: Nevena Golubovic, Angad Gill
+"""
+
+import threading
+
+import numpy as np
+
+
+class Workspace(object):
+    """
+    Named scratch buffers. A buffer is only valid until the next request for the same name, and a Workspace must
+    not be shared by threads; see ThreadWorkspaces.
+
+    Attributes
+    ----------
+    allocations: number of buffers allocated so far
+    """
+    def __init__(self):
+        self._buffers = {}
+        self.allocations = 0
+
+    def array(self, name, shape, dtype=float):
+        """
+        Returns the buffer called name, allocating it if it does not exist yet or has another shape or dtype.
+        Its contents are undefined.
+
+        Parameters
+        ----------
+        name: str
+        shape: tuple
+        dtype: numpy dtype
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+            self.allocations += 1
+        return buffer
+
+    @property
+    def nbytes(self):
+        """ Total size of the buffers in bytes """
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+
+class ThreadWorkspaces(threading.local):
+    """
+    One Workspace for each thread, so restarts that run in a thread pool reuse the buffers of the restarts that ran
+    before them in the same thread.
+    """
+    def __init__(self):
+        self.workspace = Workspace()
@@ -33,7 +33,8 @@ def run_kmeans(data, n_clusters, covar_type, covar_tied, n_init):
     kmeans = sf_kmeans.SF_KMeans(n_clusters=n_clusters, covar_type=covar_type, covar_tied=covar_tied, n_init=n_init,
                                  verbose=0,min_members=50)
     kmeans.fit(data)
-    aic, bic = kmeans.aic(data), kmeans.bic(data)
+    scores = kmeans.score()
+    aic, bic = scores['aic'], scores['bic']
     labels = [int(l) for l in kmeans.labels_]
     return aic, bic, labels
 
@@ -0,0 +1,112 @@
+"""
+Tests of the dataset cache, run with pytest from this directory. S3 is replaced by local files; importing the
+cache still needs the dependencies of utils.
+
+Author: Angad Gill, Nevena Golubovic
+"""
+import os
+import time
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('utils')
+
+import dataset_cache
+from dataset_cache import DatasetCache, evict_least_recently_used
+
+FILE_BYTES = 100
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """ Fake S3: download_from_s3 writes FILE_BYTES bytes named after the key and counts the downloads """
+    downloads = []
+
+    def download_from_s3(s3_file_key, filename=None):
+        time.sleep(0.01)
+        filename = filename or '{}.download'.format(s3_file_key)
+        with open(filename, 'w') as f:
+            f.write(s3_file_key[:1] * FILE_BYTES)
+        downloads.append(s3_file_key)
+        return filename
+
+    def s3_object_info(s3_file_key):
+        raise AssertionError('the version is given to every read')
+
+    monkeypatch.setattr(dataset_cache, 'download_from_s3', download_from_s3)
+    monkeypatch.setattr(dataset_cache, 's3_object_info', s3_object_info)
+    return downloads
+
+
+def read_text(filename):
+    with open(filename) as f:
+        return f.read()
+
+
+def read_frame(filename):
+    return pd.DataFrame({'value': [float(len(read_text(filename)))] * 10})
+
+
+def test_memory_tier_evicts_least_recently_used(tmp_path, s3, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))  # downloads that are not kept on disk go to the working directory
+    size = int(pd.DataFrame({'value': [0.] * 10}).memory_usage(deep=True).sum())
+    cache = DatasetCache(int(2.5 * size), 0, str(tmp_path / 'disk'))
+    for key in ('a', 'b', 'a', 'c'):
+        cache.read(key, read_frame, version='1', size=FILE_BYTES)
+    # a was used after b, so c evicted b
+    sources = [cache.read(key, read_frame, version='1', size=FILE_BYTES)[1]['read_source'] for key in ('a', 'c', 'b')]
+    assert sources == ['memory', 'memory', 's3']
+    assert s3 == ['a', 'b', 'c', 'b']
+    assert cache.memory_hits == 3 and cache.misses == 4
+    assert cache._memory_size == sum(entry_size for _, entry_size in cache._memory.values()) <= cache.memory_bytes
+
+
+def test_add_to_memory_replaces_and_skips_oversized(tmp_path):
+    cache = DatasetCache(100, 0, str(tmp_path))
+    cache._add_to_memory('a', 'first', 60)
+    cache._add_to_memory('a', 'second', 30)
+    assert cache._memory['a'] == ('second', 30) and cache._memory_size == 30
+    cache._add_to_memory('b', 'too large', 101)
+    assert 'b' not in cache._memory and cache._memory_size == 30
+    cache._add_to_memory('c', 'evicts a', 80)
+    assert list(cache._memory) == ['c'] and cache._memory_size == 80
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path, s3):
+    directory = tmp_path / 'disk'
+    cache = DatasetCache(0, int(2.5 * FILE_BYTES), str(directory))
+    for age, key in ((30, 'a'), (20, 'b')):
+        cache.read(key, read_text, version='1', size=FILE_BYTES)
+        old = time.time() - age
+        os.utime(cache._disk_filename(key, '1'), (old, old))
+    data, details = cache.read('a', read_text, version='1', size=FILE_BYTES)  # a becomes the most recently used
+    assert data == 'a' * FILE_BYTES and details['read_source'] == 'disk'
+    cache.read('c', read_text, version='1', size=FILE_BYTES)
+    assert sorted(os.listdir(str(directory))) == sorted(os.path.basename(cache._disk_filename(key, '1'))
+                                                       for key in ('a', 'c'))
+    assert cache.read('b', read_text, version='1', size=FILE_BYTES)[1]['read_source'] == 's3'
+    assert cache.disk_hits == 1 and s3 == ['a', 'b', 'c', 'b']
+
+
+def test_evict_least_recently_used_keeps_keep(tmp_path):
+    now = time.time()
+    for age, name in ((30, 'old.cached'), (20, 'new.cached'), (10, 'other.txt'), (40, 'keep.cached')):
+        (tmp_path / name).write_text('x' * FILE_BYTES)
+        os.utime(str(tmp_path / name), (now - age, now - age))
+    evict_least_recently_used(str(tmp_path), '.cached', 2 * FILE_BYTES, str(tmp_path / 'keep.cached'))
+    assert sorted(os.listdir(str(tmp_path))) == ['keep.cached', 'new.cached', 'other.txt']
+    # keep is never deleted, even if it alone exceeds max_bytes
+    evict_least_recently_used(str(tmp_path), '.cached', 0, str(tmp_path / 'keep.cached'))
+    assert sorted(os.listdir(str(tmp_path))) == ['keep.cached', 'other.txt']
+
+
+def test_read_details(tmp_path, s3):
+    cache = DatasetCache(0, 10 * FILE_BYTES, str(tmp_path / 'disk'))
+    _, details = cache.read('a', read_text, version='1', size=FILE_BYTES)
+    assert details == dict(read_source='s3', read_time_saved=None)
+    _, details = cache.read('a', read_text, version='1', size=FILE_BYTES)
+    assert details['read_source'] == 'disk' and details['read_time_saved'] > 0
+    # A new version of the file is a new entry
+    _, details = cache.read('a', read_text, version='2', size=FILE_BYTES)
+    assert details == dict(read_source='s3', read_time_saved=None)
@@ -0,0 +1,176 @@
+"""
+Tests of the sf_kmeans package, run with pytest from this directory.
+
+Author: Angad Gill, Nevena Golubovic
+"""
+import numpy as np
+
+from sf_kmeans.sf_kmeans import SF_KMeans
+from sf_kmeans.streaming import RowBlocks, StreamingSF_KMeans
+from sf_kmeans.multi_config import MultiConfigKMeans
+from sf_kmeans.weights import collapse_duplicates
+from sf_kmeans.minibatch import MiniBatchSF_KMeans
+from sf_kmeans.coreset import CoresetSF_KMeans
+from sf_kmeans.seeding import kmeans_plusplus, kmeans_parallel, farthest_traversal
+
+BLOB_CENTERS = ((0, 0), (6, 0), (0, 6))
+
+
+def blobs(n_per_cluster=300, centers=BLOB_CENTERS, random_state=0):
+    random_state = np.random.RandomState(random_state)
+    return np.vstack([random_state.randn(n_per_cluster, len(center)) + center for center in centers])
+
+
+def test_streaming_fit():
+    data = blobs()
+    kmeans = StreamingSF_KMeans(n_clusters=3, n_init=2, block_rows=100, random_state=0)
+    kmeans.fit(RowBlocks(data, 100))
+    assert kmeans.labels_.shape == (len(data),)
+    assert np.bincount(kmeans.labels_, minlength=3).min() > 0
+    assert np.isfinite(kmeans.score()['bic'])
+
+
+def test_streaming_iter_path():
+    data = blobs()
+    kmeans = StreamingSF_KMeans(n_clusters=1, n_init=2, block_rows=100, random_state=0)
+    fitted = [(model.n_clusters, model.score()['bic']) for model in kmeans.iter_path(data, [1, 2, 3])]
+    assert [k for k, _ in fitted] == [1, 2, 3]
+    assert all(np.isfinite(bic) for _, bic in fitted)
+
+
+def test_streaming_multi_config():
+    data = blobs()
+    models = MultiConfigKMeans(n_clusters=3, covars=[('full', False), ('diag', True)], n_init=2, random_state=0,
+                               kmeans_class=StreamingSF_KMeans, block_rows=100).fit(data)
+    assert len(models) == 2
+    assert all(model.labels_.shape == (len(data),) for model in models)
+
+
+def test_collapse_duplicates_keeps_first_occurrence_order():
+    data = np.array([[3., 0.], [1., 0.], [3., 0.], [2., 0.], [1., 0.]])
+    unique_rows, weights, inverse = collapse_duplicates(data)
+    assert np.array_equal(unique_rows, [[3., 0.], [1., 0.], [2., 0.]])
+    assert np.array_equal(weights, [2., 2., 1.])
+    assert np.array_equal(unique_rows[inverse], data)
+    assert collapse_duplicates(data, min_duplicates=0.5) is None
+
+
+def test_compress_duplicates_without_duplicates_matches_uncompressed():
+    data = blobs()
+    for engine in ('loop', 'stacked'):
+        plain = SF_KMeans(n_clusters=3, n_init=2, random_state=0, engine=engine)
+        plain.fit(data)
+        compressed = SF_KMeans(n_clusters=3, n_init=2, random_state=0, engine=engine, compress_duplicates=True)
+        compressed.fit(data)
+        assert np.array_equal(plain.labels_, compressed.labels_)
+        assert plain.score()['bic'] == compressed.score()['bic']
+
+
+def test_scale_tol_on_unscaled_data():
+    data = blobs()
+    unscaled = data * 1000.
+    for engine in ('loop', 'stacked'):
+        # Off by default, so unscaled data keeps the absolute tolerance
+        default = SF_KMeans(n_clusters=3, n_init=2, random_state=0, engine=engine)
+        default.fit(unscaled)
+        absolute = SF_KMeans(n_clusters=3, n_init=2, random_state=0, engine=engine, scale_tol=False)
+        absolute.fit(unscaled)
+        assert np.array_equal(default.labels_, absolute.labels_)
+        assert default.iteration_num == absolute.iteration_num
+        # The relative tolerance makes the fit of unscaled data stop where the fit of the same data in other units does
+        relative = SF_KMeans(n_clusters=3, n_init=2, random_state=0, engine=engine, scale_tol=True)
+        relative.fit(unscaled)
+        reference = SF_KMeans(n_clusters=3, n_init=2, random_state=0, engine=engine, scale_tol=True)
+        reference.fit(data)
+        assert np.array_equal(relative.labels_, reference.labels_)
+        assert relative.iteration_num == reference.iteration_num
+
+
+def test_rss_score():
+    data = blobs()
+    for covar_type, covar_tied in (('full', False), ('diag', True), ('global', False)):
+        kmeans = SF_KMeans(n_clusters=3, n_init=2, random_state=0, covar_type=covar_type, covar_tied=covar_tied,
+                           use_rss=True)
+        kmeans.fit(data)
+        assert np.isfinite(kmeans.score(data)['bic'])
+        covar_matrices = kmeans.covariances(kmeans.labels_, cluster_centers=kmeans.cluster_centers_, data=data)
+        differences = data[:, np.newaxis, :] - kmeans.cluster_centers_
+        expected = np.einsum('nki,kij,nkj->nk', differences, np.linalg.inv(covar_matrices), differences)
+        assert np.isclose(kmeans._rss(data), expected.min(axis=1).sum())
+
+
+def test_bounded_assignment_matches_full():
+    data = blobs(centers=((0, 0), (6, 0), (0, 6), (6, 6), (3, 3)))
+    for params in (dict(metric='euclidean'), dict(covar_type='global')):
+        full = SF_KMeans(n_clusters=5, n_init=2, random_state=0, assignment='full', **params)
+        full.fit(data)
+        for assignment in ('hamerly', 'elkan'):
+            bounded = SF_KMeans(n_clusters=5, n_init=2, random_state=0, assignment=assignment, **params)
+            bounded.fit(data)
+            assert np.array_equal(bounded.labels_, full.labels_)
+            assert bounded.iteration_num == full.iteration_num
+            assert np.isclose(bounded.score()['bic'], full.score()['bic'])
+            assert bounded.distances_skipped_ > 0
+
+
+def test_bounded_assignment_skips_tied_covariances():
+    kmeans = SF_KMeans(n_clusters=3, n_init=2, random_state=0, covar_type='full', covar_tied=True, assignment='hamerly')
+    kmeans.fit(blobs())
+    assert kmeans.distances_skipped_ == 0
+
+
+def test_stacked_engine_matches_loop_engine():
+    data = blobs()
+    for covar_type in ('full', 'diag', 'spher', 'global'):
+        for covar_tied in (False, True):
+            fitted = []
+            for engine in ('loop', 'stacked'):
+                kmeans = SF_KMeans(n_clusters=3, n_init=3, random_state=0, covar_type=covar_type,
+                                   covar_tied=covar_tied, engine=engine)
+                kmeans.fit(data)
+                fitted += [kmeans]
+            loop, stacked = fitted
+            assert np.array_equal(stacked.labels_, loop.labels_), (covar_type, covar_tied)
+            assert stacked.iteration_num == loop.iteration_num, (covar_type, covar_tied)
+            assert np.isclose(stacked.score()['bic'], loop.score()['bic']), (covar_type, covar_tied)
+
+
+def assert_recovers_centers(cluster_centers, centers=BLOB_CENTERS, tol=0.3):
+    """ Every blob center has a fitted cluster center within tol, and vice versa """
+    distances = np.linalg.norm(np.asarray(centers)[:, np.newaxis, :] - cluster_centers, axis=2)
+    assert distances.min(axis=1).max() < tol
+    assert distances.min(axis=0).max() < tol
+
+
+def test_minibatch_partial_fit_recovers_centers():
+    data = blobs(n_per_cluster=1000)
+    data = data[np.random.RandomState(1).permutation(len(data))]
+    kmeans = MiniBatchSF_KMeans(n_clusters=3, random_state=0)
+    for start in range(0, len(data), 300):
+        kmeans.partial_fit(data[start:start + 300], random_state=0)
+    assert_recovers_centers(kmeans.cluster_centers_)
+    kmeans.final_pass(data)
+    assert kmeans.labels_.shape == (len(data),)
+    assert np.isfinite(kmeans.score()['bic'])
+
+
+def test_coreset_fit():
+    data = blobs(n_per_cluster=2000)
+    kmeans = CoresetSF_KMeans(n_clusters=3, coreset_size=600, n_init=2, random_state=0)
+    kmeans.fit(data)
+    assert len(kmeans.coreset_[0]) == 600
+    assert kmeans.coreset_error_ < 0.05
+    assert kmeans.labels_.shape == (len(data),)
+    assert np.array_equal(np.unique(kmeans.labels_), [0, 1, 2])
+    assert_recovers_centers(kmeans.cluster_centers_)
+
+
+def test_seeders_pick_distinct_reproducible_rows():
+    data = blobs()
+    for seeder in (kmeans_plusplus, kmeans_parallel, farthest_traversal):
+        centers, indices = seeder(data, 3, random_state=0)
+        assert centers.shape == (3, 2)
+        assert len(np.unique(indices)) == 3
+        assert np.array_equal(centers, data[indices])
+        again, again_indices = seeder(data, 3, random_state=0)
+        assert np.array_equal(again_indices, indices), seeder.__name__
@@ -0,0 +1,50 @@
+"""
+Tests of the pure helpers of the worker, run with pytest from this directory. Importing the worker needs its
+Celery, Flask and S3 dependencies.
+
+Author: Angad Gill, Nevena Golubovic
+"""
+import pytest
+
+pytest.importorskip('celery')
+pytest.importorskip('flask_sqlalchemy')
+pytest.importorskip('boto')
+pytest.importorskip('boto3')
+
+import worker
+from sf_kmeans.stacked import stacked_memory_bytes
+
+
+def test_stacked_engine_memory_budget(monkeypatch):
+    monkeypatch.setattr(worker, 'STACKED_ENGINE_MAX_ROWS', 10000)
+    monkeypatch.setattr(worker, 'KMEANS_MEMORY_BUDGET', stacked_memory_bytes(10000, 5, 10, 10))
+    assert worker.stacked_engine(10000, 5, 10, 10) == 'stacked'
+    assert worker.stacked_engine(10000, 300, 10, 10) == 'loop'
+    assert worker.stacked_engine(10000, 5, 11, 10) == 'loop'
+    assert worker.stacked_engine(10001, 2, 2, 1) == 'loop'
+    monkeypatch.setattr(worker, 'KMEANS_MEMORY_BUDGET', None)
+    assert worker.stacked_engine(10000, 300, 10, 10) == 'stacked'
+
+
+def test_chunk_groups_never_splits_a_group():
+    groups = [[(0,), (1,)], [(2,), (3,)], [(4,), (5,)]]
+    assert worker.chunk_groups(groups, 3) == [[groups[0]], [groups[1]], [groups[2]]]
+    assert worker.chunk_groups(groups, 4) == [[groups[0], groups[1]], [groups[2]]]
+    chunks = worker.chunk_groups(groups, 5)
+    assert [group for chunk in chunks for group in chunk] == groups
+
+
+def test_chunk_groups_gives_a_large_group_its_own_chunk():
+    small, large = [(0,)], [(1,), (2,), (3,), (4,)]
+    assert worker.chunk_groups([small, large, small], 2) == [[small], [large], [small]]
+    assert worker.chunk_groups([], 2) == []
+
+
+def test_task_chunk_size_is_clamped(monkeypatch):
+    monkeypatch.setattr(worker, 'TASK_CHUNK_VALUES', 1000)
+    monkeypatch.setattr(worker, 'TASK_CHUNK_MAX_SIZE', 50)
+    assert worker.task_chunk_size(0) == 50
+    assert worker.task_chunk_size(1) == 50
+    assert worker.task_chunk_size(100) == 10
+    assert worker.task_chunk_size(1000) == 1
+    assert worker.task_chunk_size(10 ** 9) == 1
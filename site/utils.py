@@ -5,7 +5,11 @@ Author: Angad Gill, Nevena Golubovic
 """
 import io
 import os
+import json
 import random
+import shutil
+import hashlib
+import tempfile
 import time
 import base64
 import urllib.parse
@@ -417,6 +421,26 @@ def generate_s3_file_key(job_id, filename):
     return '{}/{}/{}'.format(UPLOAD_FOLDER, job_id, filename)
 
 
+_euca_bucket = None  # bucket of the Walrus connection of this process, see `euca_bucket`
+
+
+def euca_bucket():
+    """
+    Returns the Eucalyptus S3 bucket. The Walrus connection is opened on the first call and reused by later calls
+    in the same process.
+
+    Returns
+    -------
+    boto.s3.bucket.Bucket
+    """
+    global _euca_bucket
+    if _euca_bucket is None:
+        s3conn = boto.connect_walrus(aws_access_key_id=EUCA_KEY_ID, aws_secret_access_key=EUCA_SECRET_KEY,
+                                     is_secure=False, port=8773, path=EUCA_S3_PATH, host=EUCA_S3_HOST)
+        _euca_bucket = s3conn.get_bucket(S3_BUCKET)
+    return _euca_bucket
+
+
 def upload_to_s3(filepath, filename, job_id):
     """
     Uploads a file to Eucalyptus S3.
@@ -441,14 +465,111 @@ def upload_to_s3(filepath, filename, job_id):
     # s3.meta.client.upload_file(filepath, S3_BUCKET, s3_file_key)
 
     """ Eucalyptus S3 code """
-    s3conn = boto.connect_walrus(aws_access_key_id=EUCA_KEY_ID, aws_secret_access_key=EUCA_SECRET_KEY, is_secure=False,
-                                 port=8773, path=EUCA_S3_PATH, host=EUCA_S3_HOST)
-    euca_bucket = s3conn.get_bucket(S3_BUCKET)
-    k = boto.s3.key.Key(bucket=euca_bucket, name=s3_file_key)
+    k = boto.s3.key.Key(bucket=euca_bucket(), name=s3_file_key)
     k.set_contents_from_filename(filepath)
     return s3_file_key
 
 
+def upload_columns_to_s3(filepath, s3_file_key):
+    """
+    Uploads a columnar copy of a CSV file next to it in Eucalyptus S3, see `csv_to_columns`, so that readers
+    download and memory-map only the columns they need instead of parsing the CSV file. The manifest is uploaded
+    last, so a copy with a manifest is complete.
+
+    Parameters
+    ----------
+    filepath: str
+        Local path to the CSV file
+    s3_file_key: str
+        Eucalyptus S3 key of the uploaded CSV file
+
+    Returns
+    -------
+    dict
+        manifest, see `csv_to_columns`
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        manifest = csv_to_columns(filepath, directory)
+        for name in [column['file'] for column in manifest['columns'].values()] + ['manifest.json']:
+            k = boto.s3.key.Key(bucket=euca_bucket(), name=columns_file_key(s3_file_key, name))
+            k.set_contents_from_filename(os.path.join(directory, name))
+    finally:
+        shutil.rmtree(directory)
+    return manifest
+
+
+def s3_columns_manifest(s3_file_key):
+    """
+    Downloads the manifest of the columnar copy of an upload.
+
+    Parameters
+    ----------
+    s3_file_key: str
+        Eucalyptus S3 key of the uploaded CSV file
+
+    Returns
+    -------
+    dict
+        manifest, see `csv_to_columns`, or None if the upload has no columnar copy
+    """
+    k = euca_bucket().get_key(columns_file_key(s3_file_key, 'manifest.json'))
+    if k is None:
+        return None
+    return json.loads(k.get_contents_as_string().decode('utf-8'))
+
+
+def s3_to_columns(s3_file_key, columns=None):
+    """
+    Reads columns of an upload from its columnar copy, downloading only those columns. Falls back to
+    `s3_to_df` if the upload has no columnar copy or one of the columns is not in it.
+
+    Parameters
+    ----------
+    s3_file_key: str
+        Eucalyptus S3 file key
+    columns: list(str)
+        Names of the columns; all numeric columns if None
+
+    Returns
+    -------
+    Pandas DataFrame
+    """
+    manifest = s3_columns_manifest(s3_file_key)
+    if columns is None and manifest is not None:
+        columns = [c for c in manifest['header'] if c in manifest['columns']]
+    if manifest is None or any(c not in manifest['columns'] for c in columns):
+        data = s3_to_df(s3_file_key)
+        return data if columns is None else data.loc[:, columns]
+    arrays = []
+    for c in columns:
+        filename = download_from_s3(columns_file_key(s3_file_key, manifest['columns'][c]['file']))
+        try:
+            arrays += [read_column_file(filename, manifest['n_rows'])]
+        finally:
+            os.remove(filename)
+    return pd.DataFrame(dict(zip(columns, arrays)), columns=columns)
+
+
+def s3_column_names(s3_file_key):
+    """
+    Names of all columns of an upload, read from the manifest of its columnar copy if it has one.
+
+    Parameters
+    ----------
+    s3_file_key: str
+        Eucalyptus S3 file key
+
+    Returns
+    -------
+    list(str)
+    """
+    manifest = s3_columns_manifest(s3_file_key)
+    if manifest is None:
+        return list(s3_to_df(s3_file_key).columns)
+    return manifest['header']
+
+
 def s3_to_df(s3_file_key):
     """
     Downloads file from S3 and converts it to a Pandas DataFrame. Deletes the file from local disk when done.
@@ -462,23 +583,185 @@ def s3_to_df(s3_file_key):
     -------
     Pandas DataFrame
     """
-    # Add random number to file name to avoid collisions with other processes on the same machine
-    filename = '/tmp/{}_{}'.format(s3_file_key.replace('/', '_'), random.randint(1, 1e6))
+    filename = download_from_s3(s3_file_key)
+    df = pd.read_csv(filename)
+    os.remove(filename)
+    return df
+
+
+def columns_file_key(s3_file_key, name):
+    """
+    Eucalyptus S3 key of a file of the columnar copy of an upload, see `upload_columns_to_s3`.
+
+    Parameters
+    ----------
+    s3_file_key: str
+        Eucalyptus S3 key of the uploaded CSV file
+    name: str
+        'manifest.json' or the file name of a column in the manifest
+
+    Returns
+    -------
+    str
+    """
+    return '{}.columns/{}'.format(s3_file_key, name)
+
+
+def csv_to_columns(filename, directory, chunksize=65536):
+    """
+    Converts each numeric column of a CSV file to a file of raw float64 values in directory, one chunk of rows at
+    a time, and writes a manifest.json that describes them. Columns that are not numeric in every chunk are left
+    out.
+
+    Parameters
+    ----------
+    filename: str
+    directory: str
+    chunksize: int
+        Number of rows read at a time
+
+    Returns
+    -------
+    dict
+        manifest:
+            n_rows: number of rows
+            header: names of all columns of the CSV file
+            columns: column name -> dict(file=file name in directory, size=bytes, md5=hex digest of the file)
+    """
+    header = list(pd.read_csv(filename, nrows=0).columns)
+    files, hashes = {}, {}
+    numeric = None
+    n_rows = 0
+    try:
+        for chunk in pd.read_csv(filename, chunksize=chunksize):
+            if numeric is None:
+                numeric = [c for c in header if pd.api.types.is_numeric_dtype(chunk[c]) and
+                           not pd.api.types.is_bool_dtype(chunk[c])]
+                for c in numeric:
+                    files[c] = open(os.path.join(directory, '{}.float64'.format(header.index(c))), 'wb')
+                    hashes[c] = hashlib.md5()
+            for c in list(numeric):
+                if not pd.api.types.is_numeric_dtype(chunk[c]) or pd.api.types.is_bool_dtype(chunk[c]):
+                    numeric.remove(c)
+                    files.pop(c).close()
+                    os.remove(os.path.join(directory, '{}.float64'.format(header.index(c))))
+                    continue
+                values = chunk[c].values.astype('<f8').tobytes()
+                files[c].write(values)
+                hashes[c].update(values)
+            n_rows += chunk.shape[0]
+    finally:
+        for f in files.values():
+            f.close()
+
+    columns = {}
+    for c in numeric or []:
+        column_filename = '{}.float64'.format(header.index(c))
+        columns[c] = dict(file=column_filename, size=os.path.getsize(os.path.join(directory, column_filename)),
+                          md5=hashes[c].hexdigest())
+    manifest = dict(n_rows=n_rows, header=header, columns=columns)
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def read_column_file(filename, n_rows):
+    """
+    Memory-maps a column file written by `csv_to_columns`. The mapping stays valid after the file is deleted.
+
+    Parameters
+    ----------
+    filename: str
+    n_rows: int
+
+    Returns
+    -------
+    read-only numpy.memmap of float64, or an empty numpy array if n_rows is 0. Shape: (n_rows)
+    """
+    if n_rows == 0:
+        return np.empty(0)
+    return np.memmap(filename, dtype='<f8', mode='r', shape=(n_rows,))
+
+
+def csv_to_memmap(filename, columns, chunksize=65536):
+    """
+    Converts the given columns of a CSV file to a read-only memory-mapped numpy array, one chunk of rows at a
+    time. The array is stored in a temporary file next to filename, which is deleted once it is mapped.
+
+    Parameters
+    ----------
+    filename: str
+    columns: list(str)
+    chunksize: int
+        Number of rows read at a time
+
+    Returns
+    -------
+    numpy.memmap of float64. Shape: (number of rows, len(columns))
+    """
+    array_filename = '{}.float64'.format(filename)
+    n_rows = 0
+    with open(array_filename, 'wb') as f:
+        for chunk in pd.read_csv(filename, usecols=columns, chunksize=chunksize):
+            values = chunk.loc[:, columns].values.astype(np.float64)
+            f.write(values.tobytes())
+            n_rows += values.shape[0]
+    try:
+        if n_rows == 0:
+            return np.empty((0, len(columns)))
+        return np.memmap(array_filename, dtype=np.float64, mode='r', shape=(n_rows, len(columns)))
+    finally:
+        os.remove(array_filename)
+
+
+def download_from_s3(s3_file_key, filename=None):
+    """
+    Downloads file from S3 to local disk. The caller deletes the file when done.
+
+    Parameters
+    ----------
+    s3_file_key: str
+        Eucalyptus S3 file key
+    filename: str
+        Local file name to download to; by default a new file in /tmp
+
+    Returns
+    -------
+    str
+        Local file name
+    """
+    if filename is None:
+        # Add random number to file name to avoid collisions with other processes on the same machine
+        filename = '/tmp/{}_{}'.format(s3_file_key.replace('/', '_'), random.randint(1, 1e6))
 
     """ Amazon S3 code """
     # s3 = boto3.client('s3')
     # s3.download_file(S3_BUCKET, s3_file_key, filename)
 
     """ Eucalyptus S3 code """
-    s3conn = boto.connect_walrus(aws_access_key_id=EUCA_KEY_ID, aws_secret_access_key=EUCA_SECRET_KEY, is_secure=False,
-                                 port=8773, path=EUCA_S3_PATH, host=EUCA_S3_HOST)
-    euca_bucket = s3conn.get_bucket(S3_BUCKET)
-    k = boto.s3.key.Key(bucket=euca_bucket, name=s3_file_key)
+    k = boto.s3.key.Key(bucket=euca_bucket(), name=s3_file_key)
     k.get_contents_to_filename(filename)
+    return filename
 
-    df = pd.read_csv(filename)
-    os.remove(filename)
-    return df
+
+def s3_object_info(s3_file_key):
+    """
+    Looks up the ETag and size of a file in S3 without downloading it.
+
+    Parameters
+    ----------
+    s3_file_key: str
+        Eucalyptus S3 file key
+
+    Returns
+    -------
+    str, int
+        ETag without quotes, size in bytes
+    """
+    k = euca_bucket().get_key(s3_file_key)
+    if k is None:
+        raise KeyError('{} not found in S3'.format(s3_file_key))
+    return k.etag.strip('"'), k.size
 
 
 def job_to_data(job_id):
@@ -487,6 +770,11 @@ def job_to_data(job_id):
     return s3_to_df(s3_file_key)
 
 
+def job_to_columns(job_id, columns):
+    job = db.session.query(Job).filter_by(job_id=job_id).first()
+    return s3_to_columns(job.s3_file_key, columns)
+
+
 def get_viz_columns(job, x_axis, y_axis):
     # Return user selected visualization columns
     if x_axis is not None and y_axis is not None:
@@ -500,8 +788,7 @@ def get_viz_columns(job, x_axis, y_axis):
     if len(job_columns) >= 2:
         return job_columns[:2]
     # Return the first two data columns
-    data = job_to_data(job.job_id)
-    all_columns = data.columns
+    all_columns = s3_column_names(job.s3_file_key)
     preferred_columns = [c for c in all_columns if c.lower().strip() not
                          in EXCLUDE_COLUMNS][:2]
     if len(preferred_columns) == 2:
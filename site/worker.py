@@ -16,25 +16,69 @@ Amazon S3      MongoDB  <-------+   |
 
 Author: Angad Gill, Nevena Golubovic
 """
+import os
+import json
+import time
+from collections import OrderedDict
 from datetime import datetime
 from sf_kmeans import sf_kmeans
-from utils import s3_to_df
+from sf_kmeans.multi_config import MultiConfigKMeans
+from sf_kmeans.minibatch import MiniBatchSF_KMeans
+from sf_kmeans.streaming import RowBlocks, ColumnStack, StreamingSF_KMeans
+from sf_kmeans.coreset import CoresetSF_KMeans
+from sf_kmeans.stacked import stacked_memory_bytes
+from utils import csv_to_memmap, columns_file_key, read_column_file
+from utils import s3_object_info, download_from_s3, upload_columns_to_s3
+from dataset_cache import DatasetCache, PreparedData, SharedDataStore
 from celery import Celery
-from config import CELERY_BROKER
+from config import (CELERY_BROKER, KMEANS_N_JOBS, KMEANS_ASSIGNMENT,
+                    KMEANS_MEMORY_BUDGET, KMEANS_EUCLIDEAN_TOL,
+                    KMEANS_SCALE_TOL, KMEANS_REASSIGN_TOL, KMEANS_LL_TOL,
+                    KMEANS_RACE_MARGIN,
+                    STACKED_ENGINE_MAX_ROWS,
+                    MINIBATCH_MIN_ROWS, MINIBATCH_SIZE, FIT_K_PATH,
+                    FIT_COVARS_TOGETHER, TASK_CHUNK_SIZE, TASK_CHUNK_VALUES,
+                    TASK_CHUNK_MAX_SIZE, STREAMING_MIN_BYTES,
+                    STREAMING_BLOCK_ROWS, COMPRESS_DUPLICATES,
+                    CORESET_SIZE, DATASET_CACHE_MEMORY_BYTES,
+                    DATASET_CACHE_DISK_BYTES, DATASET_CACHE_DIR,
+                    PREPARED_DATA_PERSIST, SHARED_MEMORY_DIR,
+                    SHARED_MEMORY_BYTES)
 from sklearn import preprocessing
+import pandas as pd
 from models import Job, Task
 from flask_app import db
 import numpy as np
 
 app = Celery('jobs', broker=CELERY_BROKER)
+shared_data = None
+if SHARED_MEMORY_BYTES:
+    shared_data = SharedDataStore(SHARED_MEMORY_DIR, SHARED_MEMORY_BYTES)
+dataset_cache = DatasetCache(DATASET_CACHE_MEMORY_BYTES,
+                             DATASET_CACHE_DISK_BYTES, DATASET_CACHE_DIR,
+                             shared_data)
 
 
 @app.task
-def create_tasks(job_id, n_init, n_experiments, max_k, covars, columns, s3_file_key, scale):
+def create_tasks(job_id, n_init, n_experiments, max_k, covars, columns, s3_file_key, scale, path=FIT_K_PATH,
+                 covars_together=FIT_COVARS_TOGETHER, chunk_size=TASK_CHUNK_SIZE):
     """
     Creates all the tasks needed to complete a job.
     Adds database entries for each task and triggers an asynchronous
     functions to process the task.
+    If `path` is True, the tasks for all k of an experiment and covariance
+    type are processed together as one k-sweep by `work_path_task`.
+    Otherwise, if `covars_together` is True, the tasks for all covariance
+    types of an experiment and k are processed together by
+    `work_covars_task`.
+    The columnar copy of the file is built by a separate `create_columns`
+    task, so tasks start right away; tasks that start before it is done
+    read the CSV file itself.
+    If `chunk_size` is set, these task units are instead sent in chunks of
+    about `chunk_size` tasks, see `chunk_groups`, each processed by one
+    `work_chunk_task` that reads the data once and commits all its results
+    together. With 'auto', the chunk size is picked for the size of the
+    data by `task_chunk_size`.
 
     Parameters
     ----------
@@ -46,6 +90,9 @@ def create_tasks(job_id, n_init, n_experiments, max_k, covars, columns, s3_file_
     columns: list(str)
     s3_file_key: str
     scale: bool
+    path: bool
+    covars_together: bool
+    chunk_size: int, 'auto' or None
 
     Returns
     -------
@@ -56,33 +103,205 @@ def create_tasks(job_id, n_init, n_experiments, max_k, covars, columns, s3_file_
     # Add tasks to DB
     task_id = 0
     tasks = []
+    cells = []  # (experiment, task_id, k, covar_type, covar_tied) of each task
     print("creating tasks")
-    for _ in range(n_experiments):
+    for experiment in range(n_experiments):
         for k in range(1, max_k + 1):
             for covar in covars:
-                covar_type, covar_tied = covar.lower().split('-')
-                covar_tied = covar_tied == 'tied'
+                covar_type, covar_tied = parse_covar(covar)
                 task = Task(task_id=task_id, job_id=job_id, covar_type=covar_type,
                             covar_tied=covar_tied,
                             n_experiments=n_experiments, k=k, n_init=n_init,
                             s3_file_key=s3_file_key,
                             columns=columns, task_status=task_status)
                 tasks += [task]
+                cells += [(experiment, task_id, k, covar_type, covar_tied)]
                 task_id += 1
 
     response = db.session.add_all(tasks)
     db.session.commit()
 
+    create_columns.delay(s3_file_key)
+
     # Start workers
-    task_id = 0
-    for _ in range(n_experiments):
-        for k in range(1, max_k + 1):
-            for covar in covars:
-                covar_type, covar_tied = covar.lower().split('-')
-                covar_tied = covar_tied == 'tied'
-                work_task.delay(job_id, task_id, k, covar_type, covar_tied,
-                                n_init, s3_file_key, columns, scale)
-                task_id += 1
+    groups = group_cells(cells, path, covars_together)
+    if chunk_size is not None:
+        if chunk_size == 'auto':
+            chunk_size = task_chunk_size(data_values(s3_file_key, columns))
+        for chunk in chunk_groups(groups, chunk_size):
+            work_chunk_task.delay(job_id, chunk, n_init, s3_file_key, columns,
+                                  scale, path, covars_together)
+        return
+    for group in groups:
+        task_ids, ks, covar_types, covar_tieds = [list(c) for c in zip(*group)]
+        if path:
+            work_path_task.delay(job_id, task_ids, ks, covar_types[0],
+                                 covar_tieds[0], n_init, s3_file_key, columns,
+                                 scale)
+        elif covars_together:
+            work_covars_task.delay(job_id, task_ids, ks[0],
+                                   list(zip(covar_types, covar_tieds)),
+                                   n_init, s3_file_key, columns, scale)
+        else:
+            work_task.delay(job_id, task_ids[0], ks[0], covar_types[0],
+                            covar_tieds[0], n_init, s3_file_key, columns,
+                            scale)
+
+
+@app.task
+def create_columns(s3_file_key):
+    """
+    Uploads a columnar copy of an uploaded CSV file, see
+    `utils.upload_columns_to_s3`, so that tasks memory-map only their columns
+    instead of parsing the file. The copy is best-effort: if it cannot be
+    built, the error is logged and tasks read the CSV file itself. Tasks
+    also read the CSV file until the manifest of the copy, which is uploaded
+    last, exists.
+
+    Parameters
+    ----------
+    s3_file_key: str
+
+    Returns
+    -------
+    bool
+        True if the columnar copy was uploaded
+    """
+    filename = None
+    try:
+        filename = download_from_s3(s3_file_key)
+        upload_columns_to_s3(filename, s3_file_key)
+        return True
+    except Exception as e:
+        print(' columnar copy of {} failed: {!r}'.format(s3_file_key, e))
+        return False
+    finally:
+        if filename is not None and os.path.exists(filename):
+            os.remove(filename)
+
+
+def group_cells(cells, path, covars_together):
+    """
+    Groups the tasks of a job into the units processed by one fit: a k-sweep
+    of an experiment and covariance type if `path` is True, all covariance
+    types of an experiment and k if `covars_together` is True, and single
+    tasks otherwise.
+
+    Parameters
+    ----------
+    cells: list of (experiment, task_id, k, covar_type, covar_tied)
+    path: bool
+    covars_together: bool
+
+    Returns
+    -------
+    list of list of (task_id, k, covar_type, covar_tied)
+        groups in the order of their first task
+    """
+    groups = OrderedDict()
+    for experiment, task_id, k, covar_type, covar_tied in cells:
+        if path:
+            key = (experiment, covar_type, covar_tied)
+        elif covars_together:
+            key = (experiment, k)
+        else:
+            key = task_id
+        groups.setdefault(key, []).append((task_id, k, covar_type, covar_tied))
+    return list(groups.values())
+
+
+def chunk_groups(groups, chunk_size):
+    """
+    Packs consecutive groups of tasks into chunks of at most `chunk_size`
+    tasks. A group is never split, so a group larger than `chunk_size` is a
+    chunk of its own.
+
+    Parameters
+    ----------
+    groups: list of list
+        see `group_cells`
+    chunk_size: int
+
+    Returns
+    -------
+    list of list of list
+        groups of each chunk
+    """
+    chunks = []
+    chunk = []
+    n_tasks = 0
+    for group in groups:
+        if chunk and n_tasks + len(group) > chunk_size:
+            chunks += [chunk]
+            chunk = []
+            n_tasks = 0
+        chunk += [group]
+        n_tasks += len(group)
+    if chunk:
+        chunks += [chunk]
+    return chunks
+
+
+def task_chunk_size(n_values):
+    """
+    Number of tasks in a chunk for data with `n_values` values. Fits on small
+    data take less time than sending, starting and committing a task, so
+    their chunks hold many tasks; the chunk size falls in proportion to the
+    size of the data, down to one task for data with TASK_CHUNK_VALUES values
+    or more.
+
+    Parameters
+    ----------
+    n_values: int
+
+    Returns
+    -------
+    int
+    """
+    return int(max(1, min(TASK_CHUNK_MAX_SIZE,
+                          TASK_CHUNK_VALUES // max(n_values, 1))))
+
+
+def data_values(s3_file_key, columns):
+    """
+    Number of values in `columns` of the file, read from the manifest of its
+    columnar copy. Files without a columnar copy are assumed to hold a value
+    in every 8 bytes, which overestimates the values of a CSV file, so
+    their chunks are at most as large as they should be.
+
+    Parameters
+    ----------
+    s3_file_key: str
+    columns: list(str)
+
+    Returns
+    -------
+    int
+    """
+    try:
+        manifest, _ = dataset_cache.read(
+            columns_file_key(s3_file_key, 'manifest.json'), read_manifest)
+    except KeyError:
+        _, size = s3_object_info(s3_file_key)
+        return size // 8
+    return manifest['n_rows'] * len(columns)
+
+
+def parse_covar(covar):
+    """
+    Parses a covariance option of a job, such as 'Full-Tied'.
+
+    Parameters
+    ----------
+    covar: str
+
+    Returns
+    -------
+    str, bool
+        covar_type, covar_tied
+    """
+    covar_type, covar_tied = covar.lower().split('-')
+    return covar_type, covar_tied == 'tied'
 
 
 # TODO pass the task id instead of all the params. do this everywhere.
@@ -117,6 +336,368 @@ def rerun_task(job_id, task_id):
                     s3_file_key, columns, scale)
 
 
+def create_kmeans(data, n_clusters, covar_type, covar_tied, n_init,
+                  max_n_clusters=None):
+    """
+    Creates an instance of the `kmeans` object with the worker settings.
+
+    Parameters
+    ----------
+    data: Pandas DataFrame or numpy array
+        Data containing only the columns to be used for `fit`
+    n_clusters: int
+    covar_type: str
+    covar_tied: bool
+    n_init: int
+    max_n_clusters: int
+        largest number of clusters the object is used for, such as the
+        largest k of `iter_path`; defaults to n_clusters
+
+    Returns
+    -------
+    SF_KMeans, MiniBatchSF_KMeans, CoresetSF_KMeans or StreamingSF_KMeans
+    """
+    kmeans_class, params = kmeans_settings(data, max_n_clusters or n_clusters,
+                                           n_init)
+    return kmeans_class(n_clusters=n_clusters, covar_type=covar_type,
+                        covar_tied=covar_tied, n_init=n_init, **params)
+
+
+def kmeans_settings(data, n_clusters, n_init):
+    """
+    Picks the `kmeans` class and the parameters used by all fits for the size
+    of the data: small datasets run all restarts in lockstep, datasets
+    above MINIBATCH_MIN_ROWS are fit with mini-batches and memory-mapped
+    datasets are fit with sequential scans. If CORESET_SIZE is set, in-memory
+    datasets with more rows are fit on a coreset of CORESET_SIZE rows instead.
+    See `stacked_engine` for when restarts run in lockstep.
+
+    Parameters
+    ----------
+    data: Pandas DataFrame, numpy array or RowBlocks
+    n_clusters: int
+        largest number of clusters fit
+    n_init: int
+
+    Returns
+    -------
+    class, dict
+        SF_KMeans, MiniBatchSF_KMeans, CoresetSF_KMeans or
+        StreamingSF_KMeans, parameters
+    """
+    params = dict(n_jobs=KMEANS_N_JOBS, assignment=KMEANS_ASSIGNMENT,
+                  memory_budget=KMEANS_MEMORY_BUDGET,
+                  euclidean_tol=KMEANS_EUCLIDEAN_TOL,
+                  scale_tol=KMEANS_SCALE_TOL, reassign_tol=KMEANS_REASSIGN_TOL,
+                  ll_tol=KMEANS_LL_TOL, race_margin=KMEANS_RACE_MARGIN,
+                  compress_duplicates=COMPRESS_DUPLICATES, verbose=0)
+    if isinstance(data, RowBlocks):
+        return StreamingSF_KMeans, dict(params, block_rows=STREAMING_BLOCK_ROWS)
+    n_features = data.shape[1]
+    if CORESET_SIZE is not None and len(data) > CORESET_SIZE:
+        engine = stacked_engine(CORESET_SIZE, n_features, n_clusters, n_init)
+        return CoresetSF_KMeans, dict(params, coreset_size=CORESET_SIZE,
+                                      engine=engine)
+    if len(data) > MINIBATCH_MIN_ROWS:
+        return MiniBatchSF_KMeans, dict(params, batch_size=MINIBATCH_SIZE)
+    engine = stacked_engine(len(data), n_features, n_clusters, n_init)
+    return sf_kmeans.SF_KMeans, dict(params, engine=engine)
+
+
+def stacked_engine(n, n_features, n_clusters, n_init):
+    """
+    Picks the engine of a fit: 'stacked' for data with at most
+    STACKED_ENGINE_MAX_ROWS rows, where it is faster, unless the memory it
+    would allocate, see `stacked_memory_bytes`, exceeds KMEANS_MEMORY_BUDGET;
+    else 'loop'.
+
+    Parameters
+    ----------
+    n: int
+        number of data points
+    n_features: int
+    n_clusters: int
+    n_init: int
+
+    Returns
+    -------
+    str
+    """
+    if n > STACKED_ENGINE_MAX_ROWS:
+        return 'loop'
+    if KMEANS_MEMORY_BUDGET is not None and stacked_memory_bytes(
+            n, n_features, n_clusters, n_init) > KMEANS_MEMORY_BUDGET:
+        return 'loop'
+    return 'stacked'
+
+
+def kmeans_results(kmeans):
+    """
+    Collects the results of a fitted `kmeans` object.
+
+    Parameters
+    ----------
+    kmeans: SF_KMeans
+
+    Returns
+    -------
+    float, float, list(int), int, numpy array
+        aic, bic, labels, iteration_num, centers
+    """
+    scores = kmeans.score()
+    aic, bic = scores['aic'], scores['bic']
+    labels = [int(l) for l in kmeans.labels_]
+    return aic, bic, labels, kmeans.iteration_num, kmeans.cluster_centers_
+
+
+def fit_details(kmeans):
+    """
+    Collects how a fitted `kmeans` object got its results: the stopping rule
+    that ended the fit, the number of restarts abandoned by racing, and the
+    coreset size and relative log likelihood error of a fit on a coreset,
+    which are None for exact fits.
+
+    Parameters
+    ----------
+    kmeans: SF_KMeans
+
+    Returns
+    -------
+    dict
+        stop_reason, pruned_restarts, coreset_size, coreset_error
+    """
+    details = dict(stop_reason=kmeans.stop_reason,
+                   pruned_restarts=kmeans.pruned_restarts_, coreset_size=None,
+                   coreset_error=None)
+    if getattr(kmeans, 'coreset_', None) is not None:
+        details.update(coreset_size=len(kmeans.coreset_[0]),
+                       coreset_error=float(kmeans.coreset_error_))
+    return details
+
+
+def read_data(s3_file_key, columns):
+    """
+    Reads `columns` from the columnar copy of the file made at upload, see
+    `read_columns`, or from the file itself if it has no columnar copy or one
+    of `columns` is not in it.
+    The file is read through the dataset cache of this worker, which only
+    downloads it if neither the memory nor the disk tier has it. Files larger
+    than STREAMING_MIN_BYTES are converted to a read-only memory-mapped array
+    of `columns`, one chunk of rows at a time, so that they never need to fit
+    in memory.
+
+    Parameters
+    ----------
+    s3_file_key: str
+    columns: list(str)
+
+    Returns
+    -------
+    Pandas DataFrame, numpy.memmap or RowBlocks, dict
+        data, read details: read_source and read_time_saved, see
+        `DatasetCache.read`
+    """
+    try:
+        data, read_details = read_columns(s3_file_key, columns)
+    except KeyError:
+        data, read_details = read_csv(s3_file_key, columns)
+    print(' dataset cache: {} memory hits, {} shared hits, {} disk hits, '
+          '{} misses'.format(dataset_cache.memory_hits,
+                             dataset_cache.shared_hits,
+                             dataset_cache.disk_hits, dataset_cache.misses))
+    return data, read_details
+
+
+def read_columns(s3_file_key, columns):
+    """
+    Memory-maps `columns` from the columnar copy of the file made at upload,
+    see `utils.upload_columns_to_s3`, so no text is parsed and only these
+    columns are downloaded. Column files are cached on disk by the dataset
+    cache and keyed by their content hash. Data larger than
+    STREAMING_MIN_BYTES is read one block of rows at a time.
+
+    Parameters
+    ----------
+    s3_file_key: str
+    columns: list(str)
+
+    Returns
+    -------
+    Pandas DataFrame or RowBlocks, dict
+        data, read details, see `read_data`
+
+    Raises
+    ------
+    KeyError
+        if the file has no columnar copy or one of `columns` is not in it
+    """
+    manifest, details = dataset_cache.read(
+        columns_file_key(s3_file_key, 'manifest.json'), read_manifest)
+    n_rows = manifest['n_rows']
+    all_details = [details]
+    arrays = []
+    for column in columns:
+        info = manifest['columns'][column]
+        array, details = dataset_cache.read(
+            columns_file_key(s3_file_key, info['file']),
+            lambda filename: read_column_file(filename, n_rows),
+            version=info['md5'], size=info['size'])
+        arrays += [array]
+        all_details += [details]
+
+    sources = [details['read_source'] for details in all_details]
+    saved = [details['read_time_saved'] for details in all_details
+             if details['read_time_saved'] is not None]
+    read_details = dict(
+        read_source=min(sources, key=['s3', 'disk', 'memory'].index),
+        read_time_saved=sum(saved) if saved else None)
+    if n_rows * len(columns) * 8 > STREAMING_MIN_BYTES:
+        return RowBlocks(ColumnStack(arrays), STREAMING_BLOCK_ROWS), \
+            read_details
+    return pd.DataFrame(dict(zip(columns, arrays)), columns=columns), \
+        read_details
+
+
+def read_manifest(filename):
+    """ Parses the manifest of a columnar copy, see `utils.csv_to_columns` """
+    with open(filename) as f:
+        return json.load(f)
+
+
+def read_csv(s3_file_key, columns):
+    """
+    Reads the file itself, see `read_data`.
+
+    Parameters
+    ----------
+    s3_file_key: str
+    columns: list(str)
+
+    Returns
+    -------
+    Pandas DataFrame or numpy.memmap, dict
+        data, read details, see `read_data`
+    """
+    def parse(filename):
+        if os.path.getsize(filename) > STREAMING_MIN_BYTES:
+            return csv_to_memmap(filename, columns, STREAMING_BLOCK_ROWS)
+        return pd.read_csv(filename)
+
+    return dataset_cache.read(s3_file_key, parse)
+
+
+def load_data(s3_file_key, columns, scale):
+    """
+    Reads the file and prepares it for `fit` with `prepare_data`.
+    In-memory data is prepared once per job on each worker: the prepared
+    matrix is kept by the dataset cache, keyed by the file, its ETag,
+    `columns` and `scale`, so later tasks of the job start fitting
+    immediately. If SHARED_MEMORY_BYTES is set, the prepared matrix is kept
+    once per machine in shared memory, which all worker processes map
+    read-only, and `fit` reads it without copying it. If
+    PREPARED_DATA_PERSIST is True, it is also kept in the disk tier. Data
+    read one block of rows at a time is not cached.
+
+    Parameters
+    ----------
+    s3_file_key: str
+    columns: list(str)
+    scale: bool
+
+    Returns
+    -------
+    numpy array or RowBlocks, dict
+        data, read details, see `read_data`
+    """
+    start_time = time.time()
+    key = dataset_cache.prepared_key(s3_file_key, columns, scale)
+    prepared, read_details = dataset_cache.read_prepared(key)
+    if prepared is not None:
+        return prepared.data, read_details
+    data, read_details = read_data(s3_file_key, columns)
+    if isinstance(data, (np.memmap, RowBlocks)):
+        return prepare_data(data, columns, scale), read_details
+    prepared = prepare_matrix(data, columns, scale)
+    prepared = dataset_cache.add_prepared(key, prepared,
+                                          time.time() - start_time,
+                                          PREPARED_DATA_PERSIST)
+    return prepared.data, read_details
+
+
+def prepare_matrix(data, columns, scale):
+    """
+    Selects the columns to be used for `fit` and scales them if requested,
+    keeping the mean and standard deviation of each column so that results
+    can be mapped back to the original units.
+
+    Parameters
+    ----------
+    data: Pandas DataFrame
+    columns: list(str)
+    scale: bool
+
+    Returns
+    -------
+    PreparedData
+    """
+    values = data.loc[:, columns].values.astype(float)
+    if not scale:
+        return PreparedData(np.ascontiguousarray(values))
+    std = np.nanstd(values, axis=0)
+    std[std == 0] = 1.
+    return PreparedData(np.ascontiguousarray(preprocessing.scale(values)),
+                        np.nanmean(values, axis=0), std)
+
+
+def prepare_data(data, columns, scale):
+    """
+    Selects the columns to be used for `fit` and scales them if requested.
+    A memory-mapped array or RowBlocks already contains only `columns`; it is
+    read through `RowBlocks` and scaled one block at a time when it is read.
+
+    Parameters
+    ----------
+    data: Pandas DataFrame, numpy.memmap or RowBlocks
+    columns: list(str)
+    scale: bool
+
+    Returns
+    -------
+    numpy array or RowBlocks
+    """
+    if isinstance(data, (np.memmap, RowBlocks)):
+        if isinstance(data, np.memmap):
+            data = RowBlocks(data, STREAMING_BLOCK_ROWS)
+        return data.standardized() if scale else data
+    return prepare_matrix(data, columns, scale).data
+
+
+def update_task_result(job_id, task_id, aic, bic, labels, iteration_num,
+                       centers, elapsed_time, elapsed_read_time,
+                       elapsed_processing_time, stop_reason=None,
+                       pruned_restarts=None, coreset_size=None,
+                       coreset_error=None, read_source=None,
+                       read_time_saved=None):
+    """
+    Updates the database entry of a task with its results and sets its
+    status to 'done'. The caller commits the session.
+    """
+    cluster_counts = (np.sort(np.bincount(labels))[::-1]).tolist()
+    cluster_count_minimum = int(np.min(cluster_counts))
+    db.session.query(Task).filter_by(job_id=job_id, task_id=task_id).update(
+        dict(
+            task_status='done', aic=aic, bic=bic, labels=labels,
+            iteration_num=iteration_num, centers=((centers).tolist()),
+            elapsed_time=elapsed_time, elapsed_read_time=elapsed_read_time,
+            elapsed_processing_time=elapsed_processing_time,
+            stop_reason=stop_reason, pruned_restarts=pruned_restarts,
+            coreset_size=coreset_size,
+            coreset_error=coreset_error, read_source=read_source,
+            read_time_saved=read_time_saved,
+            cluster_counts=cluster_counts,
+            cluster_count_minimum=cluster_count_minimum))
+
+
 def run_kmeans(data, n_clusters, covar_type, covar_tied, n_init):
     """
     Creates an instance of the `kmeans` object and runs `fit` using the data.
@@ -132,16 +713,74 @@ def run_kmeans(data, n_clusters, covar_type, covar_tied, n_init):
 
     Returns
     -------
-    float, float, list(int)
-        aic, bic, labels
+    SF_KMeans
+        fitted `kmeans` object
     """
-    kmeans = sf_kmeans.SF_KMeans(n_clusters=n_clusters, covar_type=covar_type,
-                                 covar_tied=covar_tied, n_init=n_init,
-                                 verbose=0)
+    kmeans = create_kmeans(data, n_clusters, covar_type, covar_tied, n_init)
     kmeans.fit(data)
-    aic, bic = kmeans.aic(data), kmeans.bic(data)
-    labels = [int(l) for l in kmeans.labels_]
-    return aic, bic, labels, kmeans.iteration_num, kmeans.cluster_centers_
+    return kmeans
+
+
+def run_multi_kmeans(data, n_clusters, covars, n_init):
+    """
+    Fits all covariance types at once with `MultiConfigKMeans`, which shares
+    the seeding, initial assignment and initial cluster statistics of every
+    restart between them.
+
+    Parameters
+    ----------
+    data: numpy array or RowBlocks
+        Data containing only the columns to be used for `fit`
+    n_clusters: int
+    covars: list of (covar_type, covar_tied)
+    n_init: int
+
+    Returns
+    -------
+    list(SF_KMeans)
+        fitted `kmeans` object of each covariance type in `covars`
+    """
+    kmeans_class, params = kmeans_settings(data, n_clusters, n_init)
+    multi_kmeans = MultiConfigKMeans(n_clusters=n_clusters, covars=covars,
+                                     n_init=n_init, kmeans_class=kmeans_class,
+                                     **params)
+    return multi_kmeans.fit(data)
+
+
+def fit_group(data, group, n_init, path, covars_together):
+    """
+    Fits a group of tasks made by `group_cells` the way its task unit is
+    processed by `work_path_task`, `work_covars_task` or `work_task`.
+
+    Parameters
+    ----------
+    data: numpy array or RowBlocks
+        Data containing only the columns to be used for `fit`
+    group: list of (task_id, k, covar_type, covar_tied)
+    n_init: int
+    path: bool
+    covars_together: bool
+
+    Yields
+    ------
+    list of (task_id, SF_KMeans)
+        tasks finished by the same fit, as soon as they are done
+    """
+    task_ids, ks, covar_types, covar_tieds = [list(c) for c in zip(*group)]
+    if path:
+        task_id_for_k = dict(zip(ks, task_ids))
+        kmeans = create_kmeans(data, min(ks), covar_types[0], covar_tieds[0],
+                               n_init, max(ks))
+        for fitted in kmeans.iter_path(data, ks):
+            yield [(task_id_for_k[fitted.n_clusters], fitted)]
+    elif covars_together:
+        models = run_multi_kmeans(data, ks[0],
+                                  list(zip(covar_types, covar_tieds)), n_init)
+        yield list(zip(task_ids, models))
+    else:
+        for task_id, k, covar_type, covar_tied in group:
+            yield [(task_id, run_kmeans(data, k, covar_type, covar_tied,
+                                        n_init))]
 
 
 @app.task
@@ -172,31 +811,20 @@ def work_task(job_id, task_id, k, covar_type, covar_tied, n_init, s3_file_key, c
     try:
         print(' working on: job_id:{}, task_id:{}'.format(job_id, task_id))
         start_time = datetime.utcnow()
-        data = s3_to_df(s3_file_key)
+        data, read_details = load_data(s3_file_key, columns, scale)
         elapsed_read_time = (datetime.utcnow() - start_time).total_seconds()
         start_processing_time = datetime.utcnow()
-        data = data.loc[:, columns]
-        if scale:
-            data = preprocessing.scale(data)
 
-        aic, bic, labels, iteration_num, centers = run_kmeans(data, k,
-            covar_type, covar_tied, n_init)
+        kmeans = run_kmeans(data, k, covar_type, covar_tied, n_init)
+        aic, bic, labels, iteration_num, centers = kmeans_results(kmeans)
 
         elapsed_processing_time = (datetime.utcnow() -
                                    start_processing_time).total_seconds()
         elapsed_time = (datetime.utcnow() - start_time).total_seconds()
-        elapsed_processing_time = elapsed_processing_time
-        cluster_counts = (np.sort(np.bincount(labels))[::-1]).tolist()
-        cluster_count_minimum = int(np.min(cluster_counts))
-
-        db.session.query(Task).filter_by(job_id=job_id, task_id=task_id).update(
-            dict(
-                task_status='done', aic=aic, bic=bic, labels=labels,
-                iteration_num=iteration_num, centers=((centers).tolist()),
-                elapsed_time=elapsed_time, elapsed_read_time=elapsed_read_time,
-                elapsed_processing_time=elapsed_processing_time,
-                cluster_counts=cluster_counts,
-                cluster_count_minimum=cluster_count_minimum))
+        update_task_result(job_id, task_id, aic, bic, labels, iteration_num,
+                           centers, elapsed_time, elapsed_read_time,
+                           elapsed_processing_time, **read_details,
+                           **fit_details(kmeans))
         db.session.commit()
     except Exception as e:
         db.session.query(Task).filter_by(job_id=job_id,
@@ -206,4 +834,196 @@ def work_task(job_id, task_id, k, covar_type, covar_tied, n_init, s3_file_key, c
     return 'Done'
 
 
+@app.task
+def work_path_task(job_id, task_ids, ks, covar_type, covar_tied, n_init, s3_file_key, columns, scale):
+    """
+    Performs the processing needed to complete the tasks of one k-sweep, i.e.
+    all values of k for one experiment and covariance type.
+    Downloads and prepares the file once, then fits every k with
+    `SF_KMeans.iter_path`, which warm starts each k from the solution for the
+    previous k. Each task is updated in the database as soon as its k is done.
+    The read time and read details are attributed to the first task of the
+    sweep.
+    Sets `task_status` of the remaining tasks to 'error' if processing fails.
+
+    Parameters
+    ----------
+    job_id: str
+    task_ids: list(int)
+    ks: list(int)
+        k of each task in `task_ids`
+    covar_type: str
+    covar_tied: bool
+    n_init: int
+    s3_file_key: str
+    columns: list(str)
+    scale: bool
+
+    Returns
+    -------
+    str
+        'Done'
+    """
+    task_id_for_k = dict(zip(ks, task_ids))
+    remaining_task_ids = list(task_ids)
+    try:
+        print(' working on: job_id:{}, task_ids:{}'.format(job_id, task_ids))
+        start_time = datetime.utcnow()
+        data, read_details = load_data(s3_file_key, columns, scale)
+        elapsed_read_time = (datetime.utcnow() - start_time).total_seconds()
+        start_processing_time = datetime.utcnow()
+
+        kmeans = create_kmeans(data, min(ks), covar_type, covar_tied, n_init,
+                               max(ks))
+        for fitted in kmeans.iter_path(data, ks):
+            task_id = task_id_for_k[fitted.n_clusters]
+            aic, bic, labels, iteration_num, centers = kmeans_results(fitted)
+            elapsed_processing_time = (datetime.utcnow() -
+                                       start_processing_time).total_seconds()
+            elapsed_time = elapsed_read_time + elapsed_processing_time
+            update_task_result(job_id, task_id, aic, bic, labels,
+                               iteration_num, centers, elapsed_time,
+                               elapsed_read_time, elapsed_processing_time,
+                               **read_details, **fit_details(fitted))
+            db.session.commit()
+            remaining_task_ids.remove(task_id)
+            elapsed_read_time = 0
+            read_details = {}
+            start_processing_time = datetime.utcnow()
+    except Exception as e:
+        for task_id in remaining_task_ids:
+            db.session.query(Task).filter_by(job_id=job_id,
+                                             task_id=task_id).update(
+                dict(task_status='error'))
+        db.session.commit()
+        raise e
+    return 'Done'
+
+
+@app.task
+def work_covars_task(job_id, task_ids, k, covars, n_init, s3_file_key, columns, scale):
+    """
+    Performs the processing needed to complete the tasks of all covariance
+    types of one experiment and k.
+    Downloads and prepares the file once and fits all covariance types with
+    `MultiConfigKMeans`, which shares the seeding, initial assignment and
+    initial cluster statistics of every restart between them.
+    The read time and read details are attributed to the first task and the
+    processing time is split evenly between the tasks.
+    Sets `task_status` of all tasks to 'error' if processing fails.
+
+    Parameters
+    ----------
+    job_id: str
+    task_ids: list(int)
+    k: int
+    covars: list of (covar_type, covar_tied)
+        covariance type of each task in `task_ids`
+    n_init: int
+    s3_file_key: str
+    columns: list(str)
+    scale: bool
+
+    Returns
+    -------
+    str
+        'Done'
+    """
+    try:
+        print(' working on: job_id:{}, task_ids:{}'.format(job_id, task_ids))
+        start_time = datetime.utcnow()
+        data, read_details = load_data(s3_file_key, columns, scale)
+        elapsed_read_time = (datetime.utcnow() - start_time).total_seconds()
+        start_processing_time = datetime.utcnow()
+
+        models = run_multi_kmeans(data, k, covars, n_init)
+
+        elapsed_processing_time = (datetime.utcnow() -
+                                   start_processing_time).total_seconds()
+        elapsed_processing_time /= len(task_ids)
+        for task_id, kmeans in zip(task_ids, models):
+            aic, bic, labels, iteration_num, centers = kmeans_results(kmeans)
+            elapsed_time = elapsed_read_time + elapsed_processing_time
+            update_task_result(job_id, task_id, aic, bic, labels,
+                               iteration_num, centers, elapsed_time,
+                               elapsed_read_time, elapsed_processing_time,
+                               **read_details, **fit_details(kmeans))
+            elapsed_read_time = 0
+            read_details = {}
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        for task_id in task_ids:
+            db.session.query(Task).filter_by(job_id=job_id,
+                                             task_id=task_id).update(
+                dict(task_status='error'))
+        db.session.commit()
+        raise e
+    return 'Done'
+
+
+@app.task
+def work_chunk_task(job_id, groups, n_init, s3_file_key, columns, scale, path=False, covars_together=False):
+    """
+    Performs the processing needed to complete a chunk of tasks made by
+    `chunk_groups`.
+    Downloads and prepares the file once, fits each group of tasks with
+    `fit_group` and commits the results of all tasks together at the end.
+    The read time and read details are attributed to the first task and the
+    processing time of a fit is split evenly between the tasks it finished.
+    Sets `task_status` of all tasks of the chunk to 'error' if processing
+    fails, as none of their results is committed.
 
+    Parameters
+    ----------
+    job_id: str
+    groups: list of list of (task_id, k, covar_type, covar_tied)
+    n_init: int
+    s3_file_key: str
+    columns: list(str)
+    scale: bool
+    path: bool
+    covars_together: bool
+        how the tasks were grouped, see `group_cells`
+
+    Returns
+    -------
+    str
+        'Done'
+    """
+    task_ids = [cell[0] for group in groups for cell in group]
+    try:
+        print(' working on: job_id:{}, task_ids:{}'.format(job_id, task_ids))
+        start_time = datetime.utcnow()
+        data, read_details = load_data(s3_file_key, columns, scale)
+        elapsed_read_time = (datetime.utcnow() - start_time).total_seconds()
+        start_processing_time = datetime.utcnow()
+
+        for group in groups:
+            for finished in fit_group(data, group, n_init, path,
+                                      covars_together):
+                elapsed_processing_time = (
+                    datetime.utcnow() -
+                    start_processing_time).total_seconds() / len(finished)
+                for task_id, kmeans in finished:
+                    aic, bic, labels, iteration_num, centers = \
+                        kmeans_results(kmeans)
+                    elapsed_time = elapsed_read_time + elapsed_processing_time
+                    update_task_result(job_id, task_id, aic, bic, labels,
+                                       iteration_num, centers, elapsed_time,
+                                       elapsed_read_time,
+                                       elapsed_processing_time,
+                                       **read_details, **fit_details(kmeans))
+                    elapsed_read_time = 0
+                    read_details = {}
+                start_processing_time = datetime.utcnow()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        for task_id in task_ids:
+            db.session.query(Task).filter_by(job_id=job_id,
+                                             task_id=task_id).update(
+                dict(task_status='error'))
+        db.session.commit()
+        raise e
+    return 'Done'